@@ -31,10 +31,10 @@ from sipsimple.core import Credentials, SIPURI, ContactURIFactory
 from sipsimple.configuration import ConfigurationManager, Setting, SettingsGroup, SettingsObject, SettingsObjectID
 from sipsimple.configuration.datatypes import AudioCodecList, MSRPConnectionModel, MSRPRelayAddress, MSRPTransport, NonNegativeInteger, Path, SIPAddress, SIPProxyAddress, SRTPEncryption, STUNServerAddressList, VideoCodecList, XCAPRoot
 from sipsimple.configuration.settings import SIPSimpleSettings
-from sipsimple.payloads import ParserError
+from sipsimple.payloads.decoder import PayloadDecoder
 from sipsimple.payloads.messagesummary import MessageSummary
 from sipsimple.payloads.pidf import PIDFDocument
-from sipsimple.payloads.rlsnotify import RLSNotify
+from sipsimple.payloads.rlsnotify import RLSNotify, RLSState
 from sipsimple.payloads.watcherinfo import WatcherInfoDocument
 from sipsimple.threading import call_in_thread
 from sipsimple.threading.green import call_in_green_thread, run_in_green_thread
@@ -165,7 +165,9 @@ class Account(SettingsObject):
         self._pwi_version = None
         self._dwi_version = None
         self._presence_version = None
+        self._presence_state = RLSState()
         self._dialog_version = None
+        self._dialog_state = RLSState()
 
     def start(self):
         if self._started or self._deleted:
@@ -334,134 +336,189 @@ class Account(SettingsObject):
             notification.center.post_notification('SIPAccountDidDiscoverXCAPSupport', sender=self)
 
     def _NH_MWISubscriberDidDeactivate(self, notification):
-        self._mwi_voicemail_uri = None
+        PayloadDecoder().call_in_order(notification.sender, self._reset_mwi_state)
 
     def _NH_MWISubscriptionGotNotify(self, notification):
         if notification.data.body and notification.data.content_type == MessageSummary.content_type:
-            try:
-                message_summary = MessageSummary.parse(notification.data.body)
-            except ParserError:
-                pass
-            else:
-                self._mwi_voicemail_uri = message_summary.message_account and SIPAddress(message_summary.message_account.replace('sip:', '', 1)) or None
-                notification.center.post_notification('SIPAccountGotMessageSummary', sender=self, data=NotificationData(message_summary=message_summary))
+            PayloadDecoder().decode(notification.sender, 'MWISubscription', notification.data.content_type, notification.data.body)
+
+    def _NH_MWISubscriptionDidDecode(self, notification):
+        message_summary = notification.data.payload
+        self._mwi_voicemail_uri = message_summary.message_account and SIPAddress(message_summary.message_account.replace('sip:', '', 1)) or None
+        notification.center.post_notification('SIPAccountGotMessageSummary', sender=self, data=NotificationData(message_summary=message_summary))
+
+    def _NH_MWISubscriptionDidFailToDecode(self, notification):
+        if notification.data.dropped:
+            self._mwi_subscriber.resubscribe()
 
     def _NH_PresenceWinfoSubscriptionGotNotify(self, notification):
         if notification.data.body and notification.data.content_type == WatcherInfoDocument.content_type:
-            try:
-                watcher_info = WatcherInfoDocument.parse(notification.data.body)
-                watcher_list = watcher_info['sip:' + self.id]
-            except (ParserError, KeyError):
-                pass
-            else:
-                if watcher_list.package != 'presence':
-                    return
-                if self._pwi_version is None:
-                    if watcher_info.state == 'partial':
-                        self._pwi_subscriber.resubscribe()
-                elif watcher_info.version <= self._pwi_version:
-                    return
-                elif watcher_info.state == 'partial' and watcher_info.version > self._pwi_version + 1:
+            PayloadDecoder().decode(notification.sender, 'PresenceWinfoSubscription', notification.data.content_type, notification.data.body)
+
+    def _NH_PresenceWinfoSubscriptionDidDecode(self, notification):
+        watcher_info = notification.data.payload
+        try:
+            watcher_list = watcher_info['sip:' + self.id]
+        except KeyError:
+            pass
+        else:
+            if watcher_list.package != 'presence':
+                return
+            if self._pwi_version is None:
+                if watcher_info.state == 'partial':
                     self._pwi_subscriber.resubscribe()
-                self._pwi_version = watcher_info.version
-                data = NotificationData(version=watcher_info.version, state=watcher_info.state, watcher_list=watcher_list)
-                notification.center.post_notification('SIPAccountGotPresenceWinfo', sender=self, data=data)
+            elif watcher_info.version <= self._pwi_version:
+                return
+            elif watcher_info.state == 'partial' and watcher_info.version > self._pwi_version + 1:
+                self._pwi_subscriber.resubscribe()
+            self._pwi_version = watcher_info.version
+            data = NotificationData(version=watcher_info.version, state=watcher_info.state, watcher_list=watcher_list)
+            notification.center.post_notification('SIPAccountGotPresenceWinfo', sender=self, data=data)
+
+    def _NH_PresenceWinfoSubscriptionDidFailToDecode(self, notification):
+        if notification.data.dropped:
+            # the state is incomplete without the dropped notification, get the full state again
+            self._pwi_subscriber.resubscribe()
 
     def _NH_PresenceWinfoSubscriptionDidEnd(self, notification):
-        self._pwi_version = None
+        PayloadDecoder().call_in_order(notification.sender, self._reset_presence_winfo)
 
     def _NH_PresenceWinfoSubscriptionDidFail(self, notification):
-        self._pwi_version = None
+        PayloadDecoder().call_in_order(notification.sender, self._reset_presence_winfo)
 
     def _NH_DialogWinfoSubscriptionGotNotify(self, notification):
         if notification.data.body and notification.data.content_type == WatcherInfoDocument.content_type:
-            try:
-                watcher_info = WatcherInfoDocument.parse(notification.data.body)
-                watcher_list = watcher_info['sip:' + self.id]
-            except (ParserError, KeyError):
-                pass
-            else:
-                if watcher_list.package != 'dialog':
-                    return
-                if self._dwi_version is None:
-                    if watcher_info.state == 'partial':
-                        self._dwi_subscriber.resubscribe()
-                elif watcher_info.version <= self._dwi_version:
-                    return
-                elif watcher_info.state == 'partial' and watcher_info.version > self._dwi_version + 1:
+            PayloadDecoder().decode(notification.sender, 'DialogWinfoSubscription', notification.data.content_type, notification.data.body)
+
+    def _NH_DialogWinfoSubscriptionDidDecode(self, notification):
+        watcher_info = notification.data.payload
+        try:
+            watcher_list = watcher_info['sip:' + self.id]
+        except KeyError:
+            pass
+        else:
+            if watcher_list.package != 'dialog':
+                return
+            if self._dwi_version is None:
+                if watcher_info.state == 'partial':
                     self._dwi_subscriber.resubscribe()
-                self._dwi_version = watcher_info.version
-                data = NotificationData(version=watcher_info.version, state=watcher_info.state, watcher_list=watcher_list)
-                notification.center.post_notification('SIPAccountGotDialogWinfo', sender=self, data=data)
+            elif watcher_info.version <= self._dwi_version:
+                return
+            elif watcher_info.state == 'partial' and watcher_info.version > self._dwi_version + 1:
+                self._dwi_subscriber.resubscribe()
+            self._dwi_version = watcher_info.version
+            data = NotificationData(version=watcher_info.version, state=watcher_info.state, watcher_list=watcher_list)
+            notification.center.post_notification('SIPAccountGotDialogWinfo', sender=self, data=data)
+
+    def _NH_DialogWinfoSubscriptionDidFailToDecode(self, notification):
+        if notification.data.dropped:
+            self._dwi_subscriber.resubscribe()
 
     def _NH_DialogWinfoSubscriptionDidEnd(self, notification):
-        self._dwi_version = None
+        PayloadDecoder().call_in_order(notification.sender, self._reset_dialog_winfo)
 
     def _NH_DialogWinfoSubscriptionDidFail(self, notification):
-        self._dwi_version = None
+        PayloadDecoder().call_in_order(notification.sender, self._reset_dialog_winfo)
 
     def _NH_PresenceSubscriptionGotNotify(self, notification):
         if notification.data.body and notification.data.content_type == RLSNotify.content_type:
-            try:
-                rls_notify = RLSNotify.parse('{content_type}\r\n\r\n{body}'.format(content_type=notification.data.headers['Content-Type'], body=notification.data.body))
-            except ParserError:
-                pass
-            else:
-                if rls_notify.uri != self.xcap_manager.rls_presence_uri:
-                    return
-                if self._presence_version is None:
-                    if not rls_notify.full_state:
-                        self._presence_subscriber.resubscribe()
-                elif rls_notify.version <= self._presence_version:
-                    return
-                elif not rls_notify.full_state and rls_notify.version > self._presence_version + 1:
-                    self._presence_subscriber.resubscribe()
-                self._presence_version = rls_notify.version
-                data = NotificationData(version=rls_notify.version, full_state=rls_notify.full_state, resource_map=dict((resource.uri, resource) for resource in rls_notify))
-                notification.center.post_notification('SIPAccountGotPresenceState', sender=self, data=data)
+            PayloadDecoder().decode(notification.sender, 'PresenceSubscription', notification.data.content_type, notification.data.body, headers=notification.data.headers, pidf_cache=self._presence_state.pidf_cache)
+
+    def _NH_PresenceSubscriptionDidDecode(self, notification):
+        rls_notify = notification.data.payload
+        if rls_notify.uri != self.xcap_manager.rls_presence_uri:
+            self._presence_state.discard(rls_notify)
+            return
+        if self._presence_version is None:
+            if not rls_notify.full_state:
+                self._presence_subscriber.resubscribe()
+        elif rls_notify.version <= self._presence_version:
+            self._presence_state.discard(rls_notify)
+            return
+        elif not rls_notify.full_state and rls_notify.version > self._presence_version + 1:
+            self._presence_subscriber.resubscribe()
+        self._presence_version = rls_notify.version
+        modified_resources, removed_resources = self._presence_state.update(rls_notify)
+        data = NotificationData(version=rls_notify.version, full_state=rls_notify.full_state, resource_map=dict((resource.uri, resource) for resource in rls_notify),
+                                modified_resources=modified_resources, removed_resources=removed_resources)
+        notification.center.post_notification('SIPAccountGotPresenceState', sender=self, data=data)
+
+    def _NH_PresenceSubscriptionDidFailToDecode(self, notification):
+        if notification.data.dropped:
+            self._presence_subscriber.resubscribe()
 
     def _NH_PresenceSubscriptionDidEnd(self, notification):
-        self._presence_version = None
+        PayloadDecoder().call_in_order(notification.sender, self._reset_presence_state)
 
     def _NH_PresenceSubscriptionDidFail(self, notification):
-        self._presence_version = None
+        PayloadDecoder().call_in_order(notification.sender, self._reset_presence_state)
 
     def _NH_SelfPresenceSubscriptionGotNotify(self, notification):
         if notification.data.body and notification.data.content_type == PIDFDocument.content_type:
-            try:
-                pidf_doc = PIDFDocument.parse(notification.data.body)
-            except ParserError:
-                pass
-            else:
-                if pidf_doc.entity.partition('sip:')[2] != self.id:
-                    return
-                notification.center.post_notification('SIPAccountGotSelfPresenceState', sender=self, data=NotificationData(pidf=pidf_doc))
+            PayloadDecoder().decode(notification.sender, 'SelfPresenceSubscription', notification.data.content_type, notification.data.body)
+
+    def _NH_SelfPresenceSubscriptionDidDecode(self, notification):
+        pidf_doc = notification.data.payload
+        if pidf_doc.entity.partition('sip:')[2] != self.id:
+            return
+        notification.center.post_notification('SIPAccountGotSelfPresenceState', sender=self, data=NotificationData(pidf=pidf_doc))
+
+    def _NH_SelfPresenceSubscriptionDidFailToDecode(self, notification):
+        if notification.data.dropped:
+            self._self_presence_subscriber.resubscribe()
 
     def _NH_DialogSubscriptionGotNotify(self, notification):
         if notification.data.body and notification.data.content_type == RLSNotify.content_type:
-            try:
-                rls_notify = RLSNotify.parse('{content_type}\r\n\r\n{body}'.format(content_type=notification.data.headers['Content-Type'], body=notification.data.body))
-            except ParserError:
-                pass
-            else:
-                if rls_notify.uri != self.xcap_manager.rls_dialog_uri:
-                    return
-                if self._dialog_version is None:
-                    if not rls_notify.full_state:
-                        self._dialog_subscriber.resubscribe()
-                elif rls_notify.version <= self._dialog_version:
-                    return
-                elif not rls_notify.full_state and rls_notify.version > self._dialog_version + 1:
-                    self._dialog_subscriber.resubscribe()
-                self._dialog_version = rls_notify.version
-                data = NotificationData(version=rls_notify.version, full_state=rls_notify.full_state, resource_map=dict((resource.uri, resource) for resource in rls_notify))
-                notification.center.post_notification('SIPAccountGotDialogState', sender=self, data=data)
+            PayloadDecoder().decode(notification.sender, 'DialogSubscription', notification.data.content_type, notification.data.body, headers=notification.data.headers, pidf_cache=self._dialog_state.pidf_cache)
+
+    def _NH_DialogSubscriptionDidDecode(self, notification):
+        rls_notify = notification.data.payload
+        if rls_notify.uri != self.xcap_manager.rls_dialog_uri:
+            self._dialog_state.discard(rls_notify)
+            return
+        if self._dialog_version is None:
+            if not rls_notify.full_state:
+                self._dialog_subscriber.resubscribe()
+        elif rls_notify.version <= self._dialog_version:
+            self._dialog_state.discard(rls_notify)
+            return
+        elif not rls_notify.full_state and rls_notify.version > self._dialog_version + 1:
+            self._dialog_subscriber.resubscribe()
+        self._dialog_version = rls_notify.version
+        modified_resources, removed_resources = self._dialog_state.update(rls_notify)
+        data = NotificationData(version=rls_notify.version, full_state=rls_notify.full_state, resource_map=dict((resource.uri, resource) for resource in rls_notify),
+                                modified_resources=modified_resources, removed_resources=removed_resources)
+        notification.center.post_notification('SIPAccountGotDialogState', sender=self, data=data)
+
+    def _NH_DialogSubscriptionDidFailToDecode(self, notification):
+        if notification.data.dropped:
+            self._dialog_subscriber.resubscribe()
 
     def _NH_DialogSubscriptionDidEnd(self, notification):
-        self._dialog_version = None
+        PayloadDecoder().call_in_order(notification.sender, self._reset_dialog_state)
 
     def _NH_DialogSubscriptionDidFail(self, notification):
+        PayloadDecoder().call_in_order(notification.sender, self._reset_dialog_state)
+
+    # The state kept for the subscriptions is reset through the payload decoder, so that
+    # it is not updated by the notifications that were still being decoded when they ended
+
+    def _reset_mwi_state(self):
+        self._mwi_voicemail_uri = None
+
+    def _reset_presence_winfo(self):
+        self._pwi_version = None
+
+    def _reset_dialog_winfo(self):
+        self._dwi_version = None
+
+    def _reset_presence_state(self):
+        self._presence_version = None
+        self._presence_state.clear()
+
+    def _reset_dialog_state(self):
         self._dialog_version = None
+        self._dialog_state.clear()
 
     def _activate(self):
         with self._activation_lock:
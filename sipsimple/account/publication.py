@@ -66,6 +66,7 @@ class Publisher(object):
     __metaclass__ = ABCMeta
     __nickname__  = PublisherNickname()
     __transports__ = frozenset(['tls', 'tcp', 'udp'])
+    __coalescing_window__ = 0.5 # state changes that happen within this many seconds are sent in a single PUBLISH
 
     implements(IObserver)
 
@@ -82,6 +83,12 @@ class Publisher(object):
         self._dns_wait = 1
         self._publish_wait = 1
         self._publication_timer = None
+        self._coalescing_timer = None
+        self._state_version = 0
+        self._body_cache = None
+        self._published_body = None
+        self.sent_publications = 0
+        self.suppressed_publications = 0
         self.__dict__['state'] = None
 
     @abstractproperty
@@ -105,6 +112,8 @@ class Publisher(object):
         with self._lock:
             old_state = self.__dict__['state']
             self.__dict__['state'] = state
+            # the state may have been modified in place before being assigned again, so its cached body is dropped
+            self._state_version += 1
             if state == old_state:
                 return
             self._publish(state)
@@ -137,6 +146,7 @@ class Publisher(object):
         notification_center.remove_observer(self, name='CFGSettingsObjectDidChange', sender=self.account)
         notification_center.remove_observer(self, name='CFGSettingsObjectDidChange', sender=SIPSimpleSettings())
         notification_center.remove_observer(self, name='NetworkConditionsDidChange')
+        self._cancel_coalescing_timer()
         command = Command('terminate')
         self._command_channel.send(command)
         command.wait()
@@ -157,6 +167,7 @@ class Publisher(object):
         if not self.started:
             raise RuntimeError("not started")
         self.active = False
+        self._cancel_coalescing_timer()
         self._command_channel.send(Command('unpublish'))
         notification_center = NotificationCenter()
         notification_center.post_notification(self.__class__.__name__ + 'DidDeactivate', sender=self)
@@ -166,9 +177,34 @@ class Publisher(object):
         if not self.active:
             return
         if state is None:
+            self._cancel_coalescing_timer()
             self._command_channel.send(Command('unpublish'))
-        else:
+        elif state is SameState:
             self._command_channel.send(Command('publish', state=state))
+        elif self._coalescing_timer is None:
+            # wait for the state to settle, the latest state will be published when the timer fires
+            self._coalescing_timer = reactor.callLater(self.__coalescing_window__, self._publish_coalesced_state)
+
+    def _publish_coalesced_state(self):
+        self._coalescing_timer = None
+        if self.active:
+            self._command_channel.send(Command('publish', state=self.state))
+
+    @run_in_twisted_thread
+    def _cancel_coalescing_timer(self):
+        if self._coalescing_timer is not None and self._coalescing_timer.active():
+            self._coalescing_timer.cancel()
+        self._coalescing_timer = None
+
+    def _build_body(self, state):
+        # the body is serialized again only after the state was assigned
+        version = self._state_version
+        cache = self._body_cache
+        if cache is not None and cache[0] is state and cache[1] == version:
+            return cache[2]
+        body = state.toxml()
+        self._body_cache = (state, version, body)
+        return body
 
     def _run(self):
         while True:
@@ -184,6 +220,13 @@ class Publisher(object):
         notification_center = NotificationCenter()
         settings = SIPSimpleSettings()
 
+        body = None if command.state is SameState else self._build_body(command.state)
+        if body is not None and self.publishing and body == self._published_body:
+            # the server already has this document, there is no need to send it again
+            self.suppressed_publications += 1
+            command.signal()
+            return
+
         if self._publication_timer is not None and self._publication_timer.active():
             self._publication_timer.cancel()
         self._publication_timer = None
@@ -214,8 +257,6 @@ class Publisher(object):
             else:
                 self._dns_wait = 1
 
-            body = None if command.state is SameState else command.state.toxml()
-
             # Publish by trying each route in turn
             publish_timeout = time() + 30
             for route in routes:
@@ -227,7 +268,8 @@ class Publisher(object):
                         except PublicationETagError:
                             state = self.state # access self.state only once to avoid race conditions
                             if state is not None:
-                                self._publication.publish(state.toxml(), RouteHeader(route.uri), timeout=limit(remaining_time, min=1, max=10))
+                                body = self._build_body(state)
+                                self._publication.publish(body, RouteHeader(route.uri), timeout=limit(remaining_time, min=1, max=10))
                             else:
                                 command.signal()
                                 return
@@ -260,6 +302,9 @@ class Publisher(object):
                     else:
                         self.publishing = True
                         self._publish_wait = 1
+                        self.sent_publications += 1
+                        if body is not None:
+                            self._published_body = body
                         command.signal()
                         break
             else:
@@ -269,6 +314,7 @@ class Publisher(object):
                 raise PublicationError('No more routes to try', retry_after=retry_after)
         except PublicationError, e:
             self.publishing = False
+            self._published_body = None
             notification_center.remove_observer(self, sender=self._publication)
             def publish():
                 if self.active:
@@ -289,6 +335,7 @@ class Publisher(object):
         self._publication_timer = None
         publishing = self.publishing
         self.publishing = False
+        self._published_body = None
         if self._publication is not None:
             notification_center = NotificationCenter()
             if publishing:
@@ -346,11 +393,13 @@ class Publisher(object):
             else:
                 self.deactivate()
         elif self.active and set(['__id__', 'auth.password', 'auth.username', 'sip.outbound_proxy', 'sip.transport_list', 'sip.publish_interval']).intersection(notification.data.modified):
+            self._cancel_coalescing_timer()
             self._command_channel.send(Command('unpublish'))
             self._command_channel.send(Command('publish', state=self.state))
 
     def _NH_NetworkConditionsDidChange(self, notification):
         if self.active:
+            self._cancel_coalescing_timer()
             self._command_channel.send(Command('unpublish'))
             self._command_channel.send(Command('publish', state=self.state))
 
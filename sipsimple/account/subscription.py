@@ -3,15 +3,17 @@
 
 """Implements the subscription handlers"""
 
-__all__ = ['Subscriber', 'MWISubscriber', 'PresenceWinfoSubscriber', 'DialogWinfoSubscriber', 'PresenceSubscriber', 'SelfPresenceSubscriber', 'DialogSubscriber']
+__all__ = ['SubscriptionPool', 'Subscriber', 'MWISubscriber', 'PresenceWinfoSubscriber', 'DialogWinfoSubscriber', 'PresenceSubscriber', 'SelfPresenceSubscriber', 'DialogSubscriber']
 
 import random
 
 from abc import ABCMeta, abstractproperty
+from threading import RLock
 from time import time
 
 from application.notification import IObserver, NotificationCenter, NotificationData
 from application.python import Null, limit
+from application.python.types import Singleton
 from eventlib import coros, proc
 from twisted.internet import reactor
 from zope.interface import implements
@@ -47,6 +49,84 @@ class Content(object):
         self.type = type
 
 
+class SubscriptionPool(object):
+    """
+    Keeps track of the outgoing subscriptions, so that the subscribers that
+    are interested in the same event package for the same resource, using
+    the same credentials, can share a single SUBSCRIBE dialog. The
+    subscribers that share a subscription all observe it and receive its
+    notifications, while the pool counts the references to it and tells the
+    last subscriber that releases it to end the dialog. A subscription is
+    added as soon as it is sent, so the subscribers that acquire it need to
+    wait for it to start or fail if it is not established yet.
+    """
+
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        self._subscriptions = {}
+        self._keys = {}
+        self._references = {}
+        self._lock = RLock()
+
+    @staticmethod
+    def key(uri, event, credentials=None, content=None, extra_headers=()):
+        credentials_key = None if credentials is None else (credentials.username, credentials.password, credentials.realm)
+        content_key = None if content is None else (content.type, content.body)
+        return (str(uri), event, credentials_key, content_key, tuple((header.name, header.body) for header in extra_headers))
+
+    def acquire(self, key):
+        """Return a new reference to the subscription for key or None"""
+        with self._lock:
+            subscription = self._subscriptions.get(key, None)
+            if subscription is None:
+                return None
+            if subscription.state == 'TERMINATED':
+                self._discard(subscription)
+                return None
+            self._references[subscription] += 1
+            return subscription
+
+    def add(self, key, subscription):
+        """Make a newly sent subscription available for sharing"""
+        with self._lock:
+            if subscription in self._references:
+                return
+            existing_subscription = self._subscriptions.get(key, None)
+            if existing_subscription is not None and existing_subscription.state != 'TERMINATED':
+                # another subscriber sent the same subscription in the meantime, keep using that one for sharing
+                return
+            if existing_subscription is not None:
+                self._discard(existing_subscription)
+            self._subscriptions[key] = subscription
+            self._keys[subscription] = key
+            self._references[subscription] = 1
+
+    def release(self, subscription):
+        """Drop a reference to the subscription and return True if it is no longer used by anyone"""
+        with self._lock:
+            if subscription not in self._references:
+                return True
+            self._references[subscription] -= 1
+            if self._references[subscription] > 0:
+                return False
+            self._discard(subscription)
+            return True
+
+    def invalidate(self, subscription):
+        """Stop sharing the subscription, while the subscribers that use it keep their references"""
+        with self._lock:
+            key = self._keys.get(subscription, None)
+            if key is not None and self._subscriptions.get(key, None) is subscription:
+                del self._subscriptions[key]
+
+    def _discard(self, subscription):
+        key = self._keys.pop(subscription)
+        del self._references[subscription]
+        if self._subscriptions.get(key, None) is subscription:
+            del self._subscriptions[key]
+
+
 class SubscriberNickname(dict):
     def __missing__(self, name):
         return self.setdefault(name, name[:-10] if name.endswith('Subscriber') else name)
@@ -152,6 +232,9 @@ class Subscriber(object):
         if self._subscription_timer is not None and self._subscription_timer.active():
             self._subscription_timer.cancel()
         self._subscription_timer = None
+        if self._subscription is not None:
+            # The subscription is replaced, so it must not be shared anymore
+            SubscriptionPool().invalidate(self._subscription)
         if self._subscription_proc is not None:
             subscription_proc = self._subscription_proc
             subscription_proc.kill(InterruptSubscription)
@@ -177,6 +260,7 @@ class Subscriber(object):
     def _subscription_handler(self, command):
         notification_center = NotificationCenter()
         settings = SIPSimpleSettings()
+        pool = SubscriptionPool()
 
         subscription_uri = self.subscription_uri
         refresh_interval = command.refresh_interval or self.account.sip.subscribe_interval
@@ -198,9 +282,35 @@ class Subscriber(object):
 
             subscription_uri = SIPURI(user=subscription_uri.username, host=subscription_uri.domain)
             content = self.content
+            extra_headers = self.extra_headers
+
+            pool_key = pool.key(subscription_uri, self.event, self.account.credentials, content, extra_headers)
+            subscription = pool.acquire(pool_key)
+            if subscription is not None:
+                # Share the subscription started by another subscriber
+                notification_center.add_observer(self, sender=subscription)
+                self._subscription = subscription
+                try:
+                    if subscription.state in ('NULL', 'SENT'):
+                        # It is not established yet, so wait for it to start or fail just like the subscriber that sent it
+                        while True:
+                            notification = self._data_channel.wait()
+                            if notification.name == 'SIPSubscriptionDidStart':
+                                break
+                    else:
+                        # Refresh it so that the notifier sends the full state again
+                        subscription.subscribe(body=content.body, content_type=content.type, extra_headers=extra_headers, timeout=5)
+                except (SIPSubscriptionDidFail, SIPCoreError):
+                    # Go on with a subscription of our own
+                    notification_center.remove_observer(self, sender=subscription)
+                    pool.release(subscription)
+                    self._subscription = None
+                else:
+                    self.subscribed = True
+                    command.signal()
 
             timeout = time() + 30
-            for route in routes:
+            for route in routes if not self.subscribed else ():
                 remaining_time = timeout - time()
                 if remaining_time > 0:
                     try:
@@ -216,11 +326,12 @@ class Subscriber(object):
                                                 refresh=refresh_interval)
                     notification_center.add_observer(self, sender=subscription)
                     try:
-                        subscription.subscribe(body=content.body, content_type=content.type, extra_headers=self.extra_headers, timeout=limit(remaining_time, min=1, max=5))
+                        subscription.subscribe(body=content.body, content_type=content.type, extra_headers=extra_headers, timeout=limit(remaining_time, min=1, max=5))
                     except SIPCoreError:
                         notification_center.remove_observer(self, sender=subscription)
                         raise SubscriptionError('Internal error', retry_after=5)
                     self._subscription = subscription
+                    pool.add(pool_key, subscription)
                     try:
                         while True:
                             notification = self._data_channel.wait()
@@ -228,6 +339,7 @@ class Subscriber(object):
                                 break
                     except SIPSubscriptionDidFail, e:
                         notification_center.remove_observer(self, sender=subscription)
+                        pool.release(subscription)
                         self._subscription = None
                         if e.data.code == 407:
                             # Authentication failed, so retry the subscription in some time
@@ -250,7 +362,7 @@ class Subscriber(object):
                         self.subscribed = True
                         command.signal()
                         break
-            else:
+            if not self.subscribed:
                 # There are no more routes to try, reschedule the subscription
                 raise SubscriptionError('No more routes to try', retry_after=random.uniform(60, 180))
             # At this point it is subscribed. Handle notifications and ending/failures.
@@ -270,13 +382,15 @@ class Subscriber(object):
                 if self.active:
                     self._command_channel.send(Command('subscribe'))
             notification_center.remove_observer(self, sender=self._subscription)
+            pool.release(self._subscription)
         except InterruptSubscription, e:
             if not self.subscribed:
                 command.signal(e)
             if self._subscription is not None:
                 notification_center.remove_observer(self, sender=self._subscription)
                 try:
-                    self._subscription.end(timeout=2)
+                    if pool.release(self._subscription):
+                        self._subscription.end(timeout=2)
                 except SIPCoreError:
                     pass
                 finally:
@@ -286,17 +400,20 @@ class Subscriber(object):
                 command.signal(e)
             if self._subscription is not None:
                 try:
-                    self._subscription.end(timeout=2)
+                    last_reference = pool.release(self._subscription)
+                    if last_reference:
+                        self._subscription.end(timeout=2)
                 except SIPCoreError:
                     pass
                 else:
-                    try:
-                        while True:
-                            notification = self._data_channel.wait()
-                            if notification.name == 'SIPSubscriptionDidEnd':
-                                break
-                    except SIPSubscriptionDidFail:
-                        pass
+                    if last_reference:
+                        try:
+                            while True:
+                                notification = self._data_channel.wait()
+                                if notification.name == 'SIPSubscriptionDidEnd':
+                                    break
+                        except SIPSubscriptionDidFail:
+                            pass
                 finally:
                     notification_center.remove_observer(self, sender=self._subscription)
                     notification_center.post_notification(self.__nickname__ + 'SubscriptionDidEnd', sender=self, data=NotificationData(originator='local'))
@@ -8,15 +8,19 @@ __all__ = ['Group', 'Contact', 'ContactURI', 'EventHandling', 'Policy', 'Icon',
 
 import base64
 import cPickle
-import os
+import hashlib
 import random
+import struct
 import weakref
+import zlib
 
 from cStringIO import StringIO
 from collections import OrderedDict
+from copy import deepcopy
 from datetime import datetime
 from itertools import chain
 from operator import attrgetter
+from time import time
 from urllib2 import URLError
 
 from application import log
@@ -25,6 +29,7 @@ from application.python import Null
 from application.python.decorator import execute_once
 from eventlib import api, coros, proc
 from eventlib.green.httplib import BadStatusLine
+from lxml import etree
 from twisted.internet.error import ConnectionLost
 from xcaplib.green import XCAPClient
 from xcaplib.error import HTTPError
@@ -38,6 +43,7 @@ from sipsimple.lookup import DNSLookup, DNSLookupError
 from sipsimple.payloads import ParserError, IterateTypes, IterateIDs, IterateItems, All
 from sipsimple.payloads import addressbook, commonpolicy, dialogrules, omapolicy, pidf, prescontent, presrules, resourcelists, rlsservices, xcapcaps, xcapdiff
 from sipsimple.payloads import rpid; rpid # needs to be imported to register its namespace
+from sipsimple.payloads.decoder import PayloadDecoder
 from sipsimple.threading import run_in_twisted_thread
 from sipsimple.threading.green import Command, Worker, run_in_green_thread
 
@@ -68,25 +74,50 @@ class Document(object):
     global_tree        = None
     filename           = None
     cached             = True
+    max_node_updates   = 10 # update the whole document when more elements than this were modified
 
     def __init__(self, manager):
         self.manager = weakref.proxy(manager)
         self.content = None
         self.etag = None
+        self.update_etags = set()
         self.fetch_time = datetime.fromtimestamp(0)
         self.update_time = datetime.fromtimestamp(0)
+        self.fetch_duration = None
+        self.update_duration = None
         self.dirty = False
         self.supported = False
 
     def __nonzero__(self):
         return self.content is not None
 
+    def _get_content(self):
+        # a document loaded from the cache is only parsed when its content is first needed
+        document = self.__dict__.pop('cached_document', None)
+        if document is not None:
+            try:
+                self.__dict__['content'] = self.payload_type.parse(document, validate=False)
+            except ParserError:
+                self.__dict__['content'] = None
+                self.etag = None
+        return self.__dict__['content']
+
+    def _set_content(self, content):
+        self.__dict__.pop('cached_document', None)
+        self.__dict__['content'] = content
+
+    content = property(_get_content, _set_content)
+    del _get_content, _set_content
+
+    # a cached document that was not parsed yet cannot have been modified, so its content is left alone
     def _get_dirty(self):
-        return self.__dict__['dirty'] or (self.content is not None and self.content.__dirty__)
+        content = self.__dict__['content']
+        return self.__dict__['dirty'] or (content is not None and content.__dirty__)
 
     def _set_dirty(self, dirty):
-        if self.content is not None and not dirty:
-            self.content.__dirty__ = dirty
+        content = self.__dict__['content']
+        if content is not None and not dirty:
+            content.__dirty__ = dirty
         self.__dict__['dirty'] = dirty
 
     dirty = property(_get_dirty, _set_dirty)
@@ -100,26 +131,52 @@ class Document(object):
     def url(self):
         return self.manager.client.get_url(self.application, None, globaltree=self.global_tree, filename=self.filename)
 
+    # The cached documents are stored compressed, after a header line with the cache format, the SHA1 checksum
+    # of the document and its ETag. Only documents that were validated are cached, so when the checksum matches
+    # they are parsed without validating them again, when the content is first accessed. Caches saved as the
+    # ETag followed by the document by older versions are still loaded, with validation.
+
+    cache_format = 'XCAP-CACHE/1'
+
     def load_from_cache(self):
         if not self.cached:
             return
         try:
-            document = StringIO(self.manager.storage.load(self.name))
-            self.etag = document.readline().strip() or None
-            self.content = self.payload_type.parse(document)
+            data = self.manager.storage.load(self.name)
+            if data.startswith(self.cache_format + ' '):
+                header, data = data.split('\n', 1)
+                version, checksum, etag = header.split(' ', 2)
+                document = zlib.decompress(data)
+                if hashlib.sha1(document).hexdigest() != checksum:
+                    raise ValueError("checksum mismatch")
+                self.content = None
+                self.__dict__['cached_document'] = document
+                self.etag = etag or None
+            else:
+                document = StringIO(data)
+                self.etag = document.readline().strip() or None
+                self.content = self.payload_type.parse(document)
             self.__dict__['dirty'] = False
-        except (XCAPStorageError, ParserError):
+        except (XCAPStorageError, ParserError, ValueError, zlib.error):
             self.etag = None
             self.content = None
             self.dirty = False
         self.fetch_time = datetime.utcnow()
 
+    def save_to_cache(self, document):
+        header = '%s %s %s\n' % (self.cache_format, hashlib.sha1(document).hexdigest(), self.etag or '')
+        try:
+            self.manager.storage.save(self.name, header + zlib.compress(document))
+        except XCAPStorageError:
+            pass
+
     def initialize(self, server_caps):
         self.supported = self.application in server_caps.auids
         if not self.supported:
             self.reset()
 
     def reset(self):
+        self.__dict__.pop('unsaved_data', None)
         if self.cached and self.content is not None:
             try:
                 self.manager.storage.delete(self.name)
@@ -127,13 +184,19 @@ class Document(object):
                 pass
         self.content = None
         self.etag = None
+        self.update_etags.clear()
         self.dirty = False
 
+    def knows_etag(self, etag):
+        """Return True if the document version with the given ETag is the current one or was created by the last update"""
+        return etag is not None and (etag == self.etag or etag in self.update_etags)
+
     def fetch(self):
         try:
             document = self.manager.client.get(self.application, etagnot=self.etag, globaltree=self.global_tree, headers={'Accept': self.payload_type.content_type}, filename=self.filename)
             self.content = self.payload_type.parse(document)
             self.etag = document.etag
+            self.update_etags.clear()
             self.__dict__['dirty'] = False
         except (BadStatusLine, ConnectionLost, URLError), e:
             raise XCAPError("failed to fetch %s document: %s" % (self.name, e))
@@ -149,42 +212,118 @@ class Document(object):
         else:
             self.fetch_time = datetime.utcnow()
             if self.cached:
+                self.save_to_cache(document)
+
+    def apply_changes(self, changes):
+        """
+        Apply the changes reported for this document by xcap-diff (RFC5874)
+        to the local copy of the document. Returns False if they cannot be
+        applied and the document needs to be fetched instead.
+        """
+        if self.content is None or self.etag is None or self.dirty:
+            return False
+        etag = self.etag
+        root = deepcopy(self.content.element)
+        for change in changes:
+            if change.new_etag is None or change.previous_etag != etag:
+                return False
+            if not change.empty_body:
+                if not change.patch_operations:
+                    return False
                 try:
-                    self.manager.storage.save(self.name, self.etag + os.linesep + document)
-                except XCAPStorageError:
-                    pass
+                    change.apply_patch(root)
+                except ValueError:
+                    return False
+            etag = change.new_etag
+        document = etree.tostring(root, encoding='UTF-8', xml_declaration=True)
+        try:
+            self.content = self.payload_type.parse(document)
+        except ParserError:
+            return False
+        self.etag = etag
+        self.update_etags.clear()
+        self.__dict__['dirty'] = False
+        self.fetch_time = datetime.utcnow()
+        if self.cached:
+            self.save_to_cache(document)
+        return True
 
     def update(self):
         if not self.dirty:
             return
+        # The elements are addressed by their attribute values as we serialize them, so they can only be updated
+        # one by one when the server has a document that was uploaded by us, not one that was fetched from it.
+        uploaded = self.etag in self.update_etags
+        self.update_etags.clear()
         data = self.content.toxml() if self.content is not None else None
-        try:
-            kw = dict(etag=self.etag) if self.etag is not None else dict(etagnot='*')
-            if data is not None:
-                response = self.manager.client.put(self.application, data, globaltree=self.global_tree, filename=self.filename, headers={'Content-Type': self.payload_type.content_type}, **kw)
-            else:
-                response = self.manager.client.delete(self.application, data, globaltree=self.global_tree, filename=self.filename, **kw)
-        except (BadStatusLine, ConnectionLost, URLError), e:
-            raise XCAPError("failed to update %s document: %s" % (self.name, e))
-        except HTTPError, e:
-            if e.status == 412: # Precondition Failed
-                raise FetchRequiredError("document %s was modified externally" % self.name)
-            elif e.status == 404 and data is None: # attempted to delete a document that did't exist in the first place
-                pass
-            else:
+        if data is None or not uploaded or not self._update_nodes():
+            try:
+                kw = dict(etag=self.etag) if self.etag is not None else dict(etagnot='*')
+                if data is not None:
+                    response = self.manager.client.put(self.application, data, globaltree=self.global_tree, filename=self.filename, headers={'Content-Type': self.payload_type.content_type}, **kw)
+                else:
+                    response = self.manager.client.delete(self.application, data, globaltree=self.global_tree, filename=self.filename, **kw)
+            except (BadStatusLine, ConnectionLost, URLError), e:
                 raise XCAPError("failed to update %s document: %s" % (self.name, e))
-        self.etag = response.etag if data is not None else None
+            except HTTPError, e:
+                if e.status == 412: # Precondition Failed
+                    raise FetchRequiredError("document %s was modified externally" % self.name)
+                elif e.status == 404 and data is None: # attempted to delete a document that did't exist in the first place
+                    pass
+                else:
+                    raise XCAPError("failed to update %s document: %s" % (self.name, e))
+            self.etag = response.etag if data is not None else None
+            if self.etag is not None:
+                self.update_etags.add(self.etag)
         self.dirty = False
         self.update_time = datetime.utcnow()
         if self.cached:
+            # the manager stores the update in the cache with save_update, together with the journal
+            self.__dict__['unsaved_data'] = data
+
+    def save_update(self):
+        """Store the document uploaded by the last update in the cache"""
+        if 'unsaved_data' not in self.__dict__:
+            return
+        data = self.__dict__.pop('unsaved_data')
+        if data is not None:
+            self.save_to_cache(data)
+        else:
             try:
-                if data is not None:
-                    self.manager.storage.save(self.name, self.etag + os.linesep + data)
-                else:
-                    self.manager.storage.delete(self.name)
+                self.manager.storage.delete(self.name)
             except XCAPStorageError:
                 pass
 
+    def _update_nodes(self):
+        # Replace only the modified elements on the server with element PUTs (RFC4825), which also create the
+        # elements that were added, and remove the elements that were removed with element DELETEs. Returns False
+        # if the whole document needs to be uploaded instead, because the modified elements cannot be addressed,
+        # because there are too many of them or because the server did not accept an element update.
+        if self.etag is None or self.__dict__['dirty']:
+            return False
+        try:
+            nodes = self.content.get_dirty_nodes()
+        except NotImplementedError:
+            return False
+        if not nodes or len(nodes) > self.max_node_updates or any(element is self.content for xpath, element in nodes):
+            return False
+        for xpath, element in nodes:
+            try:
+                if element is not None:
+                    data = etree.tostring(element.element, encoding='UTF-8')
+                    response = self.manager.client.put(self.application, data, node=xpath, etag=self.etag, globaltree=self.global_tree, filename=self.filename, headers={'Content-Type': 'application/xcap-el+xml'})
+                else:
+                    response = self.manager.client.delete(self.application, node=xpath, etag=self.etag, globaltree=self.global_tree, filename=self.filename)
+            except (BadStatusLine, ConnectionLost, URLError), e:
+                raise XCAPError("failed to update %s document: %s" % (self.name, e))
+            except HTTPError, e:
+                if e.status == 412: # Precondition Failed
+                    raise FetchRequiredError("document %s was modified externally" % self.name)
+                return False
+            self.etag = response.etag
+            self.update_etags.add(self.etag)
+        return True
+
 
 class DialogRulesDocument(Document):
     name               = 'dialog-rules'
@@ -693,6 +832,8 @@ class XCAPSubscriber(Subscriber):
 class XCAPManager(object):
     implements(IObserver)
 
+    max_concurrent_requests = 4
+
     def __init__(self, account):
         from sipsimple.application import SIPApplication
         if SIPApplication.storage is None:
@@ -706,12 +847,17 @@ class XCAPManager(object):
         self.client = None
         self.command_proc = None
         self.command_channel = coros.queue()
+        self.request_slots = coros.queue()
+        for i in xrange(self.max_concurrent_requests):
+            self.request_slots.send(None)
         self.last_fetch_time = datetime.fromtimestamp(0)
         self.last_update_time = datetime.fromtimestamp(0)
         self.not_executed_fetch = None
         self.state = 'stopped'
         self.timer = None
         self.transaction_level = 0
+        self.commit_time = None
+        self.unsaved_operations = []
         self.xcap_subscriber = None
 
         self.server_caps = XCAPCapsDocument(self)
@@ -725,7 +871,7 @@ class XCAPManager(object):
         for document in self.documents:
             document.load_from_cache()
         try:
-            self.journal = cPickle.loads(self.storage.load('journal'))
+            self.journal = self._load_journal()
         except (XCAPStorageError, cPickle.UnpicklingError):
             self.journal = []
         else:
@@ -808,7 +954,10 @@ class XCAPManager(object):
             return
         self.transaction_level -= 1
         if self.transaction_level == 0 and self.journal:
-            self._save_journal()
+            self._append_journal(self.unsaved_operations)
+            self.unsaved_operations = []
+            if self.commit_time is None:
+                self.commit_time = time()
             self.command_channel.send(Command('update'))
 
     def add_contact(self, contact):
@@ -869,8 +1018,12 @@ class XCAPManager(object):
     def _schedule_operation(self, operation):
         self.journal.append(operation)
         if self.transaction_level == 0:
-            self._save_journal()
+            self._append_journal([operation])
+            if self.commit_time is None:
+                self.commit_time = time()
             self.command_channel.send(Command('update'))
+        else:
+            self.unsaved_operations.append(operation)
 
     def _run(self):
         while True:
@@ -928,6 +1081,8 @@ class XCAPManager(object):
         except XCAPStorageError:
             pass
         self.journal = []
+        self.unsaved_operations = []
+        self.commit_time = None
         self.state = 'terminated'
         command.signal()
         raise proc.ProcExit
@@ -999,6 +1154,26 @@ class XCAPManager(object):
             self.xcap_subscriber.resubscribe()
         command.signal()
 
+    def _CH_patch(self, command):
+        documents = set()
+        patched = False
+        for document in self.documents:
+            # the changes made by our own updates are already applied locally
+            changes = [change for change in command.changes if change.selector.auid == document.application and not document.knows_etag(change.new_etag)]
+            if not changes:
+                continue
+            if self.state == 'insync' and all(change.selector.document == document.filename for change in changes) and document.apply_changes(changes):
+                patched = True
+            else:
+                documents.add(document.name)
+        if patched:
+            self.state = 'updating'
+            if not self.journal or type(self.journal[0]) is not NormalizeOperation:
+                self.journal.insert(0, NormalizeOperation())
+            self.command_channel.send(Command('update'))
+        if documents:
+            self.command_channel.send(Command('fetch', documents=documents))
+
     def _CH_fetch(self, command):
         if self.state not in ('insync', 'fetching'):
             if self.not_executed_fetch is not None:
@@ -1052,16 +1227,17 @@ class XCAPManager(object):
             operation.applied = True
             api.sleep(0) # Operations are quite CPU intensive
         try:
-            for document in (doc for doc in self.documents if doc.dirty and doc.supported):
-                document.update()
+            documents = self._update_documents()
         except FetchRequiredError:
             for document in (doc for doc in self.documents if doc.dirty and doc.supported):
                 document.reset()
             for operation in journal:
                 operation.applied = False
+            self._save_updates()
             self.state = 'fetching'
             self.command_channel.send(Command('fetch', documents=set(self.document_names))) # Try to fetch them all just in case
         except XCAPError:
+            self._save_updates()
             self.timer = self._schedule_command(60, Command('update'))
         else:
             del self.journal[:len(journal)]
@@ -1070,11 +1246,15 @@ class XCAPManager(object):
                 if any(max(doc.update_time, doc.fetch_time) > self.last_update_time for doc in self.documents):
                     self._load_data()
                 self.last_update_time = datetime.utcnow()
+                if self.commit_time is not None:
+                    data = NotificationData(duration=time()-self.commit_time, documents=dict((document.name, document.update_duration) for document in documents))
+                    self.commit_time = None
+                    NotificationCenter().post_notification('XCAPManagerDidCommitOperations', sender=self, data=data)
             command.signal()
             if self.not_executed_fetch is not None:
                 self.command_channel.send(self.not_executed_fetch)
                 self.not_executed_fetch = None
-            self._save_journal()
+            self._save_updates(journal=True)
 
     # Operation handlers
     #
@@ -1703,14 +1883,14 @@ class XCAPManager(object):
 
     def _NH_XCAPSubscriptionGotNotify(self, notification):
         if notification.data.content_type == xcapdiff.XCAPDiffDocument.content_type:
-            try:
-                xcap_diff = xcapdiff.XCAPDiffDocument.parse(notification.data.body)
-            except ParserError:
-                self.command_channel.send(Command('fetch', documents=set(self.document_names)))
-            else:
-                applications = set(child.selector.auid for child in xcap_diff if isinstance(child, xcapdiff.Document))
-                documents = set(document.name for document in self.documents if document.application in applications)
-                self.command_channel.send(Command('fetch', documents=documents))
+            PayloadDecoder().decode(notification.sender, 'XCAPSubscription', notification.data.content_type, notification.data.body)
+
+    def _NH_XCAPSubscriptionDidDecode(self, notification):
+        xcap_diff = notification.data.payload
+        self.command_channel.send(Command('patch', changes=[child for child in xcap_diff if isinstance(child, xcapdiff.Document)]))
+
+    def _NH_XCAPSubscriptionDidFailToDecode(self, notification):
+        self.command_channel.send(Command('fetch', documents=set(self.document_names)))
 
     def _load_data(self):
         addressbook = Addressbook.from_payload(self.resource_lists.content['sipsimple_addressbook'])
@@ -1738,8 +1918,18 @@ class XCAPManager(object):
         data=NotificationData(addressbook=addressbook, presence_rules=presence_rules, dialog_rules=dialog_rules, status_icon=status_icon, offline_status=offline_status)
         NotificationCenter().post_notification('XCAPManagerDidReloadData', sender=self, data=data)
 
+    def _document_request(self, document, request):
+        # at most max_concurrent_requests documents are fetched or updated at the same time
+        self.request_slots.wait()
+        start_time = time()
+        try:
+            getattr(document, request)()
+        finally:
+            setattr(document, request + '_duration', time() - start_time)
+            self.request_slots.send(None)
+
     def _fetch_documents(self, documents):
-        workers = [Worker.spawn(document.fetch) for document in (doc for doc in self.documents if doc.name in documents and doc.supported)]
+        workers = [Worker.spawn(self._document_request, document, 'fetch') for document in (doc for doc in self.documents if doc.name in documents and doc.supported)]
         try:
             while workers:
                 worker = workers.pop()
@@ -1748,9 +1938,61 @@ class XCAPManager(object):
             for worker in workers:
                 worker.wait_ex()
 
+    def _update_documents(self):
+        documents = [doc for doc in self.documents if doc.dirty and doc.supported]
+        # rls-services and pres-rules reference the resource-lists document, so it is updated before the others
+        if self.resource_lists in documents:
+            self._document_request(self.resource_lists, 'update')
+        workers = [Worker.spawn(self._document_request, document, 'update') for document in documents if document is not self.resource_lists]
+        errors = [error for error in (worker.wait_ex() for worker in workers) if isinstance(error, Exception)]
+        if errors:
+            # a document that was modified externally needs to be fetched, which takes precedence over other errors
+            raise next((error for error in errors if isinstance(error, FetchRequiredError)), errors[0])
+        return documents
+
+    # The journal is stored as a log of length prefixed pickled operations. New operations are appended
+    # to the log, which is rewritten with the remaining operations after the journal is applied.
+
+    def _load_journal(self):
+        data = self.storage.load('journal')
+        journal = []
+        position = 0
+        while position + 4 <= len(data):
+            length, = struct.unpack_from('!I', data, position)
+            if position + 4 + length > len(data):
+                break # the last operation was not completely written
+            journal.append(cPickle.loads(data[position+4:position+4+length]))
+            position += 4 + length
+        if position == 0 and data.startswith('(l'):
+            # the journal was saved as a single pickled list by an older version
+            journal = cPickle.loads(data)
+        return journal
+
+    def _encode_journal(self, operations):
+        return ''.join(struct.pack('!I', len(data)) + data for data in (cPickle.dumps(operation, cPickle.HIGHEST_PROTOCOL) for operation in operations))
+
+    def _append_journal(self, operations):
+        try:
+            self.storage.append('journal', self._encode_journal(operations))
+        except XCAPStorageError:
+            pass
+
     def _save_journal(self):
+        self.unsaved_operations = []
+        try:
+            self.storage.save('journal', self._encode_journal(self.journal))
+        except XCAPStorageError:
+            pass
+
+    def _save_updates(self, journal=False):
+        # The updated documents are cached in the same storage transaction in which the journal without the
+        # applied operations is saved, so the stored journal and documents always match.
         try:
-            self.storage.save('journal', cPickle.dumps(self.journal))
+            with self.storage.transaction():
+                for document in self.documents:
+                    document.save_update()
+                if journal:
+                    self._save_journal()
         except XCAPStorageError:
             pass
 
@@ -28,10 +28,23 @@ class IXCAPStorage(Interface):
         employed by the backend implementation.
         """
 
+    def append(name, data):
+        """
+        Append the data to the data already associated with name, creating
+        it if it does not exist, by using whatever means employed by the
+        backend implementation.
+        """
+
     def delete(name):
         """Delete the data associated with name."""
 
     def purge():
         """Delete all the data stored by the backend."""
 
+    def transaction():
+        """
+        Return a context manager in which the changes made to the data are
+        stored together, if the backend implementation supports it.
+        """
+
 
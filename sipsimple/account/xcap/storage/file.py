@@ -10,6 +10,7 @@ import os
 import platform
 import random
 
+from application.python import Null
 from application.system import makedirs, unlink
 from zope.interface import implements
 
@@ -56,6 +57,19 @@ class FileStorage(object):
         else:
             self.names.add(name)
 
+    def append(self, name, data):
+        """Append the data at the end of the file identified by name."""
+        filename = os.path.join(self.directory, self.account_id, name)
+        try:
+            makedirs(os.path.join(self.directory, self.account_id))
+            file = os.fdopen(os.open(filename, os.O_WRONLY|os.O_CREAT|os.O_APPEND, 0600), 'ab')
+            file.write(data)
+            file.close()
+        except (IOError, OSError), e:
+            raise XCAPStorageError("failed to save XCAP data for %s/%s: %s" % (self.account_id, name, str(e)))
+        else:
+            self.names.add(name)
+
     def delete(self, name):
         """Delete the data stored in the file identified by name"""
         try:
@@ -86,4 +100,8 @@ class FileStorage(object):
         if failed:
             raise XCAPStorageError("the following files could not be deleted for %s: %s" % (self.account_id, ', '.join(failed)))
 
+    def transaction(self):
+        """Return a context for changes that are stored together, each file is still written on its own"""
+        return Null
+
 
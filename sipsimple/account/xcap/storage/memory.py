@@ -5,6 +5,7 @@
 
 __all__ = ["MemoryStorage"]
 
+from application.python import Null
 from zope.interface import implements
 from sipsimple.account.xcap.storage import IXCAPStorage, XCAPStorageError
 
@@ -30,6 +31,10 @@ class MemoryStorage(object):
         """Store the data under a key given by name"""
         self.data[name] = data
 
+    def append(self, name, data):
+        """Append the data to the data stored under the key given by name"""
+        self.data[name] = self.data.get(name, '') + data
+
     def delete(self, name):
         """Delete the data identified by name"""
         self.data.pop(name, None)
@@ -38,4 +43,8 @@ class MemoryStorage(object):
         """Delete all the data that is stored in the backend"""
         self.data.clear()
 
+    def transaction(self):
+        """Return a context for changes that are stored together, the changes are always stored immediately"""
+        return Null
+
 
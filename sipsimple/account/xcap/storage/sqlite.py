@@ -0,0 +1,197 @@
+# Copyright (C) 2013 AG Projects. See LICENSE for details.
+#
+
+"""XCAP backend for storing data in a SQLite database"""
+
+__all__ = ["SQLiteDatabase", "SQLiteTransaction", "SQLiteStorage"]
+
+import os
+import re
+import sqlite3
+
+from threading import RLock
+
+from application.system import makedirs
+from zope.interface import implements
+
+from sipsimple.account.xcap.storage import IXCAPStorage, XCAPStorageError
+
+
+class SQLiteDatabase(object):
+    """
+    A SQLite database that holds the XCAP data of all the accounts in a
+    single file. The data associated with a name is kept as a sequence of
+    chunks, so that appending to it does not rewrite what is already stored.
+    The database uses write-ahead logging, so every change is committed
+    without waiting for the data to be synced to disk. Changes that need to
+    be stored together are made in a transaction. Once the data stored by
+    the file backend was imported, a marker is kept in the database, so an
+    import that failed is attempted again.
+    """
+
+    def __init__(self, filename):
+        """Open the database in the given file, creating it if it does not exist"""
+        self.filename = filename
+        self.lock = RLock()
+        self.transaction_level = 0
+        self.transaction_failed = False
+        try:
+            makedirs(os.path.dirname(filename))
+            self.connection = sqlite3.connect(filename, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            with self.connection:
+                self.connection.execute('CREATE TABLE IF NOT EXISTS xcap (id INTEGER PRIMARY KEY, account TEXT NOT NULL, name TEXT NOT NULL, data BLOB NOT NULL)')
+                self.connection.execute('CREATE INDEX IF NOT EXISTS xcap_name ON xcap (account, name)')
+                self.connection.execute('CREATE TABLE IF NOT EXISTS xcap_migration (name TEXT PRIMARY KEY)')
+            self.imported = self.connection.execute('SELECT 1 FROM xcap_migration WHERE name=?', ('file',)).fetchone() is not None
+        except (OSError, sqlite3.Error), e:
+            raise XCAPStorageError("failed to open XCAP database %s: %s" % (filename, str(e)))
+
+    def load(self, account_id, name):
+        with self.lock:
+            try:
+                chunks = self.connection.execute('SELECT data FROM xcap WHERE account=? AND name=? ORDER BY id', (account_id, name)).fetchall()
+            except sqlite3.Error, e:
+                raise XCAPStorageError("failed to load XCAP data for %s/%s: %s" % (account_id, name, str(e)))
+        if not chunks:
+            raise XCAPStorageError("missing entry: %s/%s" % (account_id, name))
+        return ''.join(str(chunk) for chunk, in chunks)
+
+    def save(self, account_id, name, data):
+        with self.transaction():
+            try:
+                self.connection.execute('DELETE FROM xcap WHERE account=? AND name=?', (account_id, name))
+                self.connection.execute('INSERT INTO xcap (account, name, data) VALUES (?, ?, ?)', (account_id, name, sqlite3.Binary(data)))
+            except sqlite3.Error, e:
+                raise XCAPStorageError("failed to save XCAP data for %s/%s: %s" % (account_id, name, str(e)))
+
+    def append(self, account_id, name, data):
+        with self.transaction():
+            try:
+                self.connection.execute('INSERT INTO xcap (account, name, data) VALUES (?, ?, ?)', (account_id, name, sqlite3.Binary(data)))
+            except sqlite3.Error, e:
+                raise XCAPStorageError("failed to save XCAP data for %s/%s: %s" % (account_id, name, str(e)))
+
+    def delete(self, account_id, name):
+        with self.transaction():
+            try:
+                self.connection.execute('DELETE FROM xcap WHERE account=? AND name=?', (account_id, name))
+            except sqlite3.Error, e:
+                raise XCAPStorageError("failed to delete XCAP data for %s/%s: %s" % (account_id, name, str(e)))
+
+    def purge(self, account_id):
+        with self.transaction():
+            try:
+                self.connection.execute('DELETE FROM xcap WHERE account=?', (account_id,))
+            except sqlite3.Error, e:
+                raise XCAPStorageError("failed to delete XCAP data for %s: %s" % (account_id, str(e)))
+
+    def transaction(self):
+        """Return a new transaction on the database, to be used as a context manager"""
+        return SQLiteTransaction(self)
+
+    _temporary_file_regex = re.compile(r'\.\d+\.[0-9A-F]{8}$')
+
+    def import_directory(self, directory):
+        """
+        Copy the XCAP data stored by the file backend in the given directory
+        into the database, in a single transaction that also records that the
+        import was done. Data that is already in the database is newer than
+        the files, so it is not replaced. The files are left in place.
+        """
+        rows = []
+        try:
+            for account_id in os.listdir(directory):
+                account_directory = os.path.join(directory, account_id)
+                if not os.path.isdir(account_directory):
+                    continue
+                for name in os.listdir(account_directory):
+                    filename = os.path.join(account_directory, name)
+                    if os.path.isfile(filename) and not self._temporary_file_regex.search(name):
+                        rows.append((account_id, name, sqlite3.Binary(open(filename, 'rb').read())))
+        except (IOError, OSError), e:
+            raise XCAPStorageError("failed to import XCAP data from %s: %s" % (directory, str(e)))
+        with self.lock:
+            try:
+                with self.connection:
+                    self.connection.executemany('INSERT INTO xcap (account, name, data) SELECT ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM xcap WHERE account=? AND name=?)', ((account_id, name, data, account_id, name) for account_id, name, data in rows))
+                    self.connection.execute('INSERT OR IGNORE INTO xcap_migration (name) VALUES (?)', ('file',))
+            except sqlite3.Error, e:
+                raise XCAPStorageError("failed to import XCAP data from %s: %s" % (directory, str(e)))
+        self.imported = True
+
+
+class SQLiteTransaction(object):
+    """
+    A context in which the changes made to a SQLiteDatabase are committed
+    together, when the outermost transaction is left. If any of the changes
+    fails, they are all discarded and leaving the outermost transaction
+    raises XCAPStorageError, unless it is left because of another error.
+    The database is locked for the other threads while a transaction is open.
+    """
+
+    def __init__(self, database):
+        self.database = database
+
+    def __enter__(self):
+        self.database.lock.acquire()
+        self.database.transaction_level += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        database = self.database
+        try:
+            database.transaction_level -= 1
+            if exc_type is not None:
+                database.transaction_failed = True
+            if database.transaction_level == 0:
+                failed, database.transaction_failed = database.transaction_failed, False
+                try:
+                    if failed:
+                        database.connection.rollback()
+                    else:
+                        database.connection.commit()
+                except sqlite3.Error, e:
+                    database.connection.rollback()
+                    raise XCAPStorageError("failed to save XCAP data: %s" % str(e))
+                if failed and exc_type is None:
+                    raise XCAPStorageError("failed to save XCAP data: the transaction was rolled back")
+        finally:
+            database.lock.release()
+
+
+class SQLiteStorage(object):
+    """Implementation of an XCAP backend that stores data in a SQLite database."""
+
+    implements(IXCAPStorage)
+
+    def __init__(self, database, account_id):
+        """Initialize the storage for the specified database and account ID"""
+        self.database = database
+        self.account_id = account_id
+
+    def load(self, name):
+        """Return the data stored under name."""
+        return self.database.load(self.account_id, name)
+
+    def save(self, name, data):
+        """Replace the data stored under name."""
+        self.database.save(self.account_id, name, data)
+
+    def append(self, name, data):
+        """Append the data to the data stored under name."""
+        self.database.append(self.account_id, name, data)
+
+    def delete(self, name):
+        """Delete the data stored under name."""
+        self.database.delete(self.account_id, name)
+
+    def purge(self):
+        """Delete all the data stored for the account."""
+        self.database.purge(self.account_id)
+
+    def transaction(self):
+        """Return a context in which the changes are committed together."""
+        return self.database.transaction()
+
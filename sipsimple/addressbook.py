@@ -7,6 +7,9 @@ from __future__ import absolute_import
 
 __all__ = ['AddressbookManager', 'Contact', 'ContactURI', 'Group', 'Policy', 'SharedSetting', 'ContactExtension', 'ContactURIExtension', 'GroupExtension', 'PolicyExtension']
 
+import csv
+import re
+
 from functools import reduce
 from operator import attrgetter
 from random import randint
@@ -20,13 +23,14 @@ from application.python import Null
 from application.python.decorator import execute_once
 from application.python.types import Singleton, MarkerType
 from application.python.weakref import weakobjectmap
+from lxml import etree
 
 from sipsimple.account import xcap, AccountManager
 from sipsimple.configuration import ConfigurationManager, ObjectNotFoundError, DuplicateIDError, PersistentKey, ModifiedValue, ModifiedList
 from sipsimple.configuration import AbstractSetting, RuntimeSetting, SettingsObjectImmutableID, SettingsGroup, SettingsGroupMeta, SettingsState, ItemCollection, ItemManagement
 from sipsimple.payloads.addressbook import PolicyValue, ElementAttributes
 from sipsimple.payloads.datatypes import ID
-from sipsimple.payloads.resourcelists import ResourceListsDocument
+from sipsimple.payloads.resourcelists import ResourceListsDocument, namespace as resourcelists_namespace
 from sipsimple.threading import run_in_thread
 
 
@@ -38,6 +42,43 @@ def recursive_getattr(obj, name):
     return reduce(getattr, name.split('.'), obj)
 
 
+_telephone_number_re = re.compile(r'^\+?[0-9()\-. ]+$')
+_visual_separators_re = re.compile(r'[()\-. ]')
+
+def normalize_uri(uri):
+    """
+    Return the form of a URI under which contacts are indexed. The sip and
+    sips schemes are equivalent, the parameters and headers are dropped, the
+    host is lowercased and the port is kept. Telephone numbers, whether they
+    are given as tel URIs, as SIP URIs with user=phone or without a scheme,
+    are mapped to a tel URI without visual separators. The URI can be a
+    string or an object with user, host, port and parameters attributes,
+    like a SIPURI.
+    """
+    if not isinstance(uri, basestring):
+        address = u'%s@%s' % (uri.user, uri.host) if uri.user else unicode(uri.host)
+        if getattr(uri, 'port', None):
+            address += u':%d' % uri.port
+        if getattr(uri, 'parameters', {}).get('user') == 'phone':
+            address += u';user=phone'
+        uri = address
+    uri = uri.strip()
+    scheme, separator, address = uri.partition(':')
+    scheme = scheme.lower()
+    if not separator or scheme not in ('sip', 'sips', 'tel'):
+        address = uri
+        scheme = 'tel' if _telephone_number_re.match(uri) else 'sip'
+    if scheme == 'tel':
+        return u'tel:' + _visual_separators_re.sub(u'', address.partition(';')[0]).lower()
+    address = address.partition('?')[0]
+    user, at, host = address.rpartition('@')
+    host, separator, parameters = host.partition(';')
+    user = user.partition(';')[0]
+    if user and 'user=phone' in parameters.lower().split(';'):
+        return u'tel:' + _visual_separators_re.sub(u'', user).lower()
+    return u'sip:%s%s%s' % (user, at, host.lower())
+
+
 class Local(object):
     __metaclass__ = MarkerType
 
@@ -207,6 +248,57 @@ class MultiAccountTransaction(object):
     def __iter__(self):
         return iter(self.accounts)
 
+    def flush(self):
+        """Commit the changes made so far and keep the transaction open"""
+        for account in self.accounts:
+            account.xcap_manager.commit_transaction()
+            account.xcap_manager.start_transaction()
+
+
+class ConfigurationBatch(object):
+    """
+    Collects the configuration saves done by the addressbook objects while
+    the batch is open and flushes them with a single save when the outermost
+    batch is closed. It must only be used from the file-io thread.
+    """
+
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        self.depth = 0
+        self.pending = []
+
+    def __enter__(self):
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth -= 1
+        if self.depth == 0:
+            self.flush()
+
+    def flush(self):
+        """Save the changes collected so far and keep the batch open"""
+        if self.pending:
+            pending, self.pending = self.pending, []
+            self._save(pending)
+
+    def save(self, obj, operation, **kw):
+        if self.depth > 0:
+            self.pending.append((obj, operation, kw))
+        else:
+            self._save([(obj, operation, kw)])
+
+    def _save(self, operations):
+        configuration = ConfigurationManager()
+        try:
+            configuration.save()
+        except Exception, e:
+            log.err()
+            notification_center = NotificationCenter()
+            for obj, operation, kw in operations:
+                notification_center.post_notification('CFGManagerSaveFailed', sender=configuration, data=NotificationData(object=obj, operation=operation, exception=e, **kw))
+
 
 class XCAPGroup(xcap.Group):
     """An XCAP Group with attributes normalized to unicode"""
@@ -218,6 +310,12 @@ class XCAPGroup(xcap.Group):
         contacts = [XCAPContact.normalize(contact) for contact in contacts]
         super(XCAPGroup, self).__init__(id, name, contacts, **normalized_attributes)
 
+    def __eq__(self, other):
+        # the members of a group are not ordered, so they are compared regardless of the order in which the server returned them
+        if isinstance(other, xcap.Group):
+            return self is other or (self.id == other.id and self.name == other.name and set(self.contacts.iterids()) == set(other.contacts.iterids()) and self.attributes == other.attributes)
+        return NotImplemented
+
     @classmethod
     def normalize(cls, group):
         return cls(group.id, group.name, group.contacts, **group.attributes)
@@ -527,11 +625,7 @@ class Group(SettingsState):
             notification_center.post_notification('AddressbookGroupDidChange', sender=self, data=NotificationData(modified=modified_settings))
             modified_data = modified_settings
 
-        try:
-            configuration.save()
-        except Exception, e:
-            log.err()
-            notification_center.post_notification('CFGManagerSaveFailed', sender=configuration, data=NotificationData(object=self, operation='save', modified=modified_data, exception=e))
+        ConfigurationBatch().save(self, 'save', modified=modified_data)
 
     @run_in_thread('file-io')
     def _internal_delete(self, originator):
@@ -555,11 +649,7 @@ class Group(SettingsState):
 
         notification_center.post_notification('AddressbookGroupWasDeleted', sender=self)
 
-        try:
-            configuration.save()
-        except Exception, e:
-            log.err()
-            notification_center.post_notification('CFGManagerSaveFailed', sender=configuration, data=NotificationData(object=self, operation='delete', exception=e))
+        ConfigurationBatch().save(self, 'delete')
 
     def save(self):
         """
@@ -839,11 +929,7 @@ class Contact(SettingsState):
             notification_center.post_notification('AddressbookContactDidChange', sender=self, data=NotificationData(modified=modified_settings))
             modified_data = modified_settings
 
-        try:
-            configuration.save()
-        except Exception, e:
-            log.err()
-            notification_center.post_notification('CFGManagerSaveFailed', sender=configuration, data=NotificationData(object=self, operation='save', modified=modified_data, exception=e))
+        ConfigurationBatch().save(self, 'save', modified=modified_data)
 
     @run_in_thread('file-io')
     def _internal_delete(self, originator):
@@ -873,11 +959,7 @@ class Contact(SettingsState):
 
         notification_center.post_notification('AddressbookContactWasDeleted', sender=self)
 
-        try:
-            configuration.save()
-        except Exception, e:
-            log.err()
-            notification_center.post_notification('CFGManagerSaveFailed', sender=configuration, data=NotificationData(object=self, operation='delete', exception=e))
+        ConfigurationBatch().save(self, 'delete')
 
     def save(self):
         """
@@ -1028,11 +1110,7 @@ class Policy(SettingsState):
             notification_center.post_notification('AddressbookPolicyDidChange', sender=self, data=NotificationData(modified=modified_settings))
             modified_data = modified_settings
 
-        try:
-            configuration.save()
-        except Exception, e:
-            log.err()
-            notification_center.post_notification('CFGManagerSaveFailed', sender=configuration, data=NotificationData(object=self, operation='save', modified=modified_data, exception=e))
+        ConfigurationBatch().save(self, 'save', modified=modified_data)
 
     @run_in_thread('file-io')
     def _internal_delete(self, originator):
@@ -1056,11 +1134,7 @@ class Policy(SettingsState):
 
         notification_center.post_notification('AddressbookPolicyWasDeleted', sender=self)
 
-        try:
-            configuration.save()
-        except Exception, e:
-            log.err()
-            notification_center.post_notification('CFGManagerSaveFailed', sender=configuration, data=NotificationData(object=self, operation='delete', exception=e))
+        ConfigurationBatch().save(self, 'delete')
 
     def save(self):
         """
@@ -1109,6 +1183,105 @@ class PolicyExtension(object):
         raise TypeError("PolicyExtension subclasses cannot be instantiated")
 
 
+# The readers used to import contacts parse their input incrementally and yield a (name, uris) tuple for every
+# contact, where uris is a list of (uri, type) tuples, so that the whole input is never held in memory.
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, str) else value
+
+
+def read_csv_contacts(file):
+    """
+    Read contacts from a CSV file with a header line. The column named name
+    holds the name of the contact and every other column holds a URI, with
+    the column name as the URI type.
+    """
+    reader = csv.reader(file)
+    header = [_decode(column).strip() for column in next(reader, [])]
+    for row in reader:
+        name = u''
+        uris = []
+        for column, value in zip(header, (_decode(value).strip() for value in row)):
+            if not value:
+                continue
+            if column.lower() == 'name':
+                name = value
+            else:
+                uris.append((value, column or None))
+        if uris:
+            yield name, uris
+
+
+_vcard_escape_re = re.compile(r'\\(.)')
+_vcard_uri_types = {'CELL': u'Mobile', 'WORK': u'Work', 'HOME': u'Home'}
+
+def _vcard_lines(file):
+    line = None
+    for data in file:
+        data = _decode(data).rstrip(u'\r\n')
+        if data[:1] in (u' ', u'\t') and line is not None:
+            line += data[1:]
+        else:
+            if line is not None:
+                yield line
+            line = data
+    if line is not None:
+        yield line
+
+def read_vcard_contacts(file):
+    """
+    Read contacts from a file with vCards. The FN (or else the N) property
+    gives the name of the contact and its URIs are taken from the TEL
+    properties and from the IMPP and X-SIP properties that contain SIP URIs.
+    """
+    name = uris = None
+    for line in _vcard_lines(file):
+        property, separator, value = line.partition(u':')
+        if not separator:
+            continue
+        parameters = property.upper().split(u';')
+        property = parameters.pop(0).rpartition(u'.')[2]
+        value = _vcard_escape_re.sub(lambda match: u'\n' if match.group(1) in u'nN' else match.group(1), value).strip()
+        if property == u'BEGIN' and value.upper() == u'VCARD':
+            name, uris = u'', []
+        elif uris is None:
+            continue
+        elif property == u'END':
+            if uris:
+                yield name, uris
+            name = uris = None
+        elif property == u'FN':
+            name = value
+        elif property == u'N' and not name:
+            family, given = (value.split(u';') + [u''])[:2]
+            name = u' '.join(part for part in (given, family) if part)
+        elif property == u'TEL' or (property in (u'IMPP', u'X-SIP') and value.lower().startswith((u'sip:', u'sips:'))):
+            types = [type for parameter in parameters if parameter.startswith(u'TYPE=') for type in parameter[5:].split(u',')]
+            if property == u'TEL':
+                uri_type = next((_vcard_uri_types[type] for type in types if type in _vcard_uri_types), u'Phone')
+            else:
+                uri_type = u'SIP'
+            uris.append((value, uri_type))
+
+
+def read_resourcelists_contacts(file):
+    """
+    Read contacts from a resource-lists document. Every entry is a contact,
+    named after its display name.
+    """
+    entry_tag = '{%s}entry' % resourcelists_namespace
+    display_name_tag = '{%s}display-name' % resourcelists_namespace
+    for event, element in etree.iterparse(file, events=('end',), tag=entry_tag):
+        uri = element.get('uri')
+        name = element.findtext(display_name_tag) or u''
+        # drop the entries that were already read, to keep memory usage independent of the size of the document
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+        if uri:
+            yield _decode(name), [(_decode(uri), u'SIP')]
+
+
 class AddressbookManager(object):
     __metaclass__ = Singleton
 
@@ -1119,11 +1292,18 @@ class AddressbookManager(object):
         self.groups = {}
         self.policies = {}
         self.__xcapaddressbook__ = None
+        self.__uri_map = {}
+        self.__contact_uris = {}
+        self.__contact_groups = {}
+        self.__group_contacts = {}
+        self.__index_lock = Lock()
         notification_center = NotificationCenter()
         notification_center.add_observer(self, name='AddressbookContactWasActivated')
         notification_center.add_observer(self, name='AddressbookContactWasDeleted')
+        notification_center.add_observer(self, name='AddressbookContactDidChange')
         notification_center.add_observer(self, name='AddressbookGroupWasActivated')
         notification_center.add_observer(self, name='AddressbookGroupWasDeleted')
+        notification_center.add_observer(self, name='AddressbookGroupDidChange')
         notification_center.add_observer(self, name='AddressbookPolicyWasActivated')
         notification_center.add_observer(self, name='AddressbookPolicyWasDeleted')
         notification_center.add_observer(self, name='SIPAccountDidDiscoverXCAPSupport')
@@ -1162,6 +1342,15 @@ class AddressbookManager(object):
     def get_contacts(self):
         return self.contacts.values()
 
+    def find_contacts(self, uri):
+        """
+        Return the contacts that have the specified URI. The URI is compared
+        with the URIs of the contacts after being normalized by normalize_uri.
+        """
+        key = normalize_uri(uri)
+        with self.__index_lock:
+            return [self.contacts[id] for id in self.__uri_map.get(key, ())]
+
     def has_group(self, id):
         return id in self.groups
 
@@ -1171,6 +1360,13 @@ class AddressbookManager(object):
     def get_groups(self):
         return self.groups.values()
 
+    def find_groups(self, uri):
+        """Return the groups that contain a contact with the specified URI"""
+        key = normalize_uri(uri)
+        with self.__index_lock:
+            group_ids = set(group_id for contact_id in self.__uri_map.get(key, ()) for group_id in self.__contact_groups.get(contact_id, ()))
+            return [self.groups[id] for id in group_ids]
+
     def has_policy(self, id):
         return id in self.policies
 
@@ -1186,30 +1382,152 @@ class AddressbookManager(object):
         xcap_accounts = [account for account in account_manager.get_accounts() if hasattr(account, 'xcap') and account.xcap.discovered]
         return MultiAccountTransaction(xcap_accounts)
 
+    contact_readers = {'csv': read_csv_contacts, 'vcard': read_vcard_contacts, 'resource-lists': read_resourcelists_contacts}
+
+    @run_in_thread('file-io')
+    def import_contacts(self, file, format, group=None, chunk_size=500):
+        """
+        Create contacts from the ones in the file, which is read incrementally
+        in the given format (csv, vcard or resource-lists). The contacts are
+        added to the specified group, if any. The contacts that have a URI
+        which is already known are skipped. The contacts are saved in chunks
+        of chunk_size, with one configuration save and one XCAP commit for
+        every chunk.
+
+        An AddressbookManagerImportDidProgress notification is posted after
+        every saved chunk, followed by the AddressbookManagerDidImportContacts
+        notification when the import is done, or the
+        AddressbookManagerDidFailToImportContacts notification if the file
+        cannot be read. In the latter case the contacts of the chunks that
+        were already saved are kept and counted in the notification, while the
+        ones read since are dropped.
+        """
+        notification_center = NotificationCenter()
+        reader = self.contact_readers[format]
+        imported = 0
+        skipped = 0
+        with self.transaction() as transaction, ConfigurationBatch() as batch:
+            chunk = []
+            chunk_uris = set()
+            try:
+                for name, uris in reader(file):
+                    keys = set(normalize_uri(uri) for uri, type in uris)
+                    if not keys.isdisjoint(chunk_uris) or any(self.find_contacts(key) for key in keys):
+                        skipped += 1
+                        continue
+                    contact = Contact()
+                    contact.name = name
+                    for uri, type in uris:
+                        contact.uris.add(ContactURI(uri=uri, type=type))
+                    contact.uris.default = next(iter(contact.uris))
+                    chunk.append(contact)
+                    chunk_uris.update(keys)
+                    if len(chunk) == chunk_size:
+                        self._save_imported_contacts(chunk, group, transaction, batch)
+                        imported += len(chunk)
+                        chunk = []
+                        chunk_uris.clear()
+                        notification_center.post_notification('AddressbookManagerImportDidProgress', sender=self, data=NotificationData(imported=imported, skipped=skipped))
+                if chunk:
+                    self._save_imported_contacts(chunk, group, transaction, batch)
+                    imported += len(chunk)
+            except (EnvironmentError, csv.Error, etree.XMLSyntaxError, UnicodeDecodeError), e:
+                notification_center.post_notification('AddressbookManagerDidFailToImportContacts', sender=self, data=NotificationData(error=str(e), imported=imported, skipped=skipped))
+            else:
+                notification_center.post_notification('AddressbookManagerDidImportContacts', sender=self, data=NotificationData(imported=imported, skipped=skipped))
+
+    def _save_imported_contacts(self, contacts, group, transaction, batch):
+        for contact in contacts:
+            contact.save()
+        if group is not None:
+            for contact in contacts:
+                group.contacts.add(contact)
+            group.save()
+        batch.flush()
+        transaction.flush()
+
     def handle_notification(self, notification):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
         handler(notification)
 
+    def _index_contact(self, contact):
+        uris = set(normalize_uri(uri.uri) for uri in contact.uris if uri.uri)
+        old_uris = self.__contact_uris.get(contact.id, set())
+        for key in old_uris - uris:
+            contact_ids = self.__uri_map[key]
+            contact_ids.discard(contact.id)
+            if not contact_ids:
+                del self.__uri_map[key]
+        for key in uris - old_uris:
+            self.__uri_map.setdefault(key, set()).add(contact.id)
+        self.__contact_uris[contact.id] = uris
+
+    def _unindex_contact(self, contact):
+        for key in self.__contact_uris.pop(contact.id, ()):
+            contact_ids = self.__uri_map[key]
+            contact_ids.discard(contact.id)
+            if not contact_ids:
+                del self.__uri_map[key]
+
+    def _index_group(self, group):
+        contact_ids = set(group.contacts.ids())
+        old_contact_ids = self.__group_contacts.get(group.id, set())
+        for contact_id in old_contact_ids - contact_ids:
+            group_ids = self.__contact_groups[contact_id]
+            group_ids.discard(group.id)
+            if not group_ids:
+                del self.__contact_groups[contact_id]
+        for contact_id in contact_ids - old_contact_ids:
+            self.__contact_groups.setdefault(contact_id, set()).add(group.id)
+        self.__group_contacts[group.id] = contact_ids
+
+    def _unindex_group(self, group):
+        for contact_id in self.__group_contacts.pop(group.id, ()):
+            group_ids = self.__contact_groups[contact_id]
+            group_ids.discard(group.id)
+            if not group_ids:
+                del self.__contact_groups[contact_id]
+
     def _NH_AddressbookContactWasActivated(self, notification):
         contact = notification.sender
-        self.contacts[contact.id] = contact
+        with self.__index_lock:
+            self.contacts[contact.id] = contact
+            self._index_contact(contact)
         notification.center.post_notification('AddressbookManagerDidAddContact', sender=self, data=NotificationData(contact=contact))
 
     def _NH_AddressbookContactWasDeleted(self, notification):
         contact = notification.sender
-        del self.contacts[contact.id]
+        with self.__index_lock:
+            del self.contacts[contact.id]
+            self._unindex_contact(contact)
         notification.center.post_notification('AddressbookManagerDidRemoveContact', sender=self, data=NotificationData(contact=contact))
 
+    def _NH_AddressbookContactDidChange(self, notification):
+        contact = notification.sender
+        with self.__index_lock:
+            if contact.id in self.contacts:
+                self._index_contact(contact)
+
     def _NH_AddressbookGroupWasActivated(self, notification):
         group = notification.sender
-        self.groups[group.id] = group
+        with self.__index_lock:
+            self.groups[group.id] = group
+            self._index_group(group)
         notification.center.post_notification('AddressbookManagerDidAddGroup', sender=self, data=NotificationData(group=group))
 
     def _NH_AddressbookGroupWasDeleted(self, notification):
         group = notification.sender
-        del self.groups[group.id]
+        with self.__index_lock:
+            del self.groups[group.id]
+            self._unindex_group(group)
         notification.center.post_notification('AddressbookManagerDidRemoveGroup', sender=self, data=NotificationData(group=group))
 
+    def _NH_AddressbookGroupDidChange(self, notification):
+        group = notification.sender
+        with self.__index_lock:
+            if group.id in self.groups:
+                self._index_group(group)
+
     def _NH_AddressbookPolicyWasActivated(self, notification):
         policy = notification.sender
         self.policies[policy.id] = policy
@@ -1254,14 +1572,19 @@ class AddressbookManager(object):
                 self.__migrate_contacts(old_data)
                 return
 
-        with MultiAccountTransaction(xcap_accounts):
+        # only the objects whose last known XCAP representation differs from the one that was just loaded are reconciled and all
+        # the resulting configuration changes are written with a single save, as only a few objects change between 2 reloads
+        with MultiAccountTransaction(xcap_accounts), ConfigurationBatch():
             # because groups depend on contacts, operation order is add/update contacts, add/update/remove groups & policies, remove contacts -Dan
 
             for xcap_contact in xcap_contacts:
+                contact = self.contacts.get(xcap_contact.id)
+                if contact is not None and contact.__xcapcontact__ == xcap_contact:
+                    continue
                 xcap_contact = XCAPContact.normalize(xcap_contact)
-                try:
-                    contact = self.contacts[xcap_contact.id]
-                except KeyError:
+                if contact is not None and contact.__xcapcontact__ == xcap_contact:
+                    continue
+                if contact is None:
                     try:
                         contact = Contact(xcap_contact.id)
                     except DuplicateIDError:
@@ -1295,10 +1618,13 @@ class AddressbookManager(object):
                 contact._internal_save(originator=Remote(xcap_manager.account, xcap_contact))
 
             for xcap_group in xcap_groups:
+                group = self.groups.get(xcap_group.id)
+                if group is not None and group.__xcapgroup__ == xcap_group:
+                    continue
                 xcap_group = XCAPGroup.normalize(xcap_group)
-                try:
-                    group = self.groups[xcap_group.id]
-                except KeyError:
+                if group is not None and group.__xcapgroup__ == xcap_group:
+                    continue
+                if group is None:
                     try:
                         group = Group(xcap_group.id)
                     except DuplicateIDError:
@@ -1316,10 +1642,13 @@ class AddressbookManager(object):
                 group._internal_save(originator=Remote(xcap_manager.account, xcap_group))
 
             for xcap_policy in xcap_policies:
+                policy = self.policies.get(xcap_policy.id)
+                if policy is not None and policy.__xcappolicy__ == xcap_policy:
+                    continue
                 xcap_policy = XCAPPolicy.normalize(xcap_policy)
-                try:
-                    policy = self.policies[xcap_policy.id]
-                except KeyError:
+                if policy is not None and policy.__xcappolicy__ == xcap_policy:
+                    continue
+                if policy is None:
                     try:
                         policy = Policy(xcap_policy.id)
                     except DuplicateIDError:
@@ -12,7 +12,7 @@ from abc import ABCMeta, abstractmethod
 from itertools import chain
 from operator import attrgetter
 from threading import Lock
-from weakref import WeakSet
+from weakref import WeakSet, WeakValueDictionary
 
 from application import log
 from application.notification import NotificationCenter, NotificationData
@@ -329,6 +329,7 @@ class SettingsObjectImmutableID(object):
     def __init__(self, type):
         self.type = type
         self.values = weakobjectmap()
+        self.objects = WeakValueDictionary() # maps the IDs back to their objects, so that duplicates are found without a scan
         self.lock = Lock()
 
     def __get__(self, obj, objtype):
@@ -340,13 +341,11 @@ class SettingsObjectImmutableID(object):
                 raise AttributeError('attribute is read-only')
             if not isinstance(value, self.type):
                 value = self.type(value)
-            try:
-                other_obj = (key for key, val in self.values.iteritems() if val==value).next()
-            except StopIteration:
-                pass
-            else:
+            other_obj = self.objects.get(value)
+            if other_obj is not None:
                 raise DuplicateIDError('SettingsObject ID already used by another %s' % other_obj.__class__.__name__)
             self.values[obj] = value
+            self.objects[value] = obj
 
     def __delete__(self, obj):
         raise AttributeError('cannot delete attribute')
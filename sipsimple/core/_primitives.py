@@ -15,7 +15,29 @@ from application.notification import IObserver, NotificationCenter, Notification
 from application.python import Null
 from zope.interface import implements
 
-from sipsimple.core._core import ContactHeader, Header, Request, RouteHeader, SIPCoreError, SIPURI, ToHeader
+from sipsimple.core._core import ContactHeader, FrozenFromHeader, FrozenHeader, FrozenSIPURI, FrozenToHeader, Header, Request, RouteHeader, SIPCoreError, ToHeader
+
+
+class RegistrationTemplate(object):
+    """
+    The parts of a REGISTER request that do not change between refreshes.
+    The template keeps frozen copies of the headers it was built from, so
+    that changes made to them in place are detected.
+    """
+
+    __slots__ = ('request_uri', 'from_header', 'to_header', 'duration', 'extra_headers', 'register_headers', 'unregister_headers')
+
+    def __init__(self, from_header, duration, extra_headers):
+        self.from_header = FrozenFromHeader.new(from_header)
+        self.to_header = FrozenToHeader.new(self.from_header)
+        self.request_uri = FrozenSIPURI(self.from_header.uri.host)
+        self.duration = duration
+        self.extra_headers = tuple(header.frozen_type.new(header) for header in extra_headers)
+        self.register_headers = [FrozenHeader("Expires", str(int(duration)))] + list(self.extra_headers)
+        self.unregister_headers = [FrozenHeader("Expires", "0")] + list(self.extra_headers)
+
+    def matches(self, from_header, duration, extra_headers):
+        return self.duration == duration and self.from_header == from_header and self.extra_headers == tuple(extra_headers)
 
 
 class Registration(object):
@@ -30,6 +52,7 @@ class Registration(object):
         self._last_request = None
         self._unregistering = False
         self._lock = RLock()
+        self._template = None
 
     is_registered = property(lambda self: self._last_request is not None)
     contact_uri = property(lambda self: None if self._last_request is None else self._last_request.contact_uri)
@@ -123,10 +146,11 @@ class Registration(object):
         else:
             call_id = None
             cseq = 1
-        extra_headers = []
-        extra_headers.append(Header("Expires", str(int(self.duration) if do_register else 0)))
-        extra_headers.extend(self.extra_headers)
-        request = Request("REGISTER", SIPURI(self.from_header.uri.host), self.from_header, ToHeader.new(self.from_header), route_header,
+        if self._template is None or not self._template.matches(self.from_header, self.duration, self.extra_headers):
+            self._template = RegistrationTemplate(self.from_header, self.duration, self.extra_headers)
+        template = self._template
+        extra_headers = template.register_headers if do_register else template.unregister_headers
+        request = Request("REGISTER", template.request_uri, template.from_header, template.to_header, route_header,
                           credentials=self.credentials, contact_header=contact_header, call_id=call_id,
                           cseq=cseq, extra_headers=extra_headers)
         notification_center.add_observer(self, sender=request)
@@ -52,6 +52,7 @@ from collections import defaultdict, deque
 from copy import deepcopy
 from decimal import Decimal
 from itertools import chain, izip
+from threading import local
 from weakref import WeakValueDictionary
 
 from application.python import Null
@@ -93,14 +94,46 @@ def parse_qname(qname):
 
 ## XMLDocument
 
+class XMLParserPool(local):
+    """
+    Provides a separate XML parser for each thread, as lxml parsers cannot
+    be used by more than one thread at a time. The parsers are created when
+    a thread first needs them and they all share the same compiled schema.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.parser = etree.XMLParser(schema=schema, remove_blank_text=True)
+
+
+class XMLSchemaCache(dict):
+    """
+    Holds the compiled XML schemas and the parser pools using them, indexed
+    by the set of (namespace, schema location) pairs they were built from, so
+    that document types with the same schemas share the same compiled schema
+    """
+
+    def __missing__(self, schema_set):
+        if schema_set:
+            schema = """<?xml version="1.0"?>
+                <xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">
+                    %s
+                </xs:schema>
+            """ % '\r\n'.join('<xs:import namespace="%s" schemaLocation="%s"/>' % (namespace, schema_location) for namespace, schema_location in sorted(schema_set))
+            schema = etree.XMLSchema(etree.XML(schema))
+        else:
+            schema = None
+        return self.setdefault(schema_set, XMLParserPool(schema))
+
+schema_cache = XMLSchemaCache()
+
+
 class XMLDocumentType(type):
     def __init__(cls, name, bases, dct):
         cls.nsmap = {}
         cls.schema_map = {}
         cls.element_map = {}
         cls.root_element = None
-        cls.schema = None
-        cls.parser = None
         for base in reversed(bases):
             if hasattr(base, 'element_map'):
                 cls.element_map.update(base.element_map)
@@ -124,18 +157,20 @@ class XMLDocumentType(type):
             super(XMLDocumentType, cls).__setattr__(name, value)
 
     def _update_schema(cls):
-        if cls.schema_map:
-            location_map = {ns: urllib.quote(os.path.abspath(os.path.join(cls.schema_path, schema_file)).replace('\\', '//')) for ns, schema_file in cls.schema_map.iteritems()}
-            schema = """<?xml version="1.0"?>
-                <xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">
-                    %s
-                </xs:schema>
-            """ % '\r\n'.join('<xs:import namespace="%s" schemaLocation="%s"/>' % (namespace, schema_location) for namespace, schema_location in location_map.iteritems())
-            cls.schema = etree.XMLSchema(etree.XML(schema))
-            cls.parser = etree.XMLParser(schema=cls.schema, remove_blank_text=True)
-        else:
-            cls.schema = None
-            cls.parser = etree.XMLParser(remove_blank_text=True)
+        # the schema is only compiled when it is first used
+        cls.schema_set = frozenset((ns, urllib.quote(os.path.abspath(os.path.join(cls.schema_path, schema_file)).replace('\\', '//'))) for ns, schema_file in cls.schema_map.iteritems())
+
+    @property
+    def schema(cls):
+        return schema_cache[cls.schema_set].schema
+
+    @property
+    def parser(cls):
+        return schema_cache[cls.schema_set].parser
+
+    @property
+    def nonvalidating_parser(cls):
+        return schema_cache[frozenset()].parser
 
 
 class XMLDocument(object):
@@ -144,18 +179,21 @@ class XMLDocument(object):
     encoding = 'UTF-8'
     content_type = None
     schema_path = os.path.join(os.path.dirname(__file__), 'xml-schemas')
+    validate = True # validate parsed documents against the schema, unless overridden when calling parse
+    lazy = False # create the objects for the element children only when they are first accessed
 
     @classmethod
-    def parse(cls, document):
+    def parse(cls, document, validate=None):
+        # the parser validates the document against the schema while parsing it, when validation is not wanted
+        # the document is only checked for being well formed and the elements only check the values they parse
+        parser = cls.parser if (cls.validate if validate is None else validate) else cls.nonvalidating_parser
         try:
             if isinstance(document, str):
-                xml = etree.XML(document, parser=cls.parser)
+                xml = etree.XML(document, parser=parser)
             elif isinstance(document, unicode):
-                xml = etree.XML(document.encode('utf-8'), parser=cls.parser)
+                xml = etree.XML(document.encode('utf-8'), parser=parser)
             else:
-                xml = etree.parse(document, parser=cls.parser).getroot()
-            if cls.schema is not None:
-                cls.schema.assertValid(xml)
+                xml = etree.parse(document, parser=parser).getroot()
             return cls.root_element.from_element(xml, xml_document=cls)
         except (etree.DocumentInvalid, etree.XMLSyntaxError, ValueError), e:
             raise ParserError(str(e))
@@ -168,11 +206,20 @@ class XMLDocument(object):
         if validate and cls.schema is not None:
             cls.schema.assertValid(element)
         # Cleanup namespaces and move element NS mappings to the global scope.
-        normalized_element = etree.Element(element.tag, attrib=element.attrib, nsmap=dict(chain(element.nsmap.iteritems(), cls.nsmap.iteritems())))
-        normalized_element.text = element.text
-        normalized_element.tail = element.tail
-        normalized_element.extend(deepcopy(child) for child in element)
-        etree.cleanup_namespaces(normalized_element)
+        nsmap = dict(chain(element.nsmap.iteritems(), cls.nsmap.iteritems()))
+        if len(set(nsmap.itervalues())) == len(nsmap):
+            # Every namespace has a single prefix, so the prefixes will not change and the tree can be normalized in place.
+            # Note that this modifies the element tree of root_element: the namespace declarations of its elements are moved
+            # to the root element and the unused ones are removed. The tags, prefixes and attributes stay the same and the
+            # objects keep referring to the same elements, so the payload objects are not affected.
+            etree.cleanup_namespaces(element, top_nsmap=nsmap)
+            normalized_element = element
+        else:
+            normalized_element = etree.Element(element.tag, attrib=element.attrib, nsmap=nsmap)
+            normalized_element.text = element.text
+            normalized_element.tail = element.tail
+            normalized_element.extend(deepcopy(child) for child in element)
+            etree.cleanup_namespaces(normalized_element)
         return etree.tostring(normalized_element, encoding=encoding or cls.encoding, method='xml', xml_declaration=True, pretty_print=pretty_print)
 
     @classmethod
@@ -292,7 +339,28 @@ class XMLElementID(XMLAttribute):
         raise AttributeError("An XML element ID cannot be deleted")
 
 
-class XMLElementChild(object):
+class XMLPendingChildMixin(object):
+    """
+    A mixin for the element child descriptors, that creates the values which
+    were left as XML elements when the parent was parsed in lazy mode. The
+    children of descriptors with an onset hook are never left pending, so
+    the values can be stored without going through __set__.
+    """
+
+    def _load_pending(self, obj):
+        try:
+            type, element = self.pending.pop(obj)
+        except KeyError:
+            return None
+        try:
+            value = type.from_element(element, xml_document=obj._xml_document)
+        except ValidationError:
+            return None # we should accept partially valid documents
+        self.values[obj] = value
+        return value
+
+
+class XMLElementChild(XMLPendingChildMixin):
     def __init__(self, name, type, required=False, test_equal=True, onset=None, ondel=None):
         self.name = name
         self.type = type
@@ -301,6 +369,7 @@ class XMLElementChild(object):
         self.onset = onset
         self.ondel = ondel
         self.values = weakobjectmap()
+        self.pending = weakobjectmap()
 
     def __get__(self, obj, objtype):
         if obj is None:
@@ -308,11 +377,13 @@ class XMLElementChild(object):
         try:
             return self.values[obj]
         except KeyError:
-            return None
+            return self._load_pending(obj)
 
     def __set__(self, obj, value):
         if value is not None and not isinstance(value, self.type):
             value = self.type(value)
+        if obj in self.pending:
+            self._load_pending(obj)
         same_value = False
         old_value = self.values.get(obj)
         if value is old_value:
@@ -331,6 +402,8 @@ class XMLElementChild(object):
             self.onset(obj, self, value)
 
     def __delete__(self, obj):
+        if obj in self.pending:
+            self._load_pending(obj)
         try:
             old_value = self.values.pop(obj)
         except KeyError:
@@ -389,7 +462,7 @@ class XMLElementChoiceChildWrapper(object):
             del child_class._xml_children_qname_map[type.qname]
 
 
-class XMLElementChoiceChild(object):
+class XMLElementChoiceChild(XMLPendingChildMixin):
     def __init__(self, name, types, extension_type=None, required=False, test_equal=True, onset=None, ondel=None):
         self.name = name
         self.types = set(types)
@@ -399,6 +472,7 @@ class XMLElementChoiceChild(object):
         self.onset = onset
         self.ondel = ondel
         self.values = weakobjectmap()
+        self.pending = weakobjectmap()
 
     def __get__(self, obj, objtype):
         if obj is None:
@@ -406,11 +480,13 @@ class XMLElementChoiceChild(object):
         try:
             return self.values[obj]
         except KeyError:
-            return None
+            return self._load_pending(obj)
 
     def __set__(self, obj, value):
         if value is not None and type(value) not in self.types:
             raise TypeError("%s is not an acceptable type for %s" % (value.__class__.__name__, obj.__class__.__name__))
+        if obj in self.pending:
+            self._load_pending(obj)
         same_value = False
         old_value = self.values.get(obj)
         if value is old_value:
@@ -429,6 +505,8 @@ class XMLElementChoiceChild(object):
             self.onset(obj, self, value)
 
     def __delete__(self, obj):
+        if obj in self.pending:
+            self._load_pending(obj)
         try:
             old_value = self.values.pop(obj)
         except KeyError:
@@ -557,14 +635,19 @@ class XMLElement(XMLElementBase):
         self.__dirty__ = True
 
     def __get_dirty__(self):
-        return (self.__dict__['__dirty__']
-                or any(child.__dirty__ for child in (getattr(self, name) for name in self._xml_element_children) if child is not None)
-                or super(XMLElement, self).__get_dirty__())
+        if self.__dict__['__dirty__']:
+            return True
+        # the children that were not yet loaded from the XML element (in lazy mode) are not dirty
+        for element_child in self._xml_element_children.itervalues():
+            child = element_child.values.get(self)
+            if child is not None and child.__dirty__:
+                return True
+        return super(XMLElement, self).__get_dirty__()
 
     def __set_dirty__(self, dirty):
         super(XMLElement, self).__set_dirty__(dirty)
         if not dirty:
-            for child in (child for child in (getattr(self, name) for name in self._xml_element_children) if child is not None):
+            for child in (child for child in (element_child.values.get(self) for element_child in self._xml_element_children.itervalues()) if child is not None):
                 child.__dirty__ = dirty
         self.__dict__['__dirty__'] = dirty
 
@@ -579,20 +662,20 @@ class XMLElement(XMLElementBase):
                 raise ValidationError("required attribute %s of %s is not set" % (name, self.__class__.__name__))
         # check element children
         for name, element_child in self._xml_element_children.iteritems():
-            # if child has default but it was not set, will also be added with this occasion
-            child = getattr(self, name, None)
-            if child is None and element_child.required:
+            if element_child.required and element_child.values.get(self) is None and self not in element_child.pending:
                 raise ValidationError("element child %s of %s is not set" % (name, self.__class__.__name__))
 
     def to_element(self):
+        # the element of a clean subtree already reflects its contents, either because it was parsed from it or because it was already built
+        if not self.__dirty__:
+            return self.element
         try:
             self.check_validity()
         except ValidationError, e:
             raise BuilderError(str(e))
-        # build element children
-        for name in self._xml_element_children:
-            descriptor = getattr(self.__class__, name)
-            child = descriptor.__get__(self, StoredAttribute)
+        # build element children (the ones that were not yet loaded from their XML element are not dirty)
+        for element_child in self._xml_element_children.itervalues():
+            child = element_child.values.get(self)
             if child is not None:
                 child.to_element()
         self._build_element()
@@ -611,10 +694,13 @@ class XMLElement(XMLElementBase):
                     setattr(obj, name, attribute.parse(xmlvalue))
                 except (ValueError, TypeError):
                     raise ValidationError("got illegal value for attribute %s of %s: %s" % (name, cls.__name__, xmlvalue))
-        # set element children
+        # set element children (in lazy mode, the children with an onset hook are still set right away, so that the hook runs when it does in eager mode)
+        lazy = obj._xml_document.lazy
         for child in element:
             element_child, type = cls._xml_children_qname_map.get(child.tag, (None, None))
-            if element_child is not None:
+            if element_child is not None and lazy and element_child.onset is None:
+                element_child.pending[obj] = (type, child)
+            elif element_child is not None:
                 try:
                     value = type.from_element(child, xml_document=obj._xml_document)
                 except ValidationError:
@@ -728,8 +814,8 @@ class XMLRootElement(XMLElement):
         return obj
 
     @classmethod
-    def parse(cls, document):
-        return cls._xml_document.parse(document)
+    def parse(cls, document, validate=None):
+        return cls._xml_document.parse(document, validate=validate)
 
     def toxml(self, encoding=None, pretty_print=False, validate=True):
         return self._xml_document.build(self, encoding=encoding, pretty_print=pretty_print, validate=validate)
@@ -772,12 +858,109 @@ class XMLRootElement(XMLElement):
                 result.append(self.__cache__[element])
         return result
 
-    def get_xpath(self, element):
+    def get_xpath(self, element, parent=None):
         raise NotImplementedError
 
     def find_parent(self, element):
         raise NotImplementedError
 
+    def get_dirty_elements(self):
+        """
+        Return a list with the topmost elements that were modified since the
+        document was parsed or last marked as clean, as (element, ancestors)
+        tuples, where ancestors is a tuple with the parents of the element,
+        starting with the root element.
+        """
+        result = []
+        notvisited = deque([(self, ())])
+        while notvisited:
+            container, ancestors = notvisited.popleft()
+            if not container.__dirty__:
+                continue
+            if container.__dict__['__dirty__']:
+                result.append((container, ancestors))
+                continue
+            ancestors += (container,)
+            for element_child in container._xml_element_children.itervalues():
+                child = element_child.values.get(container)
+                if child is not None:
+                    notvisited.append((child, ancestors))
+            if isinstance(container, XMLListMixin) and container.__pending__ is None:
+                added_items = container.__dict__['_added_items']
+                for child in container._element_map.itervalues():
+                    if id(child) in added_items:
+                        result.append((child, ancestors))
+                    elif isinstance(child, XMLElement):
+                        notvisited.append((child, ancestors))
+        return result
+
+    def get_removed_elements(self):
+        """
+        Return a list with the elements that were removed from lists since the
+        document was parsed or last marked as clean, as (element, ancestors)
+        tuples, where ancestors is a tuple with the parents the element had,
+        starting with the root element and ending with the list it was
+        removed from. Elements removed from a modified element returned by
+        get_dirty_elements are not included.
+        """
+        result = []
+        notvisited = deque([(self, ())])
+        while notvisited:
+            container, ancestors = notvisited.popleft()
+            if not container.__dirty__ or container.__dict__['__dirty__']:
+                continue
+            ancestors += (container,)
+            for element_child in container._xml_element_children.itervalues():
+                child = element_child.values.get(container)
+                if child is not None:
+                    notvisited.append((child, ancestors))
+            if isinstance(container, XMLListMixin) and container.__pending__ is None:
+                added_items = container.__dict__['_added_items']
+                result.extend((item, ancestors) for item in container.__dict__['_removed_items'].itervalues())
+                notvisited.extend((child, ancestors) for child in container._element_map.itervalues() if isinstance(child, XMLElement) and id(child) not in added_items)
+        return result
+
+    def get_dirty_xpaths(self):
+        """
+        Return the XPaths of the elements that need to be updated in order to
+        bring a stored copy of the document in sync with this one. Modified
+        elements that cannot be addressed by get_xpath are replaced by their
+        nearest ancestor that can be.
+        """
+        return [xpath for xpath, element in self.get_dirty_nodes()]
+
+    def get_dirty_nodes(self):
+        """
+        Same as get_dirty_xpaths, but return (xpath, element) tuples with the
+        elements the XPaths select. The XPaths of the elements that were
+        removed are returned first, with None in place of the element.
+        """
+        def select(element, ancestors):
+            for index in xrange(len(ancestors), -1, -1):
+                node = ancestors[index] if index < len(ancestors) else element
+                try:
+                    xpath = self.get_xpath(node)
+                except ValueError:
+                    continue
+                if xpath is not None:
+                    selected[id(node)] = (xpath, node, [id(ancestor) for ancestor in ancestors[:index]])
+                    break
+        selected = {}
+        removed = []
+        for element, ancestors in self.get_dirty_elements():
+            select(element, ancestors)
+        for element, ancestors in self.get_removed_elements():
+            try:
+                xpath = self.get_xpath(element, ancestors[-1])
+            except ValueError:
+                xpath = None
+            if xpath is not None:
+                removed.append((xpath, [id(ancestor) for ancestor in ancestors]))
+            else:
+                select(ancestors[-1], ancestors[:-1])
+        nodes = [(xpath, node) for xpath, node, ancestors in selected.itervalues() if not any(ancestor in selected for ancestor in ancestors)]
+        return [(xpath, None) for xpath, ancestors in removed if not any(ancestor in selected for ancestor in ancestors)] + nodes
+
 
 ## Mixin classes
 
@@ -816,17 +999,49 @@ class XMLListMixin(XMLElementBase):
 
     __metaclass__ = XMLListMixinType
 
+    __pending__ = None # the XML element with the items that were not yet loaded (in lazy mode)
+
     _xml_item_type = None
 
     def __new__(cls, *args, **kw):
         if cls._xml_item_type is None:
             raise TypeError("The %s class cannot be instantiated because it doesn't define the _xml_item_type attribute" % cls.__name__)
         instance = super(XMLListMixin, cls).__new__(cls)
-        instance._element_map = {}
-        instance._xmlid_map = defaultdict(dict)
+        instance.__dict__['_element_map'] = {}
+        instance.__dict__['_xmlid_map'] = defaultdict(dict)
+        instance.__dict__['_xmltype_map'] = defaultdict(dict)
+        instance.__dict__['_added_items'] = {}   # the items added since the list was last marked as clean, by id
+        instance.__dict__['_removed_items'] = {} # the items removed since the list was last marked as clean, by id
         return instance
 
+    def _get_element_map(self):
+        if self.__pending__ is not None:
+            self._parse_items(self.__pending__)
+        return self.__dict__['_element_map']
+
+    def _get_xmlid_map(self):
+        if self.__pending__ is not None:
+            self._parse_items(self.__pending__)
+        return self.__dict__['_xmlid_map']
+
+    def _get_xmltype_map(self):
+        if self.__pending__ is not None:
+            self._parse_items(self.__pending__)
+        return self.__dict__['_xmltype_map']
+
+    _element_map = property(_get_element_map)
+    _xmlid_map = property(_get_xmlid_map)
+    _xmltype_map = property(_get_xmltype_map)
+    del _get_element_map, _get_xmlid_map, _get_xmltype_map
+
     def __contains__(self, item):
+        if isinstance(item, XMLElement):
+            if self._element_map.get(item.element) is item:
+                return True
+            if item._xml_id is not None:
+                same_id_item = self._xmlid_map[item.__class__].get(item._xml_id)
+                if same_id_item is not None and same_id_item == item:
+                    return True
         return item in self._element_map.itervalues()
 
     def __iter__(self):
@@ -850,7 +1065,7 @@ class XMLListMixin(XMLElementBase):
 
     def __getitem__(self, key):
         if key is IterateTypes:
-            return (cls for cls, mapping in self._xmlid_map.iteritems() if mapping)
+            return (cls for cls, mapping in self._xmltype_map.iteritems() if mapping)
         if not isinstance(key, tuple):
             raise KeyError(key)
         try:
@@ -860,7 +1075,7 @@ class XMLListMixin(XMLElementBase):
         if id is IterateIDs:
             return self._xmlid_map[cls].iterkeys()
         elif id is IterateItems:
-            return self._xmlid_map[cls].itervalues()
+            return self._xmltype_map[cls].itervalues()
         else:
             return self._xmlid_map[cls][id]
 
@@ -872,24 +1087,42 @@ class XMLListMixin(XMLElementBase):
         except ValueError:
             raise KeyError(key)
         if id is All:
-            for item in self._xmlid_map[cls].values():
+            for item in self._xmltype_map[cls].values():
                 self.remove(item)
         else:
             self.remove(self._xmlid_map[cls][id])
 
     def __get_dirty__(self):
+        if self.__pending__ is not None:
+            return super(XMLListMixin, self).__get_dirty__()
+        if self.__dict__['_added_items'] or self.__dict__['_removed_items']:
+            return True
         return any(item.__dirty__ for item in self._element_map.itervalues()) or super(XMLListMixin, self).__get_dirty__()
 
     def __set_dirty__(self, dirty):
         super(XMLListMixin, self).__set_dirty__(dirty)
         if not dirty:
-            for item in self._element_map.itervalues():
-                item.__dirty__ = dirty
+            self.__dict__['_added_items'].clear()
+            self.__dict__['_removed_items'].clear()
+            if self.__pending__ is None:
+                for item in self._element_map.itervalues():
+                    item.__dirty__ = dirty
 
     def _parse_element(self, element):
         super(XMLListMixin, self)._parse_element(element)
+        if self._xml_document.lazy:
+            self.__dict__['_element_map'].clear()
+            self.__dict__['_xmlid_map'].clear()
+            self.__dict__['_xmltype_map'].clear()
+            self.__pending__ = element
+        else:
+            self._parse_items(element)
+
+    def _parse_items(self, element):
+        self.__pending__ = None
         self._element_map.clear()
         self._xmlid_map.clear()
+        self._xmltype_map.clear()
         for child in element[:]:
             child_class = self._xml_document.get_element(child.tag, type(None))
             if child_class in self._xml_item_element_types or issubclass(child_class, self._xml_item_extension_types):
@@ -903,17 +1136,20 @@ class XMLListMixin(XMLElementBase):
                     else:
                         if value._xml_id is not None:
                             self._xmlid_map[child_class][value._xml_id] = value
+                        self._xmltype_map[child_class][value.element] = value
                         self._element_map[value.element] = value
 
     def _build_element(self):
         super(XMLListMixin, self)._build_element()
-        for child in self._element_map.itervalues():
-            child.to_element()
+        if self.__pending__ is None:
+            for child in self._element_map.itervalues():
+                child.to_element()
 
     def add(self, item):
         if not (item.__class__ in self._xml_item_element_types or isinstance(item, self._xml_item_extension_types)):
             raise TypeError("%s cannot add items of type %s" % (self.__class__.__name__, item.__class__.__name__))
         same_value = False
+        added = False
         if item._xml_id is not None and item._xml_id in self._xmlid_map[item.__class__]:
             old_item = self._xmlid_map[item.__class__][item._xml_id]
             if item is old_item:
@@ -923,20 +1159,33 @@ class XMLListMixin(XMLElementBase):
                 same_value = True
             self.element.remove(old_item.element)
             del self._xmlid_map[item.__class__][item._xml_id]
+            del self._xmltype_map[item.__class__][old_item.element]
             del self._element_map[old_item.element]
+            added = self.__dict__['_added_items'].pop(id(old_item), None) is not None
         self._insert_element(item.element)
         if item._xml_id is not None:
             self._xmlid_map[item.__class__][item._xml_id] = item
+        self._xmltype_map[item.__class__][item.element] = item
         self._element_map[item.element] = item
-        if not same_value:
-            self.__dirty__ = True
+        if not same_value or added:
+            # new elements are tracked separately so that they can be stored without the rest of the list
+            if isinstance(item, XMLElement):
+                self.__dict__['_removed_items'].pop(id(item), None)
+                self.__dict__['_added_items'][id(item)] = item
+            else:
+                self.__dirty__ = True
 
     def remove(self, item):
         self.element.remove(item.element)
         if item._xml_id is not None:
             del self._xmlid_map[item.__class__][item._xml_id]
+        del self._xmltype_map[item.__class__][item.element]
         del self._element_map[item.element]
-        self.__dirty__ = True
+        if isinstance(item, XMLElement) and self.__dict__['_added_items'].pop(id(item), None) is None:
+            self.__dict__['_removed_items'][id(item)] = item
+        else:
+            # the item may have replaced one that was already stored, so the whole list needs to be stored again
+            self.__dirty__ = True
 
     def update(self, sequence):
         for item in sequence:
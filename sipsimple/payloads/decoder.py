@@ -0,0 +1,88 @@
+# Copyright (C) 2013 AG Projects. See LICENSE for details.
+#
+
+"""Decoding of NOTIFY bodies outside of the thread that received them"""
+
+__all__ = ['PayloadDecoder']
+
+from threading import Semaphore
+
+from application.notification import NotificationCenter, NotificationData
+from application.python.types import Singleton
+
+from sipsimple.payloads import ParserError
+from sipsimple.payloads.conference import ConferenceDocument
+from sipsimple.payloads.messagesummary import MessageSummary
+from sipsimple.payloads.pidf import PIDFDocument
+from sipsimple.payloads.rlsnotify import RLSNotify
+from sipsimple.payloads.watcherinfo import WatcherInfoDocument
+from sipsimple.payloads.xcapdiff import XCAPDiffDocument
+from sipsimple.threading import call_in_thread, call_in_twisted_thread
+
+
+def decode_rls_notify(body, headers, pidf_cache=None):
+    return RLSNotify.parse('{content_type}\r\n\r\n{body}'.format(content_type=headers['Content-Type'], body=body), pidf_cache=pidf_cache)
+
+
+class PayloadDecoder(object):
+    """
+    Parses payloads in a pool of worker threads, using the decoder that was
+    registered for their content type. When a payload was decoded, the
+    <prefix>DidDecode notification is posted with the decoded payload, or
+    <prefix>DidFailToDecode if it could not be parsed. The notifications are
+    posted in the twisted thread, in the order in which the payloads from the
+    same sender were given to the decoder. When too many payloads are waiting
+    to be decoded, decode does not wait for the workers to catch up: the
+    payload is dropped and <prefix>DidFailToDecode is posted for it with
+    dropped=True, after the notifications for the payloads already waiting.
+    """
+
+    __metaclass__ = Singleton
+
+    workers = 4
+    max_pending = 100
+
+    def __init__(self):
+        self.decoders = {ConferenceDocument.content_type: ConferenceDocument.parse,
+                         MessageSummary.content_type: MessageSummary.parse,
+                         PIDFDocument.content_type: PIDFDocument.parse,
+                         RLSNotify.content_type: decode_rls_notify,
+                         WatcherInfoDocument.content_type: WatcherInfoDocument.parse,
+                         XCAPDiffDocument.content_type: XCAPDiffDocument.parse}
+        self._pending = Semaphore(self.max_pending)
+        self.dropped_payloads = 0
+
+    def register_decoder(self, content_type, decoder):
+        self.decoders[content_type] = decoder
+
+    def unregister_decoder(self, content_type):
+        self.decoders.pop(content_type, None)
+
+    def decode(self, sender, prefix, content_type, body, **kw):
+        decoder = self.decoders[content_type]
+        if not self._pending.acquire(False):
+            # this is called from the twisted thread, which must not be blocked waiting for the workers
+            self.dropped_payloads += 1
+            notification_center = NotificationCenter()
+            self.call_in_order(sender, notification_center.post_notification, prefix+'DidFailToDecode', sender=sender, data=NotificationData(content_type=content_type, error='too many payloads are waiting to be decoded', dropped=True))
+            return
+        call_in_thread(self._get_thread(sender), self._decode, decoder, sender, prefix, content_type, body, kw)
+
+    def call_in_order(self, sender, function, *args, **kw):
+        """Call function in the twisted thread, after the notifications for the payloads already given for sender were posted"""
+        call_in_thread(self._get_thread(sender), call_in_twisted_thread, function, *args, **kw)
+
+    def _get_thread(self, sender):
+        return 'payload-decoder-%d' % (hash(sender) % self.workers)
+
+    def _decode(self, decoder, sender, prefix, content_type, body, kw):
+        notification_center = NotificationCenter()
+        try:
+            payload = decoder(body, **kw)
+        except ParserError, e:
+            call_in_twisted_thread(notification_center.post_notification, prefix+'DidFailToDecode', sender=sender, data=NotificationData(content_type=content_type, error=str(e), dropped=False))
+        else:
+            call_in_twisted_thread(notification_center.post_notification, prefix+'DidDecode', sender=sender, data=NotificationData(content_type=content_type, payload=payload))
+        finally:
+            self._pending.release()
+
@@ -4,10 +4,12 @@
 """Parses and produces isComposing messages according to RFC3994."""
 
 
-__all__ = ['namespace', 'IsComposingDocument', 'State', 'LastActive', 'ContentType', 'Refresh', 'IsComposingMessage']
+__all__ = ['namespace', 'IsComposingDocument', 'State', 'LastActive', 'ContentType', 'Refresh', 'IsComposingMessage', 'ComposingIndication']
 
 
-from sipsimple.payloads import XMLDocument, XMLRootElement, XMLStringElement, XMLPositiveIntegerElement, XMLDateTimeElement, XMLElementChild
+from lxml import etree
+
+from sipsimple.payloads import ParserError, ValidationError, XMLDocument, XMLRootElement, XMLStringElement, XMLPositiveIntegerElement, XMLDateTimeElement, XMLElementChild
 
 
 namespace = 'urn:ietf:params:xml:ns:im-iscomposing'
@@ -75,3 +77,43 @@ class IsComposingMessage(XMLRootElement):
         self.content_type = content_type
         self.refresh = refresh
 
+
+class ComposingIndication(object):
+    """
+    The fields of an isComposing message, read directly from the XML tree
+    without building the IsComposingMessage object.
+    """
+
+    __slots__ = ('state', 'last_active', 'content_type', 'refresh')
+
+    def __init__(self, state, last_active=None, content_type=None, refresh=None):
+        self.state = state
+        self.last_active = last_active
+        self.content_type = content_type
+        self.refresh = refresh
+
+    def __repr__(self):
+        return "%s(%r, %r, %r, %r)" % (self.__class__.__name__, self.state, self.last_active, self.content_type, self.refresh)
+
+    @classmethod
+    def parse(cls, document):
+        if isinstance(document, unicode):
+            document = document.encode('utf-8')
+        try:
+            xml = etree.XML(document, parser=IsComposingDocument.nonvalidating_parser)
+        except etree.XMLSyntaxError, e:
+            raise ParserError(str(e))
+        if xml.tag != IsComposingMessage.qname:
+            raise ValidationError("not an isComposing document")
+        state = xml.findtext(State.qname)
+        if state is None:
+            raise ValidationError("missing state element")
+        last_active = xml.findtext(LastActive.qname)
+        content_type = xml.findtext(ContentType.qname)
+        refresh = xml.findtext(Refresh.qname)
+        try:
+            last_active = LastActive._xml_value_type(last_active.strip()) if last_active is not None else None
+            refresh = Refresh._xml_value_type(refresh.strip()) if refresh is not None else None
+        except ValueError, e:
+            raise ValidationError(str(e))
+        return cls(StateValue(state.strip()), last_active, unicode(content_type) if content_type is not None else None, refresh)
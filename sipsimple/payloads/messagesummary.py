@@ -13,6 +13,10 @@ from application.configuration.datatypes import Boolean
 from sipsimple.payloads import ValidationError
 
 
+message_context_classes = frozenset(["voice-message", "fax-message", "pager-message", "multimedia-message", "text-message", "none"])
+message_counts_re = re.compile("((\d+)/(\d+))( \((\d+)/(\d+)\))?")
+
+
 class MessageSummary(object):
     content_type = "application/simple-message-summary"
 
@@ -36,17 +40,17 @@ class MessageSummary(object):
                 field, sep, rest = line.partition(':')
                 if not field and not rest:
                     raise ValidationError("incorrect line format")
-                field = field.strip()
+                field = field.strip().lower()
                 rest = rest.strip()
 
-                if field.lower() == "messages-waiting":
+                if field == "messages-waiting":
                     summary.messages_waiting = Boolean(rest)
-                elif field.lower() == "message-account":
+                elif field == "message-account":
                     summary.message_account = rest
-                elif field.lower() in set(["voice-message", "fax-message", "pager-message", "multimedia-message", "text-message", "none"]):
-                    m = re.match("((\d+)/(\d+))( \((\d+)/(\d+)\))?", rest)
+                elif field in message_context_classes:
+                    m = message_counts_re.match(rest)
                     if m:
-                        summary.summaries[field.lower()] = dict(new_messages=m.groups()[1], old_messages=m.groups()[2], new_urgent_messages=m.groups()[4] or 0, old_urgent_messages=m.groups()[5] or 0)
+                        summary.summaries[field] = dict(new_messages=m.groups()[1], old_messages=m.groups()[2], new_urgent_messages=m.groups()[4] or 0, old_urgent_messages=m.groups()[5] or 0)
                     else:
                         raise ValidationError("invalid message context class")
                 else:
@@ -201,26 +201,31 @@ class ResourceLists(XMLListRootElement):
     def get(self, key, default=None):
         return self._xmlid_map[List].get(key, default)
 
-    def get_xpath(self, element):
+    def get_xpath(self, element, parent=None):
+        """
+        Return the XPath that selects element in this document. If parent is
+        given, element is an item that was removed from the parent list and
+        the XPath that selected it while it was in the list is returned.
+        """
         if not isinstance(element, (List, Entry, EntryRef, External, ResourceLists)):
             raise ValueError('can only find xpath for List, Entry, EntryRef or External elements')
         nsmap = dict((namespace, prefix) for prefix, namespace in self._xml_document.nsmap.iteritems())
         nsmap[self._xml_namespace] = None
         xpath_nsmap = {}
         root_xpath = '/' + self._xml_tag
-        if element is self:
+        target = element if parent is None else parent
+        if target is self and parent is None:
             return root_xpath
         notexpanded = deque([self])
         visited = set(notexpanded)
         parents = {self: None}
-        obj = None
-        while notexpanded:
+        obj = self if target is self else None
+        while notexpanded and obj is None:
             list = notexpanded.popleft()
             for child in list:
-                if child is element:
+                if child is target:
                     parents[child] = list
                     obj = child
-                    notexpanded.clear()
                     break
                 elif isinstance(child, List) and child not in visited:
                     parents[child] = list
@@ -228,6 +233,9 @@ class ResourceLists(XMLListRootElement):
                     visited.add(child)
         if obj is None:
             return None
+        if parent is not None:
+            parents[element] = parent
+            obj = element
         components = []
         while obj is not self:
             prefix = nsmap[obj._xml_namespace]
@@ -242,12 +250,13 @@ class ResourceLists(XMLListRootElement):
                 else:
                     siblings = [l for l in parents[obj] if isinstance(l, List)]
                     components.append('/%s[%d]' % (name, siblings.index(obj)+1))
+            # the URIs are matched against the attribute values as they are stored in the document, which are escaped
             elif isinstance(obj, Entry):
-                components.append('/%s[@%s=%s]' % (name, Entry.uri.xmlname, quoteattr(obj.uri)))
+                components.append('/%s[@%s=%s]' % (name, Entry.uri.xmlname, quoteattr(obj.element.get(Entry.uri.xmlname))))
             elif isinstance(obj, EntryRef):
-                components.append('/%s[@%s=%s]' % (name, EntryRef.ref.xmlname, quoteattr(obj.ref)))
+                components.append('/%s[@%s=%s]' % (name, EntryRef.ref.xmlname, quoteattr(obj.element.get(EntryRef.ref.xmlname))))
             elif isinstance(obj, External):
-                components.append('/%s[@%s=%s]' % (name, External.anchor.xmlname, quoteattr(obj.anchor)))
+                components.append('/%s[@%s=%s]' % (name, External.anchor.xmlname, quoteattr(obj.element.get(External.anchor.xmlname))))
             obj = parents[obj]
         components.reverse()
         return root_xpath + ''.join(components) + ('?' + ''.join('xmlns(%s=%s)' % (prefix, namespace) for namespace, prefix in xpath_nsmap.iteritems()) if xpath_nsmap else '')
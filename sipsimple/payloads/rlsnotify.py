@@ -3,15 +3,153 @@
 
 """Payload of the RLS notify messages."""
 
-__all__ = ['RLSNotify']
+__all__ = ['RLSNotify', 'RLSState']
 
-import email
+import hashlib
+import re
+
+from threading import Lock
 
 from sipsimple.payloads import IterateItems, ParserError
 from sipsimple.payloads import rlmi, pidf
 from sipsimple.payloads import rpid; rpid # needs to be imported to register its namespace
 
 
+class MultipartPart(object):
+    """
+    A part of a multipart body. The headers are parsed when the part is
+    created, while the body is only sliced out of the enclosing payload
+    when it is requested.
+    """
+
+    __slots__ = ('headers', '_data', '_start', '_end', '_body')
+
+    def __init__(self, headers, data, start, end):
+        self.headers = headers
+        self._data = data
+        self._start = start
+        self._end = end
+        self._body = None
+
+    def __getitem__(self, name):
+        return self.headers.get(name.lower(), None)
+
+    def get(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def get_content_type(self):
+        content_type = self.headers.get('content-type', None)
+        if content_type is None:
+            return 'text/plain'
+        return content_type.partition(';')[0].strip().lower()
+
+    def get_payload(self):
+        if self._body is None:
+            self._body = self._data[self._start:self._end]
+            self._data = None
+        return self._body
+
+
+class MultipartMessage(object):
+    """
+    A minimal multipart body parser, that splits the parts on the boundary
+    delimiters by searching the payload and without building a message
+    object tree. It offers the subset of the email.Message interface that
+    is needed for parsing the RLS notifications.
+    """
+
+    _parameter_re = re.compile(r';\s*(?P<name>[^\s=;]+)\s*=\s*(?:"(?P<quoted>(?:[^"\\]|\\.)*)"|(?P<token>[^\s;]*))')
+
+    def __init__(self, content_type, parameters, parts):
+        self.content_type = content_type
+        self.parameters = parameters
+        self.parts = parts
+
+    def get_content_type(self):
+        return self.content_type
+
+    def get_param(self, name, default=None):
+        return self.parameters.get(name.lower(), default)
+
+    def get_payload(self):
+        return self.parts
+
+    @classmethod
+    def parse_headers(cls, data, start, end):
+        headers = {}
+        name = None
+        for line in data[start:end].splitlines():
+            if not line:
+                continue
+            if line[0] in ' \t' and name is not None:
+                headers[name] += ' ' + line.strip()
+                continue
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise ParserError("invalid header line: %r" % line)
+            name = name.strip().lower()
+            headers[name] = value.strip()
+        return headers
+
+    @classmethod
+    def parse_content_type(cls, value):
+        content_type, sep, parameters = value.partition(';')
+        parameter_map = {}
+        for match in cls._parameter_re.finditer(sep + parameters):
+            quoted = match.group('quoted')
+            parameter_map[match.group('name').lower()] = re.sub(r'\\(.)', r'\1', quoted) if quoted is not None else match.group('token')
+        return content_type.strip().lower(), parameter_map
+
+    @staticmethod
+    def _find_headers_end(data, start, end):
+        crlf_position = data.find('\r\n\r\n', start, end)
+        lf_position = data.find('\n\n', start, end if crlf_position == -1 else crlf_position)
+        if lf_position != -1:
+            return lf_position, lf_position + 2
+        elif crlf_position != -1:
+            return crlf_position, crlf_position + 4
+        else:
+            return end, end
+
+    @classmethod
+    def parse(cls, payload):
+        headers_end, body_start = cls._find_headers_end(payload, 0, len(payload))
+        headers = cls.parse_headers(payload, 0, headers_end)
+        content_type, parameters = cls.parse_content_type(headers.get('content-type', 'text/plain'))
+        parts = []
+        boundary = parameters.get('boundary', None)
+        if not content_type.startswith('multipart/') or not boundary:
+            return cls(content_type, parameters, parts)
+        delimiter = '--' + boundary
+        position = payload.find(delimiter, body_start)
+        while position != -1:
+            position += len(delimiter)
+            if payload.startswith('--', position):
+                break # the close delimiter
+            # skip the transport padding and the line break that follow the delimiter
+            line_end = payload.find('\n', position)
+            if line_end == -1:
+                break
+            part_start = line_end + 1
+            next_position = payload.find('\n' + delimiter, line_end)
+            if next_position == -1:
+                raise ParserError("multipart body is missing the close delimiter")
+            # the line break that precedes the delimiter belongs to the delimiter, not to the part
+            part_end = next_position - 1 if payload[next_position-1] == '\r' else next_position
+            part_end = max(part_end, part_start)
+            next_position += 1
+            if payload.startswith('\r\n', part_start) or payload.startswith('\n', part_start):
+                # a part without headers
+                part_headers = {}
+                part_body_start = part_start + (2 if payload[part_start] == '\r' else 1)
+            else:
+                part_headers_end, part_body_start = cls._find_headers_end(payload, part_start, part_end)
+                part_headers = cls.parse_headers(payload, part_start, part_headers_end)
+            parts.append(MultipartPart(part_headers, payload, min(part_body_start, part_end), part_end))
+            position = next_position
+        return cls(content_type, parameters, parts)
+
+
 class ResourceURI(unicode):
     def __eq__(self, other):
         return super(ResourceURI, self).__eq__(other) or self.rpartition('sip:')[2] == other
@@ -32,11 +170,11 @@ class Resource(object):
         self.pidf_list = pidf_list or []
 
     @classmethod
-    def from_payload(cls, xml_element, payload_map):
-        try:
-            name = next(element for element in xml_element if isinstance(element, rlmi.Name))
-        except StopIteration:
-            name = None
+    def from_payload(cls, xml_element, payload_map, pidf_cache=None):
+        names = list(xml_element[rlmi.Name, IterateItems])
+        if len(names) > 1:
+            names.sort(key=lambda item: xml_element.element.index(item.element))
+        name = names[0] if names else None
         instances = list(xml_element[rlmi.Instance, IterateItems])
         if len(instances) == 0:
             state = None
@@ -55,10 +193,21 @@ class Resource(object):
                 payload = payload_map['<%s>' % instance.cid].get_payload()
             except KeyError:
                 continue
+            if pidf_cache is not None:
+                key = (instance.cid, hashlib.sha1(payload).digest())
+                try:
+                    pidf_list.append(pidf_cache[key])
+                    continue
+                except KeyError:
+                    pass
             try:
-                pidf_list.append(pidf.PIDFDocument.parse(payload))
+                document = pidf.PIDFDocument.parse(payload)
             except ParserError:
                 pass
+            else:
+                if pidf_cache is not None:
+                    pidf_cache[key] = document
+                pidf_list.append(document)
         return cls(xml_element.uri, name, state, reason, pidf_list)
 
 
@@ -80,8 +229,8 @@ class RLSNotify(object):
         return len(self.resources)
 
     @classmethod
-    def parse(cls, payload):
-        message = email.message_from_string(payload)
+    def parse(cls, payload, pidf_cache=None):
+        message = MultipartMessage.parse(payload)
         if message.get_content_type() != cls.content_type:
             raise ParserError("expected multipart/related content, got %s" % message.get_content_type())
         payloads = message.get_payload()
@@ -100,7 +249,141 @@ class RLSNotify(object):
         if root_type != rlmi.RLMIDocument.content_type != root.get_content_type():
             raise ParserError("the multipart/related root element must be of type %s" % rlmi.RLMIDocument.content_type)
         rlmi_document = rlmi.RLMIDocument.parse(root.get_payload())
-        resources = [Resource.from_payload(xml_element, payload_map) for xml_element in rlmi_document[rlmi.Resource, IterateItems]]
+        resources = [Resource.from_payload(xml_element, payload_map, pidf_cache) for xml_element in rlmi_document[rlmi.Resource, IterateItems]]
         return cls(rlmi_document.uri, rlmi_document.version, rlmi_document.full_state, resources)
 
 
+class PIDFCache(object):
+    """
+    The PIDF documents parsed from the RLS notifications, keyed by the
+    Content-ID and the digest of their body part. The cache is filled by
+    the threads that decode the notifications and is pruned by the thread
+    that applies them, so all access to it is serialized.
+    """
+
+    def __init__(self):
+        self._documents = {}
+        self._keys = {}
+        self._lock = Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._documents
+
+    def __getitem__(self, key):
+        with self._lock:
+            return self._documents[key]
+
+    def __setitem__(self, key, document):
+        with self._lock:
+            old_document = self._documents.get(key, None)
+            if old_document is not None:
+                del self._keys[id(old_document)]
+            self._documents[key] = document
+            self._keys[id(document)] = key
+
+    def __len__(self):
+        with self._lock:
+            return len(self._documents)
+
+    def discard(self, document):
+        with self._lock:
+            key = self._keys.pop(id(document), None)
+            if key is not None:
+                del self._documents[key]
+
+    def clear(self):
+        with self._lock:
+            self._documents.clear()
+            self._keys.clear()
+
+
+class RLSState(object):
+    """
+    The accumulated state of a resource list subscription, which is updated
+    in place from the full and partial state RLS notifications. The PIDF
+    documents parsed from previous notifications are kept in pidf_cache and
+    are reused for the body parts whose Content-ID and content are unchanged.
+    The documents are counted as they are referenced by the resources, so
+    that only the documents of the resources touched by a notification need
+    to be checked when pruning the cache.
+    """
+
+    def __init__(self):
+        self.resources = {}
+        self.pidf_cache = PIDFCache()
+        self._references = {}
+
+    def __contains__(self, uri):
+        return uri in self.resources
+
+    def __getitem__(self, uri):
+        return self.resources[uri]
+
+    def __iter__(self):
+        return self.resources.itervalues()
+
+    def __len__(self):
+        return len(self.resources)
+
+    def clear(self):
+        self.resources.clear()
+        self.pidf_cache.clear()
+        self._references.clear()
+
+    def update(self, rls_notify):
+        """Apply a RLS notification and return the (modified, removed) resource maps"""
+        modified = {}
+        removed = {}
+        if rls_notify.full_state:
+            notified_uris = set(resource.uri for resource in rls_notify)
+            for uri, resource in self.resources.items():
+                if uri not in notified_uris:
+                    removed[uri] = self._remove_resource(uri)
+        for resource in rls_notify:
+            old_resource = self.resources.get(resource.uri, None)
+            if resource.state == 'terminated' and not rls_notify.full_state:
+                # the RLS stopped reporting the state of this resource
+                if old_resource is not None:
+                    removed[resource.uri] = self._remove_resource(resource.uri)
+            elif old_resource is None or not self._same_resource(old_resource, resource):
+                self._add_resource(resource)
+                modified[resource.uri] = resource
+        self.discard(rls_notify)
+        return modified, removed
+
+    def discard(self, rls_notify):
+        """Remove the documents of a RLS notification that are not used by any resource from the cache"""
+        for resource in rls_notify:
+            for document in resource.pidf_list:
+                if id(document) not in self._references:
+                    self.pidf_cache.discard(document)
+
+    def _add_resource(self, resource):
+        old_resource = self.resources.get(resource.uri, None)
+        self.resources[resource.uri] = resource
+        for document in resource.pidf_list:
+            self._references[id(document)] = self._references.get(id(document), 0) + 1
+        if old_resource is not None:
+            self._release_documents(old_resource)
+
+    def _remove_resource(self, uri):
+        resource = self.resources.pop(uri)
+        self._release_documents(resource)
+        return resource
+
+    def _release_documents(self, resource):
+        for document in resource.pidf_list:
+            references = self._references[id(document)] - 1
+            if references > 0:
+                self._references[id(document)] = references
+            else:
+                del self._references[id(document)]
+                self.pidf_cache.discard(document)
+
+    @staticmethod
+    def _same_resource(old_resource, new_resource):
+        # the documents come from pidf_cache when they did not change, so they can be compared by identity
+        return (old_resource.name == new_resource.name and old_resource.state == new_resource.state and old_resource.reason == new_resource.reason and
+                len(old_resource.pidf_list) == len(new_resource.pidf_list) and all(old is new for old, new in zip(old_resource.pidf_list, new_resource.pidf_list)))
+
@@ -10,6 +10,12 @@ RFC 5874.
 __all__ = ['namespace', 'XCAPDiffDocument', 'BodyNotChanged', 'Document', 'Element', 'Attribute', 'XCAPDiff']
 
 
+import re
+
+from copy import deepcopy
+
+from lxml import etree
+
 from sipsimple.payloads import XMLDocument, XMLElement, XMLListRootElement, XMLStringElement, XMLEmptyElement, XMLAttribute, XMLElementID, XMLElementChild
 from sipsimple.payloads.datatypes import Boolean, XCAPURI
 
@@ -23,6 +29,158 @@ class XCAPDiffDocument(XMLDocument):
 XCAPDiffDocument.register_namespace(namespace, prefix=None, schema='xcapdiff.xsd')
 
 
+## Patch operations (RFC5261)
+
+class PatchSelector(object):
+    """
+    Finds the node selected by a patch operation in a document. Unprefixed
+    element names in the selector belong to the default namespace that is
+    in scope for the patch operation, which XPath does not know about, so
+    they are given an explicit prefix.
+    """
+
+    _name_re = re.compile(r'^[A-Za-z_][\w.-]*$')
+    _value_re = re.compile(r'\[([A-Za-z_][\w.-]*)(?==)')
+
+    def __init__(self, operation):
+        self.namespaces = dict((prefix, ns) for prefix, ns in operation.nsmap.iteritems() if prefix is not None)
+        selector = operation.get('sel')
+        if selector is None:
+            raise ValueError("missing sel attribute in %s patch operation" % etree.QName(operation).localname)
+        if None in operation.nsmap:
+            prefix = 'default'
+            while prefix in self.namespaces:
+                prefix += '_'
+            self.namespaces[prefix] = operation.nsmap[None]
+            selector = '/'.join(self._qualify_step(step, prefix) for step in self._split_steps(selector))
+        self.xpath = selector if selector.startswith(('/', 'id(')) else '/' + selector
+
+    def _split_steps(self, selector):
+        steps = []
+        start = depth = 0
+        quote = None
+        for position, char in enumerate(selector):
+            if quote is not None:
+                if char == quote:
+                    quote = None
+            elif char in '\'"':
+                quote = char
+            elif char == '[':
+                depth += 1
+            elif char == ']':
+                depth -= 1
+            elif char == '/' and depth == 0:
+                steps.append(selector[start:position])
+                start = position + 1
+        steps.append(selector[start:])
+        return steps
+
+    def _qualify_step(self, step, prefix):
+        name, bracket, predicates = step.partition('[')
+        if self._name_re.match(name):
+            name = '%s:%s' % (prefix, name)
+        return name + self._value_re.sub(r'[%s:\1' % prefix, bracket + predicates)
+
+    def select(self, root):
+        try:
+            nodes = root.xpath(self.xpath, namespaces=self.namespaces)
+        except etree.XPathError:
+            raise ValueError("illegal patch selector: %s" % self.xpath)
+        if not isinstance(nodes, list) or len(nodes) != 1:
+            raise ValueError("patch selector %s does not select a single node" % self.xpath)
+        return nodes[0]
+
+
+def _content_children(operation):
+    if operation.text and operation.text.strip() or any(child.tail and child.tail.strip() for child in operation):
+        raise ValueError("adding text nodes is not supported")
+    return [deepcopy(child) for child in operation if isinstance(child.tag, basestring)]
+
+
+def _remove_element(element):
+    parent = element.getparent()
+    if parent is None:
+        raise ValueError("cannot remove the root element")
+    if element.tail:
+        previous = element.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or '') + element.tail
+        else:
+            parent.text = (parent.text or '') + element.tail
+    parent.remove(element)
+
+
+def apply_add(root, operation):
+    target = PatchSelector(operation).select(root)
+    if not isinstance(target, etree._Element):
+        raise ValueError("the add patch operation can only select elements")
+    type = operation.get('type')
+    if type is not None:
+        if not type.startswith('@'):
+            raise ValueError("adding namespace declarations is not supported")
+        target.set(type[1:], operation.text or '')
+        return
+    children = _content_children(operation)
+    position = operation.get('pos')
+    if position is None:
+        target.extend(children)
+    elif position == 'prepend':
+        for index, child in enumerate(children):
+            target.insert(index, child)
+    elif position in ('before', 'after'):
+        parent = target.getparent()
+        if parent is None:
+            raise ValueError("cannot add siblings to the root element")
+        index = parent.index(target) + (position == 'after')
+        for offset, child in enumerate(children):
+            parent.insert(index + offset, child)
+    else:
+        raise ValueError("illegal pos value in add patch operation: %s" % position)
+
+
+def apply_replace(root, operation):
+    target = PatchSelector(operation).select(root)
+    if isinstance(target, etree._Element):
+        children = _content_children(operation)
+        if len(children) != 1:
+            raise ValueError("an element can only be replaced by another element")
+        parent = target.getparent()
+        if parent is None:
+            if children[0].tag != target.tag:
+                raise ValueError("the root element cannot be replaced with a different element")
+            target.attrib.clear()
+            target.attrib.update(children[0].attrib)
+            target.text = children[0].text
+            target[:] = children[0][:]
+        else:
+            children[0].tail = target.tail
+            parent.replace(target, children[0])
+    elif getattr(target, 'is_attribute', False):
+        target.getparent().set(target.attrname, operation.text or '')
+    elif getattr(target, 'is_text', False):
+        target.getparent().text = operation.text or ''
+    elif getattr(target, 'is_tail', False):
+        target.getparent().tail = operation.text or ''
+    else:
+        raise ValueError("unsupported node type selected by the replace patch operation")
+
+
+def apply_remove(root, operation):
+    target = PatchSelector(operation).select(root)
+    if isinstance(target, etree._Element):
+        _remove_element(target)
+    elif getattr(target, 'is_attribute', False):
+        del target.getparent().attrib[target.attrname]
+    elif getattr(target, 'is_text', False):
+        target.getparent().text = None
+    elif getattr(target, 'is_tail', False):
+        target.getparent().tail = None
+    else:
+        raise ValueError("unsupported node type selected by the remove patch operation")
+
+
+## Elements
+
 class BodyNotChanged(XMLEmptyElement):
     _xml_tag = 'body-not-changed'
     _xml_namespace = namespace
@@ -59,6 +217,22 @@ class Document(XMLElement):
     empty_body = property(_get_empty_body, _set_empty_body)
     del _get_empty_body, _set_empty_body
 
+    _patch_operations = {'{%s}add' % namespace: apply_add, '{%s}replace' % namespace: apply_replace, '{%s}remove' % namespace: apply_remove}
+
+    @property
+    def patch_operations(self):
+        return [child for child in self.element if child.tag in self._patch_operations]
+
+    def apply_patch(self, root):
+        """
+        Apply the patch operations to the given lxml element, which is the
+        root element of the document that changed. The element is modified
+        in place. Raises ValueError if an operation cannot be applied, in
+        which case the element may be partially modified.
+        """
+        for operation in self.patch_operations:
+            self._patch_operations[operation.tag](root, operation)
+
 
 class Element(XMLElement):
     _xml_tag = 'element'
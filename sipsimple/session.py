@@ -30,11 +30,12 @@ from sipsimple.core import ContactHeader, FromHeader, Header, ReasonHeader, Refe
 from sipsimple.core import SDPConnection, SDPMediaStream, SDPSession
 
 from sipsimple.account import AccountManager, BonjourAccount
+from sipsimple.account.subscription import SubscriptionPool
 from sipsimple.configuration.settings import SIPSimpleSettings
 from sipsimple.core import PublicGRUU, PublicGRUUIfAvailable, NoGRUU
 from sipsimple.lookup import DNSLookup, DNSLookupError
-from sipsimple.payloads import ParserError
 from sipsimple.payloads.conference import ConferenceDocument
+from sipsimple.payloads.decoder import PayloadDecoder
 from sipsimple.streams import MediaStreamRegistry, InvalidStreamError, UnknownStreamError
 from sipsimple.threading import run_in_twisted_thread
 from sipsimple.threading.green import Command, run_in_green_thread
@@ -361,6 +362,7 @@ class ConferenceHandler(object):
         notification_center = NotificationCenter()
         notification_center.add_observer(self, sender=self.session)
         notification_center.add_observer(self, name='NetworkConditionsDidChange')
+        notification_center.add_observer(self, name='ConferenceHandlerDidDecode', sender=self)
         self._command_proc = proc.spawn(self._run)
 
     @run_in_green_thread
@@ -404,12 +406,16 @@ class ConferenceHandler(object):
         command = Command('terminate')
         self._command_channel.send(command)
         command.wait()
+        PayloadDecoder().call_in_order(self, notification_center.remove_observer, self, name='ConferenceHandlerDidDecode', sender=self)
         self.session = None
 
     def _CH_subscribe(self, command):
         if self._subscription_timer is not None and self._subscription_timer.active():
             self._subscription_timer.cancel()
         self._subscription_timer = None
+        if self._subscription is not None:
+            # The subscription is replaced, so it must not be shared anymore
+            SubscriptionPool().invalidate(self._subscription)
         if self._subscription_proc is not None:
             subscription_proc = self._subscription_proc
             subscription_proc.kill(InterruptSubscription)
@@ -435,6 +441,7 @@ class ConferenceHandler(object):
     def _subscription_handler(self, command):
         notification_center = NotificationCenter()
         settings = SIPSimpleSettings()
+        pool = SubscriptionPool()
 
         try:
             # Lookup routes
@@ -458,8 +465,33 @@ class ConferenceHandler(object):
             default_interval = 600 if account is BonjourAccount() else account.sip.subscribe_interval
             refresh_interval = getattr(command, 'refresh_interval', default_interval)
 
+            pool_key = pool.key(target_uri, 'conference', account.credentials)
+            subscription = pool.acquire(pool_key)
+            if subscription is not None:
+                # Share the subscription started by another session
+                notification_center.add_observer(self, sender=subscription)
+                self._subscription = subscription
+                try:
+                    if subscription.state in ('NULL', 'SENT'):
+                        # It is not established yet, so wait for it to start or fail just like the session that sent it
+                        while True:
+                            notification = self._data_channel.wait()
+                            if notification.sender is subscription and notification.name == 'SIPSubscriptionDidStart':
+                                break
+                    else:
+                        # Refresh it so that the focus sends the full state again
+                        subscription.subscribe(timeout=5)
+                except (SIPSubscriptionDidFail, SIPCoreError):
+                    # Go on with a subscription of our own
+                    notification_center.remove_observer(self, sender=subscription)
+                    pool.release(subscription)
+                    self._subscription = None
+                else:
+                    self.subscribed = True
+                    command.signal()
+
             timeout = time() + 30
-            for route in routes:
+            for route in routes if not self.subscribed else ():
                 remaining_time = timeout - time()
                 if remaining_time > 0:
                     try:
@@ -481,6 +513,7 @@ class ConferenceHandler(object):
                         timeout = 5
                         raise SubscriptionError(error='Internal error', timeout=timeout)
                     self._subscription = subscription
+                    pool.add(pool_key, subscription)
                     try:
                         while True:
                             notification = self._data_channel.wait()
@@ -488,6 +521,7 @@ class ConferenceHandler(object):
                                 break
                     except SIPSubscriptionDidFail, e:
                         notification_center.remove_observer(self, sender=subscription)
+                        pool.release(subscription)
                         self._subscription = None
                         if e.data.code == 407:
                             # Authentication failed, so retry the subscription in some time
@@ -510,7 +544,7 @@ class ConferenceHandler(object):
                         self.subscribed = True
                         command.signal()
                         break
-            else:
+            if not self.subscribed:
                 # There are no more routes to try, reschedule the subscription
                 timeout = random.uniform(60, 180)
                 raise SubscriptionError(error='No more routes to try', timeout=timeout)
@@ -522,24 +556,21 @@ class ConferenceHandler(object):
                         continue
                     if notification.name == 'SIPSubscriptionGotNotify':
                         if notification.data.event == 'conference' and notification.data.body:
-                            try:
-                                conference_info = ConferenceDocument.parse(notification.data.body)
-                            except ParserError:
-                                pass
-                            else:
-                                notification_center.post_notification('SIPSessionGotConferenceInfo', sender=self.session, data=NotificationData(conference_info=conference_info))
+                            PayloadDecoder().decode(self, 'ConferenceHandler', ConferenceDocument.content_type, notification.data.body)
                     elif notification.name == 'SIPSubscriptionDidEnd':
                         break
             except SIPSubscriptionDidFail:
                 self._command_channel.send(Command('subscribe'))
             notification_center.remove_observer(self, sender=self._subscription)
+            pool.release(self._subscription)
         except InterruptSubscription, e:
             if not self.subscribed:
                 command.signal(e)
             if self._subscription is not None:
                 notification_center.remove_observer(self, sender=self._subscription)
                 try:
-                    self._subscription.end(timeout=2)
+                    if pool.release(self._subscription):
+                        self._subscription.end(timeout=2)
                 except SIPCoreError:
                     pass
         except TerminateSubscription, e:
@@ -547,17 +578,20 @@ class ConferenceHandler(object):
                 command.signal(e)
             if self._subscription is not None:
                 try:
-                    self._subscription.end(timeout=2)
+                    last_reference = pool.release(self._subscription)
+                    if last_reference:
+                        self._subscription.end(timeout=2)
                 except SIPCoreError:
                     pass
                 else:
-                    try:
-                        while True:
-                            notification = self._data_channel.wait()
-                            if notification.sender is self._subscription and notification.name == 'SIPSubscriptionDidEnd':
-                                break
-                    except SIPSubscriptionDidFail:
-                        pass
+                    if last_reference:
+                        try:
+                            while True:
+                                notification = self._data_channel.wait()
+                                if notification.sender is self._subscription and notification.name == 'SIPSubscriptionDidEnd':
+                                    break
+                        except SIPSubscriptionDidFail:
+                            pass
                 finally:
                     notification_center.remove_observer(self, sender=self._subscription)
         except SubscriptionError, e:
@@ -588,6 +622,10 @@ class ConferenceHandler(object):
     def _NH_SIPSubscriptionGotNotify(self, notification):
         self._data_channel.send(notification)
 
+    def _NH_ConferenceHandlerDidDecode(self, notification):
+        if self.session is not None:
+            notification.center.post_notification('SIPSessionGotConferenceInfo', sender=self.session, data=NotificationData(conference_info=notification.data.payload))
+
     def _NH_SIPSessionDidStart(self, notification):
         if self.session.remote_focus:
             self._activate()
@@ -3,15 +3,21 @@
 
 """Definitions and implementations of storage backends"""
 
+from __future__ import absolute_import
+
 __all__ = ['ISIPSimpleStorage', 'FileStorage', 'MemoryStorage']
 
 import os
 
 from functools import partial
+
+from application import log
 from zope.interface import Attribute, Interface, implements
 
+from sipsimple.account.xcap.storage import XCAPStorageError
 from sipsimple.account.xcap.storage.file import FileStorage as XCAPFileStorage
 from sipsimple.account.xcap.storage.memory import MemoryStorage as XCAPMemoryStorage
+from sipsimple.account.xcap.storage.sqlite import SQLiteDatabase as XCAPSQLiteDatabase, SQLiteStorage as XCAPSQLiteStorage
 from sipsimple.configuration.backend.file import FileBackend as ConfigurationFileBackend
 from sipsimple.configuration.backend.memory import MemoryBackend as ConfigurationMemoryBackend
 
@@ -24,13 +30,31 @@ class ISIPSimpleStorage(Interface):
 
 
 class FileStorage(object):
-    """Store/read SIP Simple data to/from files"""
+    """
+    Store/read SIP Simple data to/from files. The XCAP data is stored either
+    in a file per document (xcap_storage='file') or in a single SQLite
+    database for all the accounts (xcap_storage='sqlite'). The XCAP data
+    already stored in files is imported into the database, until an import
+    succeeds.
+    """
 
     implements(ISIPSimpleStorage)
 
-    def __init__(self, directory):
+    def __init__(self, directory, xcap_storage='file'):
         self.configuration_backend = ConfigurationFileBackend(os.path.join(directory, 'config'))
-        self.xcap_storage_factory  = partial(XCAPFileStorage, os.path.join(directory, 'xcap'))
+        if xcap_storage == 'file':
+            self.xcap_storage_factory = partial(XCAPFileStorage, os.path.join(directory, 'xcap'))
+        elif xcap_storage == 'sqlite':
+            database = XCAPSQLiteDatabase(os.path.join(directory, 'xcap.db'))
+            if not database.imported and os.path.isdir(os.path.join(directory, 'xcap')):
+                try:
+                    database.import_directory(os.path.join(directory, 'xcap'))
+                except XCAPStorageError, e:
+                    # the import is attempted again on the next start, until then the documents are fetched from the server
+                    log.error(str(e))
+            self.xcap_storage_factory = partial(XCAPSQLiteStorage, database)
+        else:
+            raise ValueError("unknown XCAP storage type: %s" % xcap_storage)
         self.directory = directory
 
 
@@ -42,7 +42,7 @@ from msrplib.transport import make_response, make_report
 from sipsimple.account import Account, BonjourAccount
 from sipsimple.configuration.settings import SIPSimpleSettings
 from sipsimple.core import SDPAttribute, SDPConnection, SDPMediaStream
-from sipsimple.payloads.iscomposing import IsComposingDocument, State, LastActive, Refresh, ContentType
+from sipsimple.payloads.iscomposing import ComposingIndication, IsComposingDocument, State, LastActive, Refresh, ContentType
 from sipsimple.streams import IMediaStream, MediaStreamType, StreamError, InvalidStreamError, UnknownStreamError
 from sipsimple.streams.applications.chat import ChatIdentity, ChatMessage, CPIMMessage, CPIMParserError
 from sipsimple.threading import run_in_twisted_thread
@@ -424,11 +424,11 @@ class ChatStream(MSRPStreamBase):
         self.msrp_session.send_report(chunk, 200, 'OK')
         notification_center = NotificationCenter()
         if message.content_type.lower() == IsComposingDocument.content_type:
-            data = IsComposingDocument.parse(message.body)
-            ndata = NotificationData(state=data.state.value,
-                                     refresh=data.refresh.value if data.refresh is not None else 120,
-                                     content_type=data.content_type.value if data.content_type is not None else None,
-                                     last_active=data.last_active.value if data.last_active is not None else None,
+            data = ComposingIndication.parse(message.body)
+            ndata = NotificationData(state=data.state,
+                                     refresh=data.refresh if data.refresh is not None else 120,
+                                     content_type=data.content_type,
+                                     last_active=data.last_active,
                                      sender=message.sender, recipients=message.recipients, private=private)
             notification_center.post_notification('ChatStreamGotComposingIndication', sender=self, data=ndata)
         else:
@@ -0,0 +1,196 @@
+# Copyright (C) 2013 AG Projects. See LICENSE for details.
+#
+
+import unittest
+
+from StringIO import StringIO
+
+from application.notification import NotificationCenter
+
+try:
+    from sipsimple import addressbook
+except ImportError:
+    addressbook = None
+
+
+class URI(object):
+    def __init__(self, user, host, port=None, parameters={}):
+        self.user = user
+        self.host = host
+        self.port = port
+        self.parameters = parameters
+
+
+class ContactURI(object):
+    def __init__(self, uri):
+        self.uri = uri
+
+
+class Contact(object):
+    def __init__(self, id, *uris):
+        self.id = id
+        self.uris = [ContactURI(uri) for uri in uris]
+
+
+class GroupContacts(object):
+    def __init__(self, contacts):
+        self.contacts = contacts
+
+    def ids(self):
+        return [contact.id for contact in self.contacts]
+
+
+class Group(object):
+    def __init__(self, id, *contacts):
+        self.id = id
+        self.contacts = GroupContacts(list(contacts))
+
+
+@unittest.skipIf(addressbook is None, "the addressbook dependencies are not available")
+class NormalizeURITests(unittest.TestCase):
+    def assertNormalized(self, uris, expected):
+        for uri in uris:
+            self.assertEqual(addressbook.normalize_uri(uri), expected)
+
+    def test_sip_uri(self):
+        self.assertNormalized(['sip:alice@example.com', 'sips:alice@Example.COM', ' SIP:alice@example.com;transport=tls?subject=hi',
+                               'alice@example.com', URI('alice', 'EXAMPLE.com', parameters={'transport': 'tcp'})], u'sip:alice@example.com')
+        self.assertNotEqual(addressbook.normalize_uri('sip:Alice@example.com'), addressbook.normalize_uri('sip:alice@example.com'))
+
+    def test_port(self):
+        self.assertNormalized(['sip:alice@example.com:5061', 'sips:alice@example.com:5061;transport=tls', URI('alice', 'example.com', 5061)], u'sip:alice@example.com:5061')
+        self.assertNormalized(['sip:example.com:5060', URI(None, 'example.com', 5060)], u'sip:example.com:5060')
+        self.assertNotEqual(addressbook.normalize_uri('sip:alice@example.com:5061'), addressbook.normalize_uri('sip:alice@example.com'))
+
+    def test_telephone_number(self):
+        self.assertNormalized(['tel:+1-555-123-4567', 'TEL:+1 (555) 123.4567;phone-context=example.com', '+1 555 123 4567',
+                               'sip:+1-555-123-4567@example.com;user=phone', URI('+1-555-123-4567', 'example.com', parameters={'user': 'phone'})], u'tel:+15551234567')
+        self.assertEqual(addressbook.normalize_uri('sip:+15551234567@example.com'), u'sip:+15551234567@example.com')
+
+
+@unittest.skipIf(addressbook is None, "the addressbook dependencies are not available")
+class IndexTests(unittest.TestCase):
+    def setUp(self):
+        # the manager is a singleton, the tests use their own instance
+        self.manager = addressbook.AddressbookManager.__new__(addressbook.AddressbookManager)
+        self.manager.__init__()
+
+    def tearDown(self):
+        NotificationCenter().purge_observer(self.manager)
+
+    def post(self, name, sender):
+        NotificationCenter().post_notification(name, sender=sender)
+
+    def find_contacts(self, uri):
+        return sorted(contact.id for contact in self.manager.find_contacts(uri))
+
+    def find_groups(self, uri):
+        return sorted(group.id for group in self.manager.find_groups(uri))
+
+    def test_find_contacts(self):
+        alice = Contact('alice', 'sip:alice@example.com', 'tel:+1-555-123-4567')
+        other = Contact('other', 'sips:alice@EXAMPLE.com')
+        self.post('AddressbookContactWasActivated', alice)
+        self.post('AddressbookContactWasActivated', other)
+        self.assertEqual(self.find_contacts('alice@example.com'), ['alice', 'other'])
+        self.assertEqual(self.find_contacts(URI('alice', 'example.com')), ['alice', 'other'])
+        self.assertEqual(self.find_contacts('+1 (555) 123-4567'), ['alice'])
+        self.assertEqual(self.find_contacts('sip:bob@example.com'), [])
+
+    def test_contact_changes(self):
+        alice = Contact('alice', 'sip:alice@example.com')
+        self.post('AddressbookContactWasActivated', alice)
+        alice.uris = [ContactURI('sip:alice@example.org'), ContactURI(None)]
+        self.post('AddressbookContactDidChange', alice)
+        self.assertEqual(self.find_contacts('sip:alice@example.com'), [])
+        self.assertEqual(self.find_contacts('sip:alice@example.org'), ['alice'])
+        self.post('AddressbookContactWasDeleted', alice)
+        self.assertEqual(self.find_contacts('sip:alice@example.org'), [])
+        self.post('AddressbookContactDidChange', alice)
+        self.assertEqual(self.find_contacts('sip:alice@example.org'), [])
+
+    def test_find_groups(self):
+        alice = Contact('alice', 'sip:alice@example.com')
+        bob = Contact('bob', 'sip:bob@example.com')
+        friends = Group('friends', alice, bob)
+        work = Group('work', alice)
+        for contact in (alice, bob):
+            self.post('AddressbookContactWasActivated', contact)
+        for group in (friends, work):
+            self.post('AddressbookGroupWasActivated', group)
+        self.assertEqual(self.find_groups('sip:alice@example.com'), ['friends', 'work'])
+        self.assertEqual(self.find_groups('sip:bob@example.com'), ['friends'])
+        work.contacts = GroupContacts([bob])
+        self.post('AddressbookGroupDidChange', work)
+        self.assertEqual(self.find_groups('sip:alice@example.com'), ['friends'])
+        self.assertEqual(self.find_groups('sip:bob@example.com'), ['friends', 'work'])
+        self.post('AddressbookGroupWasDeleted', friends)
+        self.assertEqual(self.find_groups('sip:alice@example.com'), [])
+        self.assertEqual(self.find_groups('sip:bob@example.com'), ['work'])
+
+
+@unittest.skipIf(addressbook is None, "the addressbook dependencies are not available")
+class ReaderTests(unittest.TestCase):
+    def test_csv(self):
+        data = ('Name,SIP,Mobile\r\n'
+                'Alice,sip:alice@example.com,+1 555 123 4567\r\n'
+                ',, \r\n'
+                '"Bob, Jr.",sip:bob@example.com,\r\n'
+                'Carol\r\n'
+                '\xc3\x88mile,sip:emile@example.com\r\n')
+        self.assertEqual(list(addressbook.read_csv_contacts(StringIO(data))),
+                         [(u'Alice', [(u'sip:alice@example.com', u'SIP'), (u'+1 555 123 4567', u'Mobile')]),
+                          (u'Bob, Jr.', [(u'sip:bob@example.com', u'SIP')]),
+                          (u'\xc8mile', [(u'sip:emile@example.com', u'SIP')])])
+        self.assertEqual(list(addressbook.read_csv_contacts(StringIO(''))), [])
+
+    def test_csv_is_read_incrementally(self):
+        contacts = addressbook.read_csv_contacts(StringIO('name,sip\nAlice,sip:alice@example.com\nBob\0,sip:bob@example.com\n'))
+        self.assertEqual(next(contacts), (u'Alice', [(u'sip:alice@example.com', u'sip')]))
+        self.assertRaises(addressbook.csv.Error, next, contacts)
+
+    def test_vcard(self):
+        data = ('BEGIN:VCARD\r\n'
+                'VERSION:3.0\r\n'
+                'N:Smith;Alice;;;\r\n'
+                'FN:Alice Smith\\, PhD\r\n'
+                'TEL;TYPE=CELL,VOICE:+1 555 123 4567\r\n'
+                'item1.TEL:+1 555 765\r\n'
+                ' 4321\r\n'
+                'IMPP:sip:alice@example.com\r\n'
+                'IMPP:xmpp:alice@example.com\r\n'
+                'END:VCARD\r\n'
+                'BEGIN:VCARD\r\n'
+                'N:Jones;Bob\r\n'
+                'X-SIP;TYPE=WORK:SIPS:bob@example.com\r\n'
+                'END:VCARD\r\n'
+                'BEGIN:VCARD\r\n'
+                'FN:Carol\r\n'
+                'EMAIL:carol@example.com\r\n'
+                'END:VCARD\r\n'
+                'TEL:+1 555 000 0000\r\n')
+        self.assertEqual(list(addressbook.read_vcard_contacts(StringIO(data))),
+                         [(u'Alice Smith, PhD', [(u'+1 555 123 4567', u'Mobile'), (u'+1 555 7654321', u'Phone'), (u'sip:alice@example.com', u'SIP')]),
+                          (u'Bob Jones', [(u'SIPS:bob@example.com', u'SIP')])])
+
+    def test_resourcelists(self):
+        data = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<resource-lists xmlns="urn:ietf:params:xml:ns:resource-lists">'
+                '<list name="buddies">'
+                '<entry uri="sip:alice@example.com"><display-name>Alice</display-name></entry>'
+                '<list name="work"><entry uri="sip:bob@example.com"/></list>'
+                '<entry-ref ref="resource-lists/users/sip:alice@example.com/index/~~/resource-lists/list%5b@name=%22buddies%22%5d"/>'
+                '<entry uri="sip:\xc3\xa9mile@example.com"><display-name>\xc3\x89mile</display-name></entry>'
+                '</list></resource-lists>')
+        self.assertEqual(list(addressbook.read_resourcelists_contacts(StringIO(data))),
+                         [(u'Alice', [(u'sip:alice@example.com', u'SIP')]),
+                          (u'', [(u'sip:bob@example.com', u'SIP')]),
+                          (u'\xc9mile', [(u'sip:\xe9mile@example.com', u'SIP')])])
+
+    def test_resourcelists_syntax_error(self):
+        contacts = addressbook.read_resourcelists_contacts(StringIO('<resource-lists xmlns="urn:ietf:params:xml:ns:resource-lists"><list><entry uri="sip:alice@example.com"/><entry'))
+        self.assertRaises(addressbook.etree.XMLSyntaxError, list, contacts)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+# Copyright (C) 2013 AG Projects. See LICENSE for details.
+#
+
+import unittest
+
+from sipsimple.payloads import XMLDocument, XMLRootElement, XMLStringElement, XMLElementChild
+from sipsimple.payloads.resourcelists import Entry, ResourceListsDocument
+
+
+namespace = 'urn:ag-projects:xml:ns:sipsimple-tests'
+
+
+class OnsetDocument(XMLDocument):
+    content_type = 'application/x-sipsimple-tests+xml'
+
+OnsetDocument.register_namespace(namespace, prefix=None)
+
+
+class Note(XMLStringElement):
+    _xml_tag = 'note'
+    _xml_namespace = namespace
+    _xml_document = OnsetDocument
+
+
+class Status(XMLStringElement):
+    _xml_tag = 'status'
+    _xml_namespace = namespace
+    _xml_document = OnsetDocument
+
+
+class Person(XMLRootElement):
+    _xml_tag = 'person'
+    _xml_namespace = namespace
+    _xml_document = OnsetDocument
+    _xml_children_order = {Status.qname: 0, Note.qname: 1}
+
+    def _onset_status(self, descriptor, value):
+        self.status_history.append(None if value is None else value.value)
+    status = XMLElementChild('status', type=Status, required=False, test_equal=True, onset=_onset_status)
+    del _onset_status
+
+    note = XMLElementChild('note', type=Note, required=False, test_equal=True)
+
+    def __init__(self, status=None, note=None):
+        XMLRootElement.__init__(self)
+        self.status = status
+        self.note = note
+
+    @property
+    def status_history(self):
+        return self.__dict__.setdefault('_status_history', [])
+
+
+PERSON = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+          '<person xmlns="urn:ag-projects:xml:ns:sipsimple-tests"><status>busy</status><note>in a meeting</note></person>')
+
+RESOURCE_LISTS = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                  '<resource-lists xmlns="urn:ietf:params:xml:ns:resource-lists">'
+                  '<list name="buddies"><display-name>Buddies</display-name>'
+                  '<entry uri="sip:alice@example.com"><display-name>Alice</display-name></entry>'
+                  '<entry uri="sip:bob@example.com"/>'
+                  '<list name="work"><entry uri="sip:carol@example.com"><display-name>Carol</display-name></entry></list>'
+                  '</list></resource-lists>')
+
+
+class LazyParsingTests(unittest.TestCase):
+    def parse(self, document_class, document, lazy):
+        saved_lazy = document_class.lazy
+        document_class.lazy = lazy
+        try:
+            return document_class.parse(document, validate=False)
+        finally:
+            document_class.lazy = saved_lazy
+
+    def test_onset_hooks(self):
+        eager = self.parse(OnsetDocument, PERSON, lazy=False)
+        lazy = self.parse(OnsetDocument, PERSON, lazy=True)
+        self.assertEqual(lazy.status_history, eager.status_history)
+        self.assertEqual(lazy.status_history, [u'busy'])
+        self.assertEqual(lazy.note, eager.note)
+        self.assertEqual(lazy.status_history, [u'busy'])
+        lazy.status = u'away'
+        self.assertEqual(lazy.status_history, [u'busy', u'away'])
+
+    def test_same_contents(self):
+        eager = self.parse(ResourceListsDocument, RESOURCE_LISTS, lazy=False)
+        lazy = self.parse(ResourceListsDocument, RESOURCE_LISTS, lazy=True)
+        self.assertEqual(lazy, eager)
+        self.assertEqual(lazy.toxml(), eager.toxml())
+        eager_list, lazy_list = eager['buddies'], lazy['buddies']
+        self.assertEqual(lazy_list.display_name, eager_list.display_name)
+        self.assertEqual([entry.uri for entry in lazy_list if isinstance(entry, Entry)], [entry.uri for entry in eager_list if isinstance(entry, Entry)])
+        self.assertEqual([entry.display_name for entry in lazy_list if isinstance(entry, Entry)], [entry.display_name for entry in eager_list if isinstance(entry, Entry)])
+
+    def test_clean_after_access(self):
+        lazy = self.parse(ResourceListsDocument, RESOURCE_LISTS, lazy=True)
+        lazy['buddies'].display_name
+        self.assertFalse(lazy.__dirty__)
+        lazy['buddies'].display_name = u'Friends'
+        self.assertTrue(lazy.__dirty__)
+        self.assertTrue('>Friends</rl:display-name>' in lazy.toxml())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+# Copyright (C) 2013 AG Projects. See LICENSE for details.
+#
+
+import email
+import unittest
+
+from sipsimple.payloads import ParserError
+from sipsimple.payloads.rlsnotify import MultipartMessage, RLSNotify, RLSState
+
+
+BOUNDARY = '50UBfW7LSCVLtggUPe5z'
+
+PIDF = ('<?xml version="1.0" encoding="UTF-8"?>\r\n'
+        '<presence xmlns="urn:ietf:params:xml:ns:pidf" entity="%s">'
+        '<tuple id="t1"><status><basic>%s</basic></status></tuple>'
+        '</presence>')
+
+
+def make_notify(resources, version=0, full_state=True):
+    """Build a RLS notification from a list of (uri, state, basic status) tuples"""
+    rlmi = ['<?xml version="1.0" encoding="UTF-8"?>\r\n<list xmlns="urn:ietf:params:xml:ns:rlmi" uri="sip:rls@example.com" version="%d" fullState="%s">' % (version, 'true' if full_state else 'false')]
+    parts = []
+    for index, (uri, state, status) in enumerate(resources):
+        cid = 'cid%d@example.com' % index
+        if state == 'terminated':
+            rlmi.append('<resource uri="%s"><instance id="i%d" state="terminated" reason="rejected"/></resource>' % (uri, index))
+        else:
+            rlmi.append('<resource uri="%s"><instance id="i%d" state="%s" cid="%s"/></resource>' % (uri, index, state, cid))
+            parts.append((cid, PIDF % (uri, status)))
+    rlmi.append('</list>')
+    body = ['--%s\r\nContent-ID: <root@example.com>\r\nContent-Type: application/rlmi+xml;charset="UTF-8"\r\n\r\n%s\r\n' % (BOUNDARY, ''.join(rlmi))]
+    for cid, pidf in parts:
+        body.append('--%s\r\nContent-ID: <%s>\r\nContent-Type: application/pidf+xml;charset="UTF-8"\r\n\r\n%s\r\n' % (BOUNDARY, cid, pidf))
+    body.append('--%s--\r\n' % BOUNDARY)
+    content_type = 'multipart/related;type="application/rlmi+xml";start="<root@example.com>";boundary="%s"' % BOUNDARY
+    return 'Content-Type: %s\r\n\r\n%s' % (content_type, ''.join(body))
+
+
+class MultipartMessageTests(unittest.TestCase):
+    def test_parts(self):
+        payload = ('Content-Type: multipart/related; type="application/rlmi+xml"; start="<root@example.com>"; boundary=simple\r\n\r\n'
+                   'preamble\r\n'
+                   '--simple\r\nContent-ID: <root@example.com>\r\nContent-Type: application/rlmi+xml\r\n\r\nfirst\r\nbody\r\n'
+                   '--simple  \r\nContent-ID: <second@example.com>\r\n\r\nsecond body\r\n'
+                   '--simple--\r\nepilogue\r\n')
+        message = MultipartMessage.parse(payload)
+        self.assertEqual(message.get_content_type(), 'multipart/related')
+        self.assertEqual(message.get_param('type'), 'application/rlmi+xml')
+        self.assertEqual(message.get_param('start'), '<root@example.com>')
+        self.assertEqual(message.get_param('missing', 'default'), 'default')
+        parts = message.get_payload()
+        self.assertEqual(len(parts), 2)
+        self.assertEqual(parts[0]['Content-ID'], '<root@example.com>')
+        self.assertEqual(parts[0].get_content_type(), 'application/rlmi+xml')
+        self.assertEqual(parts[0].get_payload(), 'first\r\nbody')
+        self.assertEqual(parts[1]['content-id'], '<second@example.com>')
+        self.assertEqual(parts[1].get_content_type(), 'text/plain')
+        self.assertEqual(parts[1].get_payload(), 'second body')
+
+    def test_matches_email_parser(self):
+        payload = make_notify([('sip:alice@example.com', 'active', 'open'), ('sip:bob@example.com', 'active', 'closed')])
+        message = MultipartMessage.parse(payload)
+        email_message = email.message_from_string(payload)
+        self.assertEqual(message.get_content_type(), email_message.get_content_type())
+        self.assertEqual(message.get_param('boundary'), email_message.get_param('boundary'))
+        self.assertEqual([(part['Content-ID'], part.get_content_type(), part.get_payload()) for part in message.get_payload()],
+                         [(part['Content-ID'], part.get_content_type(), part.get_payload()) for part in email_message.get_payload()])
+
+    def test_line_feeds(self):
+        payload = 'Content-Type: multipart/mixed; boundary="a b"\n\n--a b\nContent-Type: text/plain;\n charset=utf-8\n\nbody\n--a b--\n'
+        parts = MultipartMessage.parse(payload).get_payload()
+        self.assertEqual(len(parts), 1)
+        self.assertEqual(parts[0]['Content-Type'], 'text/plain; charset=utf-8')
+        self.assertEqual(parts[0].get_payload(), 'body')
+
+    def test_part_without_headers(self):
+        parts = MultipartMessage.parse('Content-Type: multipart/mixed; boundary=b\r\n\r\n--b\r\n\r\nbody\r\n--b--\r\n').get_payload()
+        self.assertEqual(parts[0].headers, {})
+        self.assertEqual(parts[0].get_payload(), 'body')
+
+    def test_boundary_inside_line(self):
+        parts = MultipartMessage.parse('Content-Type: multipart/mixed; boundary=b\r\n\r\n--b\r\n\r\nnot a --b delimiter\r\n--b--\r\n').get_payload()
+        self.assertEqual(len(parts), 1)
+        self.assertEqual(parts[0].get_payload(), 'not a --b delimiter')
+
+    def test_quoted_parameters(self):
+        content_type, parameters = MultipartMessage.parse_content_type('Multipart/Related; Boundary="quoted \\"boundary\\""; type=text/plain')
+        self.assertEqual(content_type, 'multipart/related')
+        self.assertEqual(parameters, {'boundary': 'quoted "boundary"', 'type': 'text/plain'})
+
+    def test_not_multipart(self):
+        message = MultipartMessage.parse('Content-Type: application/pidf+xml\r\n\r\n<presence/>')
+        self.assertEqual(message.get_content_type(), 'application/pidf+xml')
+        self.assertEqual(message.get_payload(), [])
+
+    def test_missing_close_delimiter(self):
+        self.assertRaises(ParserError, MultipartMessage.parse, 'Content-Type: multipart/mixed; boundary=b\r\n\r\n--b\r\n\r\nbody')
+
+    def test_invalid_header(self):
+        self.assertRaises(ParserError, MultipartMessage.parse, 'Content-Type: multipart/mixed; boundary=b\r\n\r\n--b\r\ninvalid header\r\n\r\nbody\r\n--b--\r\n')
+
+
+class RLSStateTests(unittest.TestCase):
+    def setUp(self):
+        self.state = RLSState()
+
+    def apply(self, resources, version=0, full_state=True):
+        rls_notify = RLSNotify.parse(make_notify(resources, version, full_state), pidf_cache=self.state.pidf_cache)
+        return self.state.update(rls_notify)
+
+    def test_full_state(self):
+        modified, removed = self.apply([('sip:alice@example.com', 'active', 'open'), ('sip:bob@example.com', 'active', 'closed')])
+        self.assertEqual(sorted(modified), ['sip:alice@example.com', 'sip:bob@example.com'])
+        self.assertEqual(removed, {})
+        self.assertEqual(len(self.state), 2)
+        self.assertEqual(len(self.state.pidf_cache), 2)
+        modified, removed = self.apply([('sip:alice@example.com', 'active', 'open')], version=1)
+        self.assertEqual(modified, {})
+        self.assertEqual(list(removed), ['sip:bob@example.com'])
+        self.assertEqual(len(self.state.pidf_cache), 1)
+
+    def test_partial_state_reuses_unchanged_documents(self):
+        self.apply([('sip:alice@example.com', 'active', 'open'), ('sip:bob@example.com', 'active', 'open')])
+        alice = self.state['sip:alice@example.com']
+        modified, removed = self.apply([('sip:alice@example.com', 'active', 'open'), ('sip:bob@example.com', 'active', 'closed')], version=1, full_state=False)
+        self.assertEqual(list(modified), ['sip:bob@example.com'])
+        self.assertEqual(removed, {})
+        self.assertTrue(self.state['sip:alice@example.com'] is alice)
+        # the document of the previous bob state is no longer referenced
+        self.assertEqual(len(self.state.pidf_cache), 2)
+
+    def test_partial_state_removes_terminated_resources(self):
+        self.apply([('sip:alice@example.com', 'active', 'open'), ('sip:bob@example.com', 'active', 'open')])
+        modified, removed = self.apply([('sip:bob@example.com', 'terminated', None)], version=1, full_state=False)
+        self.assertEqual(modified, {})
+        self.assertEqual(list(removed), ['sip:bob@example.com'])
+        self.assertFalse('sip:bob@example.com' in self.state)
+        self.assertEqual(len(self.state), 1)
+        self.assertEqual(len(self.state.pidf_cache), 1)
+
+    def test_discard(self):
+        self.apply([('sip:alice@example.com', 'active', 'open')])
+        rls_notify = RLSNotify.parse(make_notify([('sip:alice@example.com', 'active', 'closed')], version=1, full_state=False), pidf_cache=self.state.pidf_cache)
+        self.assertEqual(len(self.state.pidf_cache), 2)
+        self.state.discard(rls_notify)
+        self.assertEqual(len(self.state.pidf_cache), 1)
+        self.assertEqual(len(self.state), 1)
+
+    def test_clear(self):
+        self.apply([('sip:alice@example.com', 'active', 'open')])
+        self.state.clear()
+        self.assertEqual(len(self.state), 0)
+        self.assertEqual(len(self.state.pidf_cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
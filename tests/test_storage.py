@@ -0,0 +1,168 @@
+# Copyright (C) 2013 AG Projects. See LICENSE for details.
+#
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+try:
+    from sipsimple.account.xcap.storage import XCAPStorageError
+    from sipsimple.account.xcap.storage.sqlite import SQLiteDatabase, SQLiteStorage
+    from sipsimple.storage import FileStorage
+except ImportError:
+    SQLiteDatabase = None
+
+
+@unittest.skipIf(SQLiteDatabase is None, "the storage dependencies are not available")
+class SQLiteStorageTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = SQLiteDatabase(os.path.join(self.directory, 'xcap.db'))
+        self.storage = SQLiteStorage(self.database, 'alice@example.com')
+
+    def tearDown(self):
+        self.database.connection.close()
+        shutil.rmtree(self.directory)
+
+    def test_save_and_load(self):
+        self.storage.save('index', 'first')
+        self.storage.save('index', 'second')
+        self.assertEqual(self.storage.load('index'), 'second')
+        self.assertRaises(XCAPStorageError, self.storage.load, 'missing')
+
+    def test_append(self):
+        self.storage.append('journal', 'one')
+        self.storage.append('journal', '')
+        self.storage.append('journal', 'two\0three')
+        self.assertEqual(self.storage.load('journal'), 'onetwo\0three')
+        self.assertEqual(self.database.connection.execute('SELECT count(*) FROM xcap WHERE name=?', ('journal',)).fetchone()[0], 3)
+        self.storage.save('journal', 'four')
+        self.assertEqual(self.storage.load('journal'), 'four')
+        self.assertEqual(self.database.connection.execute('SELECT count(*) FROM xcap WHERE name=?', ('journal',)).fetchone()[0], 1)
+
+    def test_delete(self):
+        self.storage.append('journal', 'one')
+        self.storage.append('journal', 'two')
+        self.storage.save('index', 'data')
+        self.storage.delete('journal')
+        self.storage.delete('missing')
+        self.assertRaises(XCAPStorageError, self.storage.load, 'journal')
+        self.assertEqual(self.storage.load('index'), 'data')
+
+    def test_accounts_are_separate(self):
+        bob = SQLiteStorage(self.database, 'bob@example.com')
+        self.storage.save('index', 'alice')
+        bob.save('index', 'bob')
+        self.storage.purge()
+        self.assertRaises(XCAPStorageError, self.storage.load, 'index')
+        self.assertEqual(bob.load('index'), 'bob')
+
+    def test_data_is_kept(self):
+        self.storage.append('journal', 'one')
+        self.storage.append('journal', 'two')
+        self.database.connection.close()
+        self.database = SQLiteDatabase(self.database.filename)
+        self.assertEqual(SQLiteStorage(self.database, 'alice@example.com').load('journal'), 'onetwo')
+
+    def test_transaction(self):
+        self.storage.save('index', 'old')
+        with self.storage.transaction():
+            self.storage.save('index', 'new')
+            with self.storage.transaction():
+                self.storage.append('journal', 'one')
+            self.assertFalse(self.other_connection().execute('SELECT count(*) FROM xcap WHERE name=?', ('journal',)).fetchone()[0])
+        self.assertEqual(str(self.other_connection().execute('SELECT data FROM xcap WHERE name=?', ('index',)).fetchone()[0]), 'new')
+        self.assertEqual(self.storage.load('journal'), 'one')
+
+    def test_failed_transaction(self):
+        self.database.connection.execute("CREATE TRIGGER fail BEFORE INSERT ON xcap WHEN NEW.name='fail' BEGIN SELECT RAISE(ABORT, 'failed'); END")
+        self.storage.save('index', 'old')
+        with self.assertRaises(XCAPStorageError):
+            with self.storage.transaction():
+                self.storage.save('index', 'new')
+                self.assertRaises(XCAPStorageError, self.storage.append, 'fail', 'data')
+                self.storage.append('journal', 'one')
+        self.assertEqual(self.storage.load('index'), 'old')
+        self.assertRaises(XCAPStorageError, self.storage.load, 'journal')
+        with self.assertRaises(ValueError):
+            with self.storage.transaction():
+                self.storage.save('index', 'new')
+                raise ValueError
+        self.assertEqual(self.storage.load('index'), 'old')
+        self.storage.save('index', 'new')
+        self.assertEqual(self.storage.load('index'), 'new')
+
+    def other_connection(self):
+        connection = sqlite3.connect(self.database.filename)
+        self.addCleanup(connection.close)
+        return connection
+
+
+@unittest.skipIf(SQLiteDatabase is None, "the storage dependencies are not available")
+class MigrationTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.write_file('alice@example.com', 'index', 'file data')
+        self.write_file('alice@example.com', 'index.1234.0123ABCD', 'temporary data')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_file(self, account_id, name, data):
+        directory = os.path.join(self.directory, 'xcap', account_id)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, name), 'wb') as file:
+            file.write(data)
+
+    def open_storage(self):
+        storage = FileStorage(self.directory, xcap_storage='sqlite')
+        return storage.xcap_storage_factory('alice@example.com')
+
+    def test_import(self):
+        storage = self.open_storage()
+        self.assertTrue(storage.database.imported)
+        self.assertEqual(storage.load('index'), 'file data')
+        self.assertRaises(XCAPStorageError, storage.load, 'index.1234.0123ABCD')
+        storage.save('index', 'database data')
+        storage.database.connection.close()
+        self.write_file('alice@example.com', 'journal', 'file data')
+        storage = self.open_storage()
+        self.assertEqual(storage.load('index'), 'database data')
+        self.assertRaises(XCAPStorageError, storage.load, 'journal')
+        storage.database.connection.close()
+
+    def test_failed_import_is_retried(self):
+        database = SQLiteDatabase(os.path.join(self.directory, 'xcap.db'))
+        self.assertFalse(database.imported)
+        SQLiteStorage(database, 'alice@example.com').save('journal', 'database data')
+        database.connection.close()
+        self.write_file('alice@example.com', 'journal', 'file data')
+        storage = self.open_storage()
+        self.assertTrue(storage.database.imported)
+        self.assertEqual(storage.load('index'), 'file data')
+        self.assertEqual(storage.load('journal'), 'database data')
+        storage.database.connection.close()
+
+    def test_failed_import_does_not_stop_start(self):
+        def import_directory(database, directory):
+            raise XCAPStorageError("failed to import XCAP data from %s" % directory)
+        original_import_directory = SQLiteDatabase.import_directory
+        SQLiteDatabase.import_directory = import_directory
+        try:
+            storage = self.open_storage()
+        finally:
+            SQLiteDatabase.import_directory = original_import_directory
+        self.assertFalse(storage.database.imported)
+        self.assertRaises(XCAPStorageError, storage.load, 'index')
+        storage.database.connection.close()
+        storage = self.open_storage()
+        self.assertTrue(storage.database.imported)
+        self.assertEqual(storage.load('index'), 'file data')
+        storage.database.connection.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,255 @@
+# Copyright (C) 2013 AG Projects. See LICENSE for details.
+#
+
+import cPickle
+import re
+import unittest
+
+from lxml import etree
+
+from sipsimple.payloads import resourcelists
+
+try:
+    from sipsimple.account import xcap
+    from sipsimple.account.xcap.storage import XCAPStorageError
+    from sipsimple.account.xcap.storage.memory import MemoryStorage
+except ImportError:
+    xcap = None
+
+
+@unittest.skipIf(xcap is None, "the XCAP manager dependencies are not available")
+class JournalTests(unittest.TestCase):
+    def setUp(self):
+        self.manager = self.create_manager(MemoryStorage('alice@example.com'))
+
+    @staticmethod
+    def create_manager(storage):
+        manager = xcap.XCAPManager.__new__(xcap.XCAPManager)
+        manager.storage = storage
+        manager.journal = []
+        manager.unsaved_operations = []
+        return manager
+
+    def assertSameOperations(self, operations, expected_operations):
+        self.assertEqual([(type(operation), operation.__dict__) for operation in operations], [(type(operation), operation.__dict__) for operation in expected_operations])
+
+    def test_append_and_load(self):
+        first = [xcap.AddGroupOperation(group={'id': 'g1', 'name': u'Friends'}), xcap.AddContactOperation(contact={'id': 'c1', 'name': u'Alice'})]
+        second = [xcap.AddGroupMemberOperation(group={'id': 'g1'}, contact={'id': 'c1'})]
+        self.manager._append_journal(first)
+        self.manager._append_journal(second)
+        self.assertSameOperations(self.manager._load_journal(), first + second)
+
+    def test_incomplete_operation_is_ignored(self):
+        operations = [xcap.AddContactOperation(contact={'id': 'c%d' % index}) for index in range(3)]
+        self.manager._append_journal(operations)
+        data = self.manager.storage.load('journal')
+        for length in (len(data) - 1, len(data) - 10):
+            self.manager.storage.save('journal', data[:length])
+            self.assertSameOperations(self.manager._load_journal(), operations[:2])
+        self.manager.storage.save('journal', data[:2])
+        self.assertEqual(self.manager._load_journal(), [])
+
+    def test_empty_journal(self):
+        self.manager.storage.save('journal', '')
+        self.assertEqual(self.manager._load_journal(), [])
+
+    def test_missing_journal(self):
+        self.assertRaises(XCAPStorageError, self.manager._load_journal)
+
+    def test_old_format(self):
+        operations = [xcap.AddContactOperation(contact={'id': 'c1'}), xcap.RemoveContactOperation(contact={'id': 'c2'})]
+        self.manager.storage.save('journal', cPickle.dumps(operations))
+        self.assertSameOperations(self.manager._load_journal(), operations)
+
+    def test_save_rewrites_the_journal(self):
+        operations = [xcap.AddContactOperation(contact={'id': 'c%d' % index}) for index in range(4)]
+        self.manager._append_journal(operations)
+        self.manager.journal = operations[2:]
+        self.manager.unsaved_operations = operations[3:]
+        self.manager._save_journal()
+        self.assertEqual(self.manager.unsaved_operations, [])
+        self.assertSameOperations(self.manager._load_journal(), operations[2:])
+
+    def test_storage_errors_are_ignored(self):
+        class FailingStorage(MemoryStorage):
+            def append(self, name, data):
+                raise XCAPStorageError("cannot append to %s" % name)
+            def save(self, name, data):
+                raise XCAPStorageError("cannot save %s" % name)
+        manager = self.create_manager(FailingStorage('alice@example.com'))
+        manager.journal = [xcap.NormalizeOperation()]
+        manager._append_journal(manager.journal)
+        manager._save_journal()
+
+
+class Response(str):
+    def __new__(cls, data, etag):
+        instance = str.__new__(cls, data)
+        instance.etag = etag
+        return instance
+
+
+class XCAPClient(object):
+    def __init__(self):
+        self.requests = []
+
+    def put(self, application, data, node=None, etag=None, **kw):
+        self.requests.append((node, data, etag))
+        return Response('', etag='etag-%d' % len(self.requests))
+
+    def delete(self, application, node=None, etag=None, **kw):
+        self.requests.append((node, None, etag))
+        return Response('', etag='etag-%d' % len(self.requests))
+
+
+class XCAPManager(object):
+    def __init__(self):
+        self.client = XCAPClient()
+        self.storage = MemoryStorage('alice@example.com')
+
+
+RESOURCE_LISTS = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                  '<resource-lists xmlns="urn:ietf:params:xml:ns:resource-lists">'
+                  '<list name="buddies">'
+                  '<entry uri="sip:alice@example.com"><display-name>Alice</display-name></entry>'
+                  '<entry uri="sip:bob@example.com"><display-name>Bob</display-name></entry>'
+                  '</list></resource-lists>')
+
+
+@unittest.skipIf(xcap is None, "the XCAP manager dependencies are not available")
+class NodeUpdateTests(unittest.TestCase):
+    def setUp(self):
+        self.manager = XCAPManager()
+        self.document = xcap.ResourceListsDocument(self.manager)
+        self.document.content = resourcelists.ResourceListsDocument.parse(RESOURCE_LISTS)
+        self.document.etag = 'fetched'
+
+    def upload(self):
+        # make the server copy of the document the one that we serialize, as after a document PUT
+        self.document.dirty = True
+        xcap.Document.update(self.document)
+        self.server_document = self.manager.client.requests[-1][1]
+        del self.manager.client.requests[:]
+
+    def select(self, node_selector):
+        # evaluate the node selector on the server copy of the document, the default namespace needs a prefix in XPath
+        xpath = re.sub(r'/(?=[a-z])', '/rl:', node_selector)
+        return etree.XML(self.server_document).xpath(xpath, namespaces={'rl': resourcelists.namespace})
+
+    def test_fetched_document_is_uploaded_whole(self):
+        alice = self.document.content['buddies'][resourcelists.Entry, u'sip:alice@example.com']
+        alice.display_name = u'Alice Smith'
+        xcap.Document.update(self.document)
+        self.assertEqual(len(self.manager.client.requests), 1)
+        node, data, etag = self.manager.client.requests[0]
+        self.assertEqual(node, None)
+        self.assertEqual(etag, 'fetched')
+
+    def test_entry_node_update(self):
+        self.upload()
+        alice = self.document.content['buddies'][resourcelists.Entry, u'sip:alice@example.com']
+        alice.display_name = u'Alice Smith'
+        xcap.Document.update(self.document)
+        self.assertEqual(len(self.manager.client.requests), 1)
+        node, data, etag = self.manager.client.requests[0]
+        self.assertEqual(node, '/resource-lists/list[@name="buddies"]/entry[@uri="sip%3Aalice%40example.com"]')
+        self.assertEqual(etag, 'etag-1')
+        selected = self.select(node)
+        self.assertEqual(len(selected), 1)
+        self.assertEqual(resourcelists.Entry.from_element(selected[0]).uri, u'sip:alice@example.com')
+        self.assertEqual(resourcelists.Entry.from_element(etree.XML(data)).display_name, u'Alice Smith')
+        self.assertFalse(self.document.dirty)
+
+    def test_added_entry_node_update(self):
+        self.upload()
+        self.document.content['buddies'].add(resourcelists.Entry(u'sip:carol@example.com', display_name=u'Carol'))
+        xcap.Document.update(self.document)
+        self.assertEqual(len(self.manager.client.requests), 1)
+        node, data, etag = self.manager.client.requests[0]
+        self.assertEqual(node, '/resource-lists/list[@name="buddies"]/entry[@uri="sip%3Acarol%40example.com"]')
+        self.assertEqual(len(self.select(node[:node.rindex('/')])), 1)
+        self.assertEqual(self.select(node), [])
+        self.assertEqual(resourcelists.Entry.from_element(etree.XML(data)).display_name, u'Carol')
+        self.assertFalse(self.document.dirty)
+
+    def test_removed_entry_node_update(self):
+        self.upload()
+        buddies = self.document.content['buddies']
+        buddies.remove(buddies[resourcelists.Entry, u'sip:bob@example.com'])
+        buddies.add(resourcelists.Entry(u'sip:carol@example.com'))
+        xcap.Document.update(self.document)
+        self.assertEqual(len(self.manager.client.requests), 2)
+        node, data, etag = self.manager.client.requests[0]
+        self.assertEqual(node, '/resource-lists/list[@name="buddies"]/entry[@uri="sip%3Abob%40example.com"]')
+        self.assertEqual(data, None)
+        self.assertEqual(etag, 'etag-1')
+        self.assertEqual(len(self.select(node)), 1)
+        node, data, etag = self.manager.client.requests[1]
+        self.assertEqual(node, '/resource-lists/list[@name="buddies"]/entry[@uri="sip%3Acarol%40example.com"]')
+        self.assertFalse(self.document.dirty)
+
+    def test_added_and_removed_entry(self):
+        self.upload()
+        buddies = self.document.content['buddies']
+        carol = resourcelists.Entry(u'sip:carol@example.com')
+        buddies.add(carol)
+        buddies.remove(carol)
+        xcap.Document.update(self.document)
+        self.assertEqual(len(self.manager.client.requests), 1)
+        node, data, etag = self.manager.client.requests[0]
+        self.assertEqual(node, '/resource-lists/list[@name="buddies"]')
+        self.assertEqual([entry.uri for entry in resourcelists.List.from_element(etree.XML(data))], [u'sip:alice@example.com', u'sip:bob@example.com'])
+
+    def test_list_node_update(self):
+        self.upload()
+        buddies = self.document.content['buddies']
+        buddies.display_name = u'Buddies'
+        buddies.add(resourcelists.Entry(u'sip:carol@example.com'))
+        xcap.Document.update(self.document)
+        self.assertEqual(len(self.manager.client.requests), 1)
+        node, data, etag = self.manager.client.requests[0]
+        self.assertEqual(node, '/resource-lists/list[@name="buddies"]')
+        self.assertEqual([entry.uri for entry in resourcelists.List.from_element(etree.XML(data))], [u'sip:alice@example.com', u'sip:bob@example.com', u'sip:carol@example.com'])
+
+
+@unittest.skipIf(xcap is None, "the XCAP manager dependencies are not available")
+class CacheTests(unittest.TestCase):
+    def setUp(self):
+        self.manager = XCAPManager()
+        self.document = xcap.ResourceListsDocument(self.manager)
+
+    def test_missing_etag(self):
+        self.document.save_to_cache(RESOURCE_LISTS)
+        header = self.manager.storage.load(self.document.name).split('\n', 1)[0]
+        self.assertTrue(header.endswith(' '))
+        self.document.load_from_cache()
+        self.assertEqual(self.document.etag, None)
+
+    def test_cached_document_is_parsed_lazily(self):
+        self.document.etag = 'cached'
+        self.document.save_to_cache(RESOURCE_LISTS)
+        self.document.load_from_cache()
+        self.assertEqual(self.document.etag, 'cached')
+        self.assertFalse(self.document.dirty)
+        self.document.dirty = False
+        self.assertTrue('cached_document' in self.document.__dict__)
+        self.assertEqual([entry.uri for entry in self.document.content['buddies']], [u'sip:alice@example.com', u'sip:bob@example.com'])
+        self.assertFalse('cached_document' in self.document.__dict__)
+        self.assertFalse(self.document.dirty)
+
+    def test_update_is_cached_with_save_update(self):
+        self.document.content = resourcelists.ResourceListsDocument.parse(RESOURCE_LISTS)
+        self.document.dirty = True
+        xcap.Document.update(self.document)
+        self.assertRaises(XCAPStorageError, self.manager.storage.load, self.document.name)
+        self.document.save_update()
+        self.document.save_update()
+        self.document.content = None
+        self.document.load_from_cache()
+        self.assertEqual(self.document.etag, 'etag-1')
+        self.assertEqual([entry.uri for entry in self.document.content['buddies']], [u'sip:alice@example.com', u'sip:bob@example.com'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# Copyright (C) 2013 AG Projects. See LICENSE for details.
+#
+
+import unittest
+
+from lxml import etree
+
+from sipsimple.payloads import xcapdiff
+
+
+RL = 'urn:ietf:params:xml:ns:resource-lists'
+
+RESOURCE_LISTS = ('<resource-lists xmlns="urn:ietf:params:xml:ns:resource-lists">'
+                  '<list name="buddies">'
+                  '<entry uri="sip:alice@example.com"><display-name>Alice</display-name></entry>'
+                  '<entry uri="sip:bob@example.com"><display-name>Bob</display-name></entry>'
+                  '</list></resource-lists>')
+
+
+def make_diff(operations, previous_etag='etag-1', new_etag='etag-2'):
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<xcap-diff xmlns="urn:ietf:params:xml:ns:xcap-diff" xmlns:rl="urn:ietf:params:xml:ns:resource-lists" xcap-root="https://xcap.example.com/xcap-root/">'
+            '<document sel="resource-lists/users/sip:alice@example.com/index" previous-etag="%s" new-etag="%s">%s</document>'
+            '</xcap-diff>' % (previous_etag, new_etag, operations))
+
+
+class PatchTests(unittest.TestCase):
+    def setUp(self):
+        self.root = etree.fromstring(RESOURCE_LISTS)
+
+    def patch(self, operations):
+        diff = xcapdiff.XCAPDiffDocument.parse(make_diff(operations), validate=False)
+        document, = list(diff)
+        document.apply_patch(self.root)
+        return document
+
+    def uris(self):
+        return [entry.get('uri') for entry in self.root.iterfind('{%s}list/{%s}entry' % (RL, RL))]
+
+    def test_document_attributes(self):
+        document = self.patch('')
+        self.assertEqual(document.previous_etag, 'etag-1')
+        self.assertEqual(document.new_etag, 'etag-2')
+        self.assertFalse(document.empty_body)
+        self.assertEqual(document.patch_operations, [])
+        self.assertEqual(etree.tostring(self.root), RESOURCE_LISTS)
+
+    def test_add_element(self):
+        self.patch('<add sel="rl:resource-lists/rl:list[@name=\'buddies\']"><rl:entry uri="sip:carol@example.com"/></add>')
+        self.assertEqual(self.uris(), ['sip:alice@example.com', 'sip:bob@example.com', 'sip:carol@example.com'])
+
+    def test_add_element_positions(self):
+        self.patch('<add sel="rl:resource-lists/rl:list/rl:entry[@uri=\'sip:bob@example.com\']" pos="before"><rl:entry uri="sip:carol@example.com"/></add>'
+                   '<add sel="rl:resource-lists/rl:list/rl:entry[@uri=\'sip:bob@example.com\']" pos="after"><rl:entry uri="sip:dave@example.com"/></add>'
+                   '<add sel="rl:resource-lists/rl:list" pos="prepend"><rl:entry uri="sip:erin@example.com"/></add>')
+        self.assertEqual(self.uris(), ['sip:erin@example.com', 'sip:alice@example.com', 'sip:carol@example.com', 'sip:bob@example.com', 'sip:dave@example.com'])
+
+    def test_add_attribute(self):
+        self.patch('<add sel="rl:resource-lists/rl:list[@name=\'buddies\']" type="@display">Buddies</add>')
+        self.assertEqual(self.root[0].get('display'), 'Buddies')
+
+    def test_default_namespace_selector(self):
+        self.patch('<xd:add xmlns:xd="urn:ietf:params:xml:ns:xcap-diff" xmlns="urn:ietf:params:xml:ns:resource-lists" '
+                   'sel="resource-lists/list[@name=\'buddies\']/entry[display-name=\'Bob\']" pos="after"><entry uri="sip:carol@example.com"/></xd:add>')
+        self.assertEqual(self.uris(), ['sip:alice@example.com', 'sip:bob@example.com', 'sip:carol@example.com'])
+
+    def test_replace_element(self):
+        self.patch('<replace sel="rl:resource-lists/rl:list/rl:entry[@uri=\'sip:alice@example.com\']"><rl:entry uri="sip:alice@example.org"/></replace>')
+        self.assertEqual(self.uris(), ['sip:alice@example.org', 'sip:bob@example.com'])
+
+    def test_replace_attribute_and_text(self):
+        self.patch('<replace sel="rl:resource-lists/rl:list/@name">friends</replace>'
+                   '<replace sel="rl:resource-lists/rl:list/rl:entry[@uri=\'sip:bob@example.com\']/rl:display-name/text()">Robert</replace>')
+        self.assertEqual(self.root[0].get('name'), 'friends')
+        self.assertEqual(self.root.findtext('{%s}list/{%s}entry[2]/{%s}display-name' % (RL, RL, RL)), 'Robert')
+
+    def test_remove_element_and_attribute(self):
+        self.patch('<remove sel="rl:resource-lists/rl:list/rl:entry[@uri=\'sip:alice@example.com\']"/>'
+                   '<remove sel="rl:resource-lists/rl:list/@name"/>')
+        self.assertEqual(self.uris(), ['sip:bob@example.com'])
+        self.assertEqual(self.root[0].get('name'), None)
+
+    def test_operations_are_applied_in_order(self):
+        self.patch('<add sel="rl:resource-lists/rl:list"><rl:entry uri="sip:carol@example.com"/></add>'
+                   '<remove sel="rl:resource-lists/rl:list/rl:entry[@uri=\'sip:carol@example.com\']"/>')
+        self.assertEqual(self.uris(), ['sip:alice@example.com', 'sip:bob@example.com'])
+
+    def test_unmatched_selector(self):
+        self.assertRaises(ValueError, self.patch, '<remove sel="rl:resource-lists/rl:list/rl:entry[@uri=\'sip:carol@example.com\']"/>')
+        self.assertRaises(ValueError, self.patch, '<remove sel="rl:resource-lists/rl:list/rl:entry"/>')
+
+    def test_illegal_operations(self):
+        self.assertRaises(ValueError, self.patch, '<remove sel="rl:resource-lists"/>')
+        self.assertRaises(ValueError, self.patch, '<add sel="rl:resource-lists/rl:list" pos="middle"><rl:entry uri="sip:carol@example.com"/></add>')
+        self.assertRaises(ValueError, self.patch, '<add sel="rl:resource-lists/rl:list" type="namespace::foo">urn:foo</add>')
+        self.assertRaises(ValueError, self.patch, '<replace sel="rl:resource-lists/rl:list"><rl:entry uri="sip:carol@example.com"/><rl:entry uri="sip:dave@example.com"/></replace>')
+
+
+if __name__ == '__main__':
+    unittest.main()